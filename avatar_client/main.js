@@ -72,7 +72,10 @@ app.whenReady().then(() => {
 
     mainWindow.setAlwaysOnTop(true, "screen-saver");
     mainWindow.setIgnoreMouseEvents(false); // 可穿透可调整
-    mainWindow.loadFile("index.html");
+    // 多个展位共用一个监控服务时, 通过 --room=<名称> 或环境变量 AVATAR_ROOM 选择展位
+    const roomArg = process.argv.find((arg) => arg.startsWith("--room="));
+    const room = roomArg ? roomArg.slice("--room=".length) : (process.env.AVATAR_ROOM || "");
+    mainWindow.loadFile("index.html", room ? { query: { room } } : undefined);
     // 临时打开 DevTools 以便调试 renderer 日志和 WebSocket 行为
     // try {
     //     mainWindow.webContents.openDevTools();
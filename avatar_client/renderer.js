@@ -1,5 +1,5 @@
 document.addEventListener("DOMContentLoaded", () => {
-    const video = document.getElementById("avatar");
+    let video = document.getElementById("avatar");
     const img = document.getElementById("avatarImg");
     let currentVideo = null;
     let currentPage = null;
@@ -18,8 +18,145 @@ document.addEventListener("DOMContentLoaded", () => {
 
     let isPaused = false;
 
+    // 当前播放列表的延迟追踪 ID, 由 Monitor 随 playlist 下发, 上报事件时原样带回
+    let currentTrace = null;
+
+    // ---- 视频表 ----
+    // Monitor 每个演示文稿只下发一次 {"tasks": "deck", "version": ..., "idle": ..., "slides": [null, ...]},
+    // 翻页时只下发 {"tasks": "cue", "slide": N, "seq": N, "version": ...}, 在本地查表得到要播放的视频.
+    let deckTable = null;
+    // 视频表版本不一致时暂存的 cue, 收到新的视频表后播放
+    let pendingCue = null;
+
+    // ---- 消息序号 ----
+    // Monitor 广播的消息带有递增的 seq 和进程的 epoch, 丢弃同一 epoch 中重复或乱序的消息
+    let serverEpoch = null;
+    let lastSeq = 0;
+    // 从快照恢复时, 第一项视频从该位置 (秒) 开始播放
+    let resumePosition = 0;
+
+    function acceptSequence(msg) {
+        if (typeof msg.seq !== 'number') return true; // 单独的回复不带序号
+        if (msg.epoch !== serverEpoch) {
+            // Monitor 重启
+            serverEpoch = msg.epoch;
+            lastSeq = msg.seq;
+            return true;
+        }
+        if (msg.seq <= lastSeq) return false;
+        lastSeq = msg.seq;
+        return true;
+    }
+
+    // ---- 预加载池 ----
+    // Monitor 通过 {"tasks": "preload", "videos": [{"video": ..., "size": ...}]} 提示即将播放的视频,
+    // 预先用隐藏的 <video> 缓冲, 播放时直接替换当前的 <video>, 不再重新加载.
+    // 按最近使用淘汰 (Map 保持插入顺序), 数量和按文件大小估算的内存都有上限.
+    const PRELOAD_POOL_MAX = 4;
+    const PRELOAD_MEMORY_CAP = 128 * 1024 * 1024;
+    // 大小未知的视频 (没有出现在 preload 消息中, 如播放后放回池中的元素) 按上限平均分配的大小估算, 不计为 0
+    const PRELOAD_DEFAULT_SIZE = PRELOAD_MEMORY_CAP / PRELOAD_POOL_MAX;
+    const preloadPool = new Map(); // src -> {el, size}
+    const knownSizes = new Map();  // src -> size, 来自 preload 消息
+
+    function logInfo(...args) {
+        if (window.electronLog) window.electronLog.info(...args); else console.log(...args);
+    }
+
+    function preloadPoolBytes() {
+        let total = 0;
+        for (const entry of preloadPool.values()) total += entry.size;
+        return total;
+    }
+
+    function releaseVideoElement(el) {
+        try {
+            el.pause();
+            el.removeAttribute('src');
+            el.load();
+        } catch (e) {}
+        el.remove();
+    }
+
+    function evictPreloads() {
+        while (preloadPool.size > 0 && (preloadPool.size > PRELOAD_POOL_MAX || preloadPoolBytes() > PRELOAD_MEMORY_CAP)) {
+            const [src, entry] = preloadPool.entries().next().value;
+            preloadPool.delete(src);
+            releaseVideoElement(entry.el);
+            logInfo('preload evicted:', src);
+        }
+    }
+
+    function createVideoElement() {
+        const el = document.createElement('video');
+        el.preload = 'auto';
+        el.muted = true;
+        el.autoplay = false;
+        el.style.display = 'none';
+        video.parentNode.insertBefore(el, video.nextSibling);
+        return el;
+    }
+
+    // 放入池中, 已存在则移到最近使用的位置
+    function putPreload(src, el) {
+        if (preloadPool.has(src)) {
+            const entry = preloadPool.get(src);
+            preloadPool.delete(src);
+            if (entry.el !== el) releaseVideoElement(entry.el);
+        }
+        preloadPool.set(src, { el: el, size: knownSizes.get(src) || PRELOAD_DEFAULT_SIZE });
+        evictPreloads();
+    }
+
+    function preloadVideo(src) {
+        if (!src || src === video.getAttribute('src')) return;
+        if (preloadPool.has(src)) {
+            putPreload(src, preloadPool.get(src).el);
+            return;
+        }
+        const el = createVideoElement();
+        el.src = src;
+        el.load();
+        putPreload(src, el);
+    }
+
+    function handlePreloadMessage(videos) {
+        if (!Array.isArray(videos)) return;
+        for (const item of videos) {
+            if (!item || !item.video) continue;
+            if (item.size > 0) knownSizes.set(item.video, item.size);
+            preloadVideo(item.video);
+        }
+    }
+
+    // 切换到播放 src 的 <video>: 优先使用预加载的元素, 当前元素放回池中供之后复用
+    function useVideoElement(src) {
+        if (video.getAttribute('src') === src) return;
+        let next = null;
+        if (preloadPool.has(src)) {
+            next = preloadPool.get(src).el;
+            preloadPool.delete(src);
+        } else {
+            next = createVideoElement();
+            next.src = src;
+        }
+        const previous = video;
+        next.id = previous.id;
+        previous.removeAttribute('id');
+        previous.pause();
+        previous.onended = null;
+        previous.style.display = 'none';
+        video = next;
+        const previousSrc = previous.getAttribute('src');
+        if (previousSrc) putPreload(previousSrc, previous);
+        else releaseVideoElement(previous);
+    }
+
     // ---- 向 Monitor 发消息 ----
     function notifyMonitor(event) {
+        if (currentTrace && event && !event.trace) event.trace = currentTrace;
+        // 客户端单调时钟 (毫秒), 监控服务用 started/finished 的差值得到实际播放时长
+        if (event && event.at === undefined) event.at = performance.now();
         try {
             if (window.pptWS && typeof window.pptWS.send === 'function') {
                 window.pptWS.send(event);
@@ -65,11 +202,11 @@ document.addEventListener("DOMContentLoaded", () => {
     // }
     // ----- Playlist / controller handling -----
     function clearPlaybackState() {
-        // stop video
+        // stop video, 保留已缓冲的内容, 切换视频时放回预加载池
         try {
             video.pause();
-            video.removeAttribute('src');
-            video.load();
+            video.onended = null;
+            video.style.display = 'none';
         } catch (e) {
             console.warn('clearPlaybackState video error', e);
         }
@@ -149,7 +286,6 @@ document.addEventListener("DOMContentLoaded", () => {
 
         } else if (item.video) {
             img.style.display = 'none';
-            video.style.display = 'block';
             currentVideo = item.video;
 
             // prepare loop behavior for video:
@@ -158,17 +294,20 @@ document.addEventListener("DOMContentLoaded", () => {
             // >0 => loop that many times
             const loopVal = Number(item.loop);
             if (loopVal === -1) {
-                video.loop = true;
                 videoLoopRemaining = Infinity;
             } else if (loopVal === 0) {
                 // skip this video
                 advanceToNext();
                 return;
             } else {
-                video.loop = false;
                 videoLoopRemaining = Math.max(1, loopVal || 1);
             }
 
+            // 使用预加载的 <video>, 没有则新建
+            useVideoElement(item.video);
+            video.style.display = 'block';
+            video.loop = (videoLoopRemaining === Infinity);
+
             video.onended = () => {
                 if (videoLoopRemaining === Infinity) {
                     // will not happen if video.loop=true, but keep safe
@@ -187,11 +326,19 @@ document.addEventListener("DOMContentLoaded", () => {
                 }
             };
 
-            video.src = item.video;
+            const position = currentIndex === 0 ? resumePosition : 0;
+            video.currentTime = position;
             video.muted = false;
             video.volume = 1;
             video.play().catch(err => { if (window.electronLog) window.electronLog.error('video play error', err); else console.error('video play error', err); });
-            notifyMonitor({ event: 'started', type: 'video', src: item.video, index: currentIndex });
+            notifyMonitor({ event: 'started', type: 'video', src: item.video, index: currentIndex, position: position });
+            // 第一帧渲染完成后上报, 用于统计翻页到数字人出现的延迟
+            if (currentTrace && typeof video.requestVideoFrameCallback === 'function') {
+                const trace = currentTrace;
+                video.requestVideoFrameCallback(() => {
+                    notifyMonitor({ event: 'rendered', type: 'video', src: item.video, index: currentIndex, trace: trace });
+                });
+            }
         } else {
             // unknown item, skip
             if (window.electronLog) window.electronLog.warn('unknown playlist item', item);
@@ -215,6 +362,52 @@ document.addEventListener("DOMContentLoaded", () => {
         startCurrentItem();
     }
 
+    function handleDeckMessage(msg) {
+        deckTable = {
+            deck: msg.deck,
+            version: msg.version,
+            idle: msg.idle || null,
+            slides: Array.isArray(msg.slides) ? msg.slides : []
+        };
+        logInfo('deck table:', msg.deck, msg.version, deckTable.slides.length - 1, 'slides');
+        if (pendingCue && pendingCue.version === deckTable.version) {
+            const cue = pendingCue;
+            pendingCue = null;
+            handleCueMessage(cue);
+        }
+    }
+
+    function handleCueMessage(msg) {
+        if (!deckTable || (msg.version && msg.version !== deckTable.version)) {
+            pendingCue = msg;
+            notifyMonitor({ event: 'need_deck', version: msg.version });
+            return;
+        }
+        currentTrace = msg.trace || null;
+        currentPage = msg.slide;
+        const list = [];
+        const src = deckTable.slides[msg.slide];
+        if (src) list.push({ video: src, loop: 1 });
+        if (deckTable.idle) list.push({ video: deckTable.idle, loop: -1 });
+        // 与 playlist 相同的播放方式; 同一视频的 <video> 直接从头播放, 不重新加载
+        handlePlaylistMessage(list);
+    }
+
+    // 连接 (或重新连接) 后 Monitor 下发的会话快照: 视频表, 从当前项开始的播放列表, 播放位置和暂停状态
+    function handleSnapshotMessage(msg) {
+        serverEpoch = msg.epoch;
+        lastSeq = msg.seq;
+        pendingCue = null;
+        if (msg.deck) handleDeckMessage(msg.deck);
+        currentTrace = msg.trace || null;
+        currentPage = msg.slide;
+        isPaused = false;
+        resumePosition = msg.position > 0 ? msg.position : 0;
+        handlePlaylistMessage(msg.playlist || []);
+        resumePosition = 0;
+        if (msg.paused) pausePlayback();
+    }
+
     function pausePlayback() {
         if (isPaused) return; // already paused
         isPaused = true;
@@ -294,12 +487,32 @@ document.addEventListener("DOMContentLoaded", () => {
         if (!msg || !msg.tasks) return;
 
         const t = msg.tasks;
+        if (t === 'snapshot') {
+            handleSnapshotMessage(msg);
+            return;
+        }
+        if (!acceptSequence(msg)) {
+            logInfo('drop stale message', t, msg.seq);
+            return;
+        }
         if (t === 'playlist') {
             if (window.electronLog) window.electronLog.info('New playlist.'); else console.info('New playlist.');
+            currentTrace = msg.trace || null;
+            pendingCue = null;
             handlePlaylistMessage(msg.playlist || []);
             return;
         }
 
+        if (t === 'deck') {
+            handleDeckMessage(msg);
+            return;
+        }
+
+        if (t === 'cue') {
+            handleCueMessage(msg);
+            return;
+        }
+
         if (t === 'pause') {
             if (window.electronLog) window.electronLog.info('Pausing playback.'); else console.info('Pausing playback.');
             pausePlayback();
@@ -312,11 +525,18 @@ document.addEventListener("DOMContentLoaded", () => {
             return;
         }
 
+        if (t === 'preload') {
+            handlePreloadMessage(msg.videos || []);
+            return;
+        }
+
         if (window.electronLog) window.electronLog.warn('unknown tasks', t); else console.warn('unknown tasks', t);
     }
 
     // ---- 连接 WebSocket ----
-    window.pptWS.connect("ws://localhost:8765", (message) => {
+    const room = new URLSearchParams(window.location.search).get("room");
+    const monitorUrl = "ws://localhost:8765" + (room ? "/" + encodeURIComponent(room) : "");
+    window.pptWS.connect(monitorUrl, (message) => {
         const parsed = parseControllerMessage(message);
         handleControllerMessage(parsed);
     });
@@ -0,0 +1,412 @@
+import asyncio
+import collections
+import email.utils
+import logging
+import mimetypes
+import os
+import time
+import urllib.parse
+
+logger = logging.getLogger("monitor_service")
+
+URL_PREFIX = "/assets/"
+# 请求头的最大长度
+MAX_HEADER_BYTES = 8192
+# 不支持零拷贝时 (例如 TLS) 每次读取的字节数
+CHUNK_SIZE = 256 * 1024
+# 没有传输的文件句柄保持打开的秒数; Windows 上打开的文件不能被替换或删除
+FILE_IDLE_SECONDS = 10.0
+# keep-alive 连接等待下一个请求的秒数, 超时后关闭连接
+KEEP_ALIVE_TIMEOUT = 30.0
+
+mimetypes.add_type("video/webm", ".webm")
+
+REASONS = {200: "OK", 206: "Partial Content", 304: "Not Modified", 400: "Bad Request", 404: "Not Found",
+           405: "Method Not Allowed", 416: "Range Not Satisfiable", 431: "Request Header Fields Too Large",
+           500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+def asset_url(base_url, asset):
+    '''
+    视频在 base_url (AssetServer.base_url) 下的地址
+    '''
+    return base_url + urllib.parse.quote(asset.file.replace("\\", "/"))
+
+
+class _OpenFile():
+    '''
+    打开的视频文件, 传输期间持有引用, 被淘汰后最后一个传输结束时关闭
+    '''
+    __slots__ = ("path", "file", "size", "mtime_ns", "etag", "last_modified", "content_type", "refs", "evicted", "last_used")
+
+    def __init__(self, path, file, st):
+        self.path = path
+        self.file = file
+        self.size = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+        self.etag = '"%x-%x"' % (st.st_size, st.st_mtime_ns)
+        self.last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+        self.content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.refs = 0
+        self.evicted = False
+        # 最后一次传输结束的 time.monotonic() 时间
+        self.last_used = time.monotonic()
+
+    def matches(self, st):
+        return st.st_size == self.size and st.st_mtime_ns == self.mtime_ns
+
+
+class FileHandleCache():
+    '''
+    按 LRU 缓存打开的文件, 最多 max_open 个
+    每次请求只 stat 一次确认文件没有被替换, 不再重复 open/close; 文件变化时重新打开.
+    超过 idle_seconds 没有使用的文件由 close_idle() 关闭, 操作员可以替换或删除视频文件.
+    '''
+    def __init__(self, max_open=32, idle_seconds=FILE_IDLE_SECONDS):
+        self.max_open = max_open
+        self.idle_seconds = idle_seconds
+        self.hits = 0
+        self.misses = 0
+        self.idle_closed = 0
+        self._files = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._files)
+
+    def acquire(self, path):
+        '''
+        返回 path 的 _OpenFile 并增加引用, 使用完后调用 release(); 文件不存在时抛出 OSError
+        '''
+        st = os.stat(path)
+        entry = self._files.get(path)
+        if entry is not None and entry.matches(st):
+            self._files.move_to_end(path)
+            self.hits += 1
+        else:
+            if entry is not None:
+                self._evict(path)
+            self.misses += 1
+            file = open(path, "rb")
+            entry = _OpenFile(path, file, os.fstat(file.fileno()))
+            self._files[path] = entry
+            while len(self._files) > self.max_open:
+                self._evict(next(iter(self._files)))
+        entry.refs += 1
+        return entry
+
+    def release(self, entry):
+        entry.refs -= 1
+        entry.last_used = time.monotonic()
+        if entry.evicted and entry.refs == 0:
+            entry.file.close()
+
+    def close_idle(self, now=None):
+        '''
+        关闭超过 idle_seconds 没有使用并且没有在传输的文件
+        '''
+        now = time.monotonic() if now is None else now
+        for path, entry in list(self._files.items()):
+            if entry.refs == 0 and now - entry.last_used >= self.idle_seconds:
+                self._evict(path)
+                self.idle_closed += 1
+
+    def _evict(self, path):
+        entry = self._files.pop(path)
+        entry.evicted = True
+        if entry.refs == 0:
+            entry.file.close()
+
+    def close(self):
+        for path in list(self._files):
+            self._evict(path)
+
+
+class HttpError(Exception):
+    def __init__(self, status, headers=None):
+        super().__init__(status)
+        self.status = status
+        self.headers = headers or {}
+
+
+def parse_range(value, size):
+    '''
+    解析单个字节范围 "bytes=start-end", "bytes=start-", "bytes=-suffix", 返回 (start, end) (包含 end)
+    多个范围或格式不正确时返回 None (按完整文件回复), 范围超出文件时抛出 HttpError(416)
+    '''
+    unit, _, ranges = value.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        return None
+    first, sep, last = ranges.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if first == "":
+            suffix = int(last)
+            if suffix <= 0:
+                raise HttpError(416, {"Content-Range": "bytes */%s" % size})
+            start, end = max(0, size - suffix), size - 1
+        else:
+            start = int(first)
+            end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        raise HttpError(416, {"Content-Range": "bytes */%s" % size})
+    if start < 0 or end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+class AssetServer():
+    '''
+    视频文件的 HTTP 服务, 与 WebSocket 服务运行在同一个事件循环中
+    只提供 slide_video.json 中配置的文件: GET/HEAD /assets/<slide_video.json 中的路径>
+      Range: 单个字节范围, 播放器拖动和断点续传时只传输需要的部分;
+      ETag (大小和 mtime) 和 Cache-Control, 播放器重复播放同一视频时使用缓存 (304);
+      文件内容通过 loop.sendfile 零拷贝发送 (Linux 上为 os.sendfile, Windows 上为 TransmitFile);
+      打开的文件按 LRU 缓存 (FileHandleCache), 空闲 file_idle_seconds 秒后关闭;
+      keep-alive 连接 keep_alive_timeout 秒没有新请求时关闭.
+    url(asset) 返回播放列表和视频表中使用的地址, public_host 为其他机器 (第二块显示屏) 访问本机的地址.
+    add_route() 注册其他路径 (如 /metrics, /health) 的处理函数.
+    '''
+    def __init__(self, manifest, host="localhost", port=8766, public_host=None, max_age=3600, max_open=32,
+                 file_idle_seconds=FILE_IDLE_SECONDS, keep_alive_timeout=KEEP_ALIVE_TIMEOUT):
+        self.manifest = manifest
+        self.host = host
+        self.port = port
+        self.public_host = public_host or host
+        self.max_age = max_age
+        self.keep_alive_timeout = keep_alive_timeout
+        self.files = FileHandleCache(max_open, file_idle_seconds)
+        self.requests = 0
+        self.not_modified = 0
+        self.partial = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.connections = 0
+        self.idle_timeouts = 0
+        self._server = None
+        self._sweeper = None
+        self._routes = {}
+        self._routes_generation = None
+        # 路径 -> 处理函数, 返回 (状态码, Content-Type, 内容)
+        self._handlers = {}
+
+    @property
+    def base_url(self):
+        host = self.public_host
+        if ":" in host and not host.startswith("["):
+            host = "[%s]" % host
+        return "http://%s:%s%s" % (host, self.port, URL_PREFIX)
+
+    def url(self, asset):
+        return asset_url(self.base_url, asset)
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port, limit=MAX_HEADER_BYTES)
+        if not self.port:
+            # 端口为 0 时使用系统分配的端口
+            self.port = self._server.sockets[0].getsockname()[1]
+        self._sweeper = asyncio.create_task(self._close_idle_files())
+        logger.info("视频文件服务: %s", self.base_url)
+
+    async def close(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        self.files.close()
+
+    async def _close_idle_files(self):
+        # 文件最多在空闲 2 * idle_seconds 后关闭
+        while True:
+            await asyncio.sleep(self.files.idle_seconds)
+            self.files.close_idle()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def add_route(self, path, fn):
+        '''
+        GET/HEAD path 时调用 fn(), 返回 (状态码, Content-Type, str 或 bytes), 不缓存
+        '''
+        self._handlers[path] = fn
+
+    def _resolve(self, url_path):
+        '''
+        URL 路径对应的本地文件, 不在视频清单中时返回 None
+        '''
+        if self._routes_generation != self.manifest.generation:
+            routes = {}
+            for deck in self.manifest.decks.values():
+                for asset in deck.assets():
+                    routes[asset.file.replace("\\", "/")] = asset.path
+            self._routes = routes
+            self._routes_generation = self.manifest.generation
+        if not url_path.startswith(URL_PREFIX):
+            return None
+        return self._routes.get(urllib.parse.unquote(url_path[len(URL_PREFIX):]))
+
+    async def _read_request(self, reader):
+        '''
+        读取请求行和请求头, 连接关闭时返回 None
+        '''
+        try:
+            data = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError:
+            return None
+        except asyncio.LimitOverrunError:
+            raise HttpError(431)
+        lines = data.decode("latin-1").split("\r\n")
+        parts = lines[0].split()
+        if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+            raise HttpError(400)
+        headers = {}
+        for line in lines[1:]:
+            if line:
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+        return parts[0], parts[1], parts[2], headers
+
+    async def _handle_connection(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self._read_request(reader), self.keep_alive_timeout)
+                except asyncio.TimeoutError:
+                    # 客户端没有关闭的空闲连接
+                    self.idle_timeouts += 1
+                    break
+                except HttpError as e:
+                    self.errors += 1
+                    await self._send_head(writer, e.status, e.headers, 0, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                method, target, version, headers = request
+                keep_alive = headers.get("connection", "").lower() != "close" and version != "HTTP/1.0"
+                self.requests += 1
+                try:
+                    await self._respond(writer, method, target, headers, keep_alive)
+                except HttpError as e:
+                    self.errors += 1
+                    await self._send_head(writer, e.status, e.headers, 0, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        except Exception as e:
+            logger.warning("视频文件服务处理请求失败: %s", e)
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def _send_head(self, writer, status, headers, length, keep_alive=True):
+        lines = ["HTTP/1.1 %s %s" % (status, REASONS.get(status, ""))]
+        headers = dict(headers)
+        headers["Content-Length"] = str(length)
+        headers["Connection"] = "keep-alive" if keep_alive else "close"
+        if keep_alive:
+            headers["Keep-Alive"] = "timeout=%d" % max(1, self.keep_alive_timeout)
+        # 渲染进程从 file:// 加载, 预加载和 fetch 需要跨域
+        headers["Access-Control-Allow-Origin"] = "*"
+        lines.extend("%s: %s" % item for item in headers.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+
+    async def _respond(self, writer, method, target, headers, keep_alive):
+        if method not in ("GET", "HEAD"):
+            raise HttpError(405, {"Allow": "GET, HEAD"})
+        url_path = urllib.parse.urlsplit(target).path
+        fn = self._handlers.get(url_path)
+        if fn is not None:
+            await self._respond_dynamic(writer, method, fn, keep_alive)
+            return
+        path = self._resolve(url_path)
+        if path is None:
+            raise HttpError(404)
+        try:
+            entry = self.files.acquire(path)
+        except OSError:
+            raise HttpError(404)
+        try:
+            response = {
+                "Content-Type": entry.content_type,
+                "Accept-Ranges": "bytes",
+                "ETag": entry.etag,
+                "Last-Modified": entry.last_modified,
+                "Cache-Control": "public, max-age=%s" % self.max_age
+            }
+            if_none_match = headers.get("if-none-match")
+            if if_none_match and (if_none_match == "*" or entry.etag in [tag.strip() for tag in if_none_match.split(",")]):
+                self.not_modified += 1
+                await self._send_head(writer, 304, response, 0, keep_alive)
+                return
+            status, start, end = 200, 0, entry.size - 1
+            byte_range = headers.get("range")
+            if byte_range and headers.get("if-range", entry.etag) == entry.etag:
+                parsed = parse_range(byte_range, entry.size)
+                if parsed is not None:
+                    status, (start, end) = 206, parsed
+                    response["Content-Range"] = "bytes %s-%s/%s" % (start, end, entry.size)
+                    self.partial += 1
+            count = max(0, end - start + 1)
+            await self._send_head(writer, status, response, count, keep_alive)
+            if method == "GET" and count:
+                await self._send_body(writer, entry, start, count)
+        finally:
+            self.files.release(entry)
+
+    async def _respond_dynamic(self, writer, method, fn, keep_alive):
+        try:
+            status, content_type, body = fn()
+        except Exception as e:
+            logger.warning("处理请求失败: %s", e)
+            raise HttpError(500)
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        await self._send_head(writer, status, {"Content-Type": content_type, "Cache-Control": "no-store"}, len(body), keep_alive)
+        if method == "GET" and body:
+            writer.write(body)
+            await writer.drain()
+
+    async def _send_body(self, writer, entry, offset, count):
+        loop = asyncio.get_running_loop()
+        try:
+            sent = await loop.sendfile(writer.transport, entry.file, offset, count, fallback=False)
+        except (asyncio.SendfileNotAvailableError, NotImplementedError):
+            # 没有零拷贝时直接读取; 同一文件对象被多个连接共用, seek 和 read 之间不能让出事件循环
+            sent = 0
+            while sent < count:
+                entry.file.seek(offset + sent)
+                data = entry.file.read(min(CHUNK_SIZE, count - sent))
+                if not data:
+                    break
+                writer.write(data)
+                sent += len(data)
+                await writer.drain()
+        self.bytes_sent += sent
+
+    def as_dict(self):
+        return {
+            "url": self.base_url,
+            "connections": self.connections,
+            "idle_timeouts": self.idle_timeouts,
+            "requests": self.requests,
+            "not_modified": self.not_modified,
+            "partial": self.partial,
+            "errors": self.errors,
+            "bytes_sent": self.bytes_sent,
+            "open_files": len(self.files),
+            "file_cache_hits": self.files.hits,
+            "file_cache_misses": self.files.misses,
+            "files_idle_closed": self.files.idle_closed
+        }
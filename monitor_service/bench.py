@@ -0,0 +1,459 @@
+'''
+离线性能测试: 模拟的 PowerPoint (fake_com) 和模拟的数字人客户端, 不需要 Windows
+
+    cd monitor_service && python bench.py
+    python bench.py --clients 200 --json ../log/bench.json
+
+测量:
+  detection  翻页到主循环取出变化的延迟, 分别测试轮询方式和事件方式
+  fanout     广播 playlist 到所有客户端收到的时间, 以及客户端回复 started 的往返时间
+  idle       无人操作时每小时的 CPU 时间和 COM 调用次数
+  discovery  没有运行 PowerPoint 时每小时的 GetActiveObject 次数和 CPU 时间, 以及 PowerPoint 启动并开始放映后
+             检测到放映的时间; 分别测试每次轮询都查找 (fixed), 退避 (backoff) 和退避加进程检查 (precheck)
+  stall      PowerPoint 弹出模态对话框 (COM 调用阻塞) 时事件循环的最大延迟,
+             分别测试在事件循环中直接调用和通过 ComWorker 调用
+  rooms      多个房间 (展位) 共用一个事件循环时, 向一个房间广播的时间; 其他房间的客户端不应收到消息
+  assets     视频文件服务 (AssetServer) 的吞吐量和每个 Range 请求的延迟, 多个保持连接的客户端并发请求
+  logging    主循环中每次记录广播日志的耗时 (完整的播放列表消息), 分别测试直接写文件和控制台,
+             以及通过日志队列 (logging_setup) 由后台线程写入
+  startup    在没有 pywin32, tendo 的情况下导入 monitor 的耗时 (目标 STARTUP_TARGET_SECONDS,
+             由 tests/test_startup.py 检查)
+'''
+import argparse
+import asyncio
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import time
+
+import websockets
+
+from asset_server import AssetServer
+from com_worker import ComWorker
+from discovery import AppDiscovery
+import logging_setup
+from fake_com import FakeComEventSlideSource, FakePowerPointApp, apply_slide_action, fake_get_active_object, generate_slide_script
+from manifest import SlideVideoManifest
+import protocol
+from ppt_com import PowerPointMonitor
+from server import handler
+from slide_source import PollIntervals, PollingSlideSource
+from tracing import LatencyHistogram
+
+DECK_NAME = "demo-大模型介绍.pptx"
+
+# 导入 monitor 的目标耗时 (秒)
+STARTUP_TARGET_SECONDS = 0.5
+
+# 在子进程中屏蔽 Windows 相关模块后导入 monitor, 输出导入耗时
+STARTUP_PROBE = """
+import sys, time
+for name in ("win32com", "win32com.client", "pythoncom", "pywintypes", "tendo", "tendo.singleton"):
+    sys.modules[name] = None
+start = time.perf_counter()
+import monitor
+elapsed = time.perf_counter() - start
+assert "win32com.client" not in sys.modules or sys.modules["win32com.client"] is None
+print(elapsed)
+"""
+
+
+def make_monitor(manifest, call_delay, show=True, slides=20):
+    app = FakePowerPointApp(call_delay)
+    presentation = app.open(DECK_NAME, slides)
+    if show:
+        presentation.start_show()
+    monitor = PowerPointMonitor(manifest, get_active_object=fake_get_active_object(app))
+    monitor.connect_powerpoint()
+    return app, presentation, monitor
+
+
+def make_source(mode, monitor, app, poll_interval, worker=None):
+    if mode == "polling":
+        return PollingSlideSource(monitor, interval=poll_interval, worker=worker)
+    return FakeComEventSlideSource(monitor, app)
+
+
+async def bench_detection(manifest, mode, args):
+    app, presentation, monitor = make_monitor(manifest, args.call_delay, slides=args.slides)
+    source = make_source(mode, monitor, app, args.poll_interval)
+    await source.start()
+    histogram = LatencyHistogram()
+    script = generate_slide_script(args.slides, args.changes, args.interval, seed=args.seed)
+    try:
+        for delay, action, argument in script:
+            await asyncio.sleep(delay)
+            changed_at = time.monotonic()
+            before = presentation._show_index
+            apply_slide_action(presentation, action, argument)
+            if presentation._show_index == before:
+                continue
+            change = await source.next_change(timeout=args.poll_interval * 4 + 1)
+            if change is not None:
+                histogram.add(time.monotonic() - changed_at)
+    finally:
+        await source.stop()
+    return histogram.summary()
+
+
+class SimulatedAvatarClient():
+    '''
+    模拟数字人客户端: 收到 playlist 后记录时间, 并回复 started 事件
+    '''
+    def __init__(self, url):
+        self.url = url
+        self.received = {}
+        self.messages = 0
+        self.websocket = None
+
+    async def run(self, connected):
+        async with websockets.connect(self.url) as websocket:
+            self.websocket = websocket
+            connected.release()
+            async for message in websocket:
+                msg = json.loads(message)
+                self.messages += 1
+                if msg.get("tasks") != "playlist":
+                    continue
+                self.received[msg.get("trace")] = time.monotonic()
+                await websocket.send(json.dumps({"event": "started", "type": "video", "src": "", "trace": msg.get("trace")}))
+
+
+async def connect_clients(port, room_name, count):
+    clients = [SimulatedAvatarClient("ws://localhost:%s/%s" % (port, room_name)) for _ in range(count)]
+    connected = asyncio.Semaphore(0)
+    tasks = [asyncio.create_task(client.run(connected)) for client in clients]
+    for _ in clients:
+        await connected.acquire()
+    # 等待每个客户端收到连接时的快照
+    while len(handler.room(room_name).clients) < count or any(client.messages == 0 for client in clients):
+        await asyncio.sleep(0.01)
+    return clients, tasks
+
+
+async def broadcast_rounds(room, clients, rounds):
+    '''
+    向房间广播 rounds 次 playlist, 返回所有客户端收到的时间
+    '''
+    fanout = LatencyHistogram()
+    for slide in range(1, rounds + 1):
+        trace = room.tracer.begin(None, slide)
+        message = protocol.playlist_message([{"video": "../assets/videos/demo-10-Summery.webm", "loop": 1}], trace)
+        sent_at = time.monotonic()
+        await room.send_to_clients("playlist", message, trace)
+        deadline = sent_at + 10
+        while time.monotonic() < deadline and not all(trace in client.received for client in clients):
+            await asyncio.sleep(0.001)
+        received = [client.received[trace] for client in clients if trace in client.received]
+        if received:
+            fanout.add(max(received) - sent_at)
+    return fanout
+
+
+async def bench_fanout(args):
+    room = handler.room("bench-fanout")
+    async with websockets.serve(handler.handler, "localhost", 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        clients, tasks = await connect_clients(port, room.name, args.clients)
+        fanout = await broadcast_rounds(room, clients, args.rounds)
+        # 等待最后的 started 事件
+        await asyncio.sleep(0.2)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    latency = room.tracer.summary()
+    return {"all_clients_received": fanout.summary(),
+            "sent->written": latency["sent->written"],
+            "written->started": latency["written->started"]}
+
+
+async def bench_rooms(args):
+    '''
+    args.rooms 个房间, 每个房间 args.room_clients 个客户端, 只向第一个房间广播
+    '''
+    async with websockets.serve(handler.handler, "localhost", 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        rooms = []
+        tasks = []
+        for index in range(args.rooms):
+            clients, room_tasks = await connect_clients(port, "bench-room-%s" % index, args.room_clients)
+            rooms.append((handler.room("bench-room-%s" % index), clients))
+            tasks.extend(room_tasks)
+        target, target_clients = rooms[0]
+        others = [client for _room, clients in rooms[1:] for client in clients]
+        before = sum(client.messages for client in others)
+        fanout = await broadcast_rounds(target, target_clients, args.rounds)
+        await asyncio.sleep(0.1)
+        leaked = sum(client.messages for client in others) - before
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return {"rooms": args.rooms, "clients": args.rooms * args.room_clients,
+            "room_received": fanout.summary(), "other_rooms_received": leaked}
+
+
+async def bench_idle(manifest, mode, args):
+    app, _presentation, monitor = make_monitor(manifest, args.call_delay, show=False, slides=args.slides)
+    source = make_source(mode, monitor, app, args.poll_interval)
+    await source.start()
+    calls_before = app.com_calls
+    cpu_before = time.process_time()
+    await asyncio.sleep(args.idle_seconds)
+    cpu = time.process_time() - cpu_before
+    calls = app.com_calls - calls_before
+    await source.stop()
+    scale = 3600.0 / args.idle_seconds
+    return {"cpu_seconds_per_hour": round(cpu * scale, 3), "com_calls_per_hour": int(calls * scale)}
+
+
+async def bench_discovery(manifest, mode, args):
+    '''
+    mode: fixed 每次轮询都查找所有程序 (之前的行为), backoff 按退避查找,
+          precheck 退避并先检查进程 (模拟的进程列表)
+    '''
+    state = {"app": None, "lookups": 0}
+
+    def get_active_object(name):
+        state["lookups"] += 1
+        if name == "PowerPoint.Application" and state["app"] is not None:
+            return state["app"]
+        raise RuntimeError("Operation unavailable: %s" % name)
+
+    monitor = PowerPointMonitor(manifest, get_active_object=get_active_object)
+    if mode == "fixed":
+        monitor.discovery = AppDiscovery(monitor._ppt_app_list, min_delay=0.0, max_delay=0.0, process_check=None)
+        intervals = PollIntervals(args.poll_interval)
+    else:
+        process_check = None
+        if mode == "precheck":
+            process_check = lambda: {"powerpnt.exe"} if state["app"] is not None else {"explorer.exe"}
+        monitor.discovery = AppDiscovery(monitor._ppt_app_list, process_check=process_check)
+        intervals = PollIntervals(args.poll_interval / 2, args.poll_interval, args.poll_interval * 4)
+    source = PollingSlideSource(monitor, interval=intervals)
+    await source.start()
+    cpu_before = time.process_time()
+    await asyncio.sleep(args.idle_seconds)
+    cpu = time.process_time() - cpu_before
+    lookups = state["lookups"]
+    scale = 3600.0 / args.idle_seconds
+
+    # PowerPoint 启动并开始放映
+    app = FakePowerPointApp(args.call_delay)
+    app.open(DECK_NAME, args.slides).start_show()
+    started = time.monotonic()
+    state["app"] = app
+    reaction = None
+    deadline = started + 30
+    while time.monotonic() < deadline:
+        change = await source.next_change(timeout=deadline - time.monotonic())
+        if change is not None and change.status["present_slide_index"] > 0:
+            reaction = change.detected_at - started
+            break
+    await source.stop()
+    return {"lookups_per_hour": int(lookups * scale), "cpu_seconds_per_hour": round(cpu * scale, 3),
+            "show_detected_ms": round(reaction * 1000, 1) if reaction is not None else None,
+            "backoff_failures": monitor.discovery.failures}
+
+
+async def bench_stall(manifest, mode, args):
+    '''
+    mode: inline 在事件循环中轮询, worker 通过 ComWorker 轮询
+    '''
+    app, _presentation, monitor = make_monitor(manifest, args.call_delay, slides=args.slides)
+    worker = ComWorker(default_timeout=args.com_timeout) if mode == "worker" else None
+    source = make_source("polling", monitor, app, args.poll_interval, worker)
+    await source.start()
+    app.stall(args.stall_seconds)
+    max_lag = 0.0
+    deadline = time.monotonic() + args.stall_seconds + args.poll_interval * 2
+    while time.monotonic() < deadline:
+        expected = time.monotonic() + 0.01
+        await asyncio.sleep(0.01)
+        max_lag = max(max_lag, time.monotonic() - expected)
+    await source.stop()
+    result = {"max_loop_lag_ms": round(max_lag * 1000, 2)}
+    if worker is not None:
+        stats = worker.as_dict()
+        result.update({key: stats[key] for key in ("calls", "timeouts", "hung", "late")})
+        worker.stop()
+    return result
+
+
+async def fetch_range(reader, writer, path, start, end):
+    '''
+    在保持的连接上发送一个 Range 请求, 返回收到的正文字节数
+    '''
+    writer.write(("GET %s HTTP/1.1\r\nHost: bench\r\nRange: bytes=%s-%s\r\n\r\n" % (path, start, end)).encode("latin-1"))
+    head = await reader.readuntil(b"\r\n\r\n")
+    length = 0
+    for line in head.decode("latin-1").split("\r\n"):
+        if line.lower().startswith("content-length:"):
+            length = int(line.split(":", 1)[1])
+    await reader.readexactly(length)
+    return length
+
+
+async def bench_assets(manifest, args):
+    server = AssetServer(manifest, "127.0.0.1", 0)
+    await server.start()
+    assets = {}
+    for deck in manifest.decks.values():
+        for asset in deck.assets():
+            if asset.playable:
+                assets[asset.file] = asset
+    paths = [server.url(asset).split(str(server.port), 1)[1] for asset in assets.values()]
+    sizes = [asset.size for asset in assets.values()]
+    histogram = LatencyHistogram()
+    chunk = 256 * 1024
+
+    async def client(index):
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+        received = 0
+        try:
+            for n in range(index, args.asset_requests, args.asset_clients):
+                i = n % len(paths)
+                start = (n * chunk) % max(1, sizes[i] - chunk)
+                began = time.monotonic()
+                received += await fetch_range(reader, writer, paths[i], start, start + chunk - 1)
+                histogram.add(time.monotonic() - began)
+        finally:
+            writer.close()
+        return received
+
+    began = time.monotonic()
+    received = sum(await asyncio.gather(*[client(i) for i in range(args.asset_clients)]))
+    elapsed = time.monotonic() - began
+    stats = server.as_dict()
+    await server.close()
+    return {"range_request_ms": histogram.summary(), "throughput_mb_s": round(received / elapsed / 1e6, 1),
+            "file_cache_hits": stats["file_cache_hits"], "file_cache_misses": stats["file_cache_misses"]}
+
+
+def bench_logging(count=2000):
+    '''
+    记录 count 条广播日志的单次耗时, 控制台输出到 os.devnull
+    sync: 与之前相同, 在调用线程中格式化完整消息并写入滚动文件和控制台
+    queued: NonBlockingQueueHandler 放入队列, 消息截断, 同一位置限流
+    '''
+    playlist = [{"video": "http://localhost:8766/assets/videos/demo-%s.webm" % i, "loop": 1} for i in range(40)]
+    message = json.dumps({"tasks": "play", "playlist": playlist, "seq": 1, "epoch": "bench"})
+    results = {"message_bytes": len(message)}
+    with tempfile.TemporaryDirectory() as tmp, open(os.devnull, "w") as devnull:
+        for mode in ("sync", "queued"):
+            file_handler = logging.handlers.RotatingFileHandler(os.path.join(tmp, mode + ".log"), maxBytes=5 * 1024 * 1024,
+                                                                backupCount=1, encoding="utf-8")
+            console_handler = logging.StreamHandler(devnull)
+            log = logging.getLogger("bench.logging." + mode)
+            log.propagate = False
+            log.setLevel(logging.INFO)
+            listener = None
+            if mode == "sync":
+                formatter = logging.Formatter('%(asctime)s %(levelname)s [%(name)s] %(message)s')
+                file_handler.setFormatter(formatter)
+                console_handler.setFormatter(formatter)
+                log.addHandler(file_handler)
+                log.addHandler(console_handler)
+                arg = message
+            else:
+                file_handler.setFormatter(logging_setup.JsonFormatter())
+                console_handler.setFormatter(logging_setup.TextFormatter('%(asctime)s %(levelname)s [%(name)s] %(message)s'))
+                queue_handler = logging_setup.NonBlockingQueueHandler(queue.Queue(logging_setup.QUEUE_SIZE))
+                queue_handler.addFilter(logging_setup.RateLimitFilter())
+                listener = logging.handlers.QueueListener(queue_handler.queue, file_handler, console_handler)
+                listener.start()
+                log.addHandler(queue_handler)
+                arg = logging_setup.preview(message)
+            histogram = LatencyHistogram(max_samples=count)
+            started = time.perf_counter()
+            for i in range(count):
+                t0 = time.perf_counter()
+                log.info("Broadcasting message to %s clients in %s: %s", 50, "default", arg)
+                histogram.add(time.perf_counter() - t0)
+            elapsed = time.perf_counter() - started
+            if listener is not None:
+                listener.stop()
+            for handler in list(log.handlers):
+                log.removeHandler(handler)
+                handler.close()
+            results[mode] = {"call_ms": histogram.summary(), "calls_per_second": round(count / elapsed),
+                             "file_bytes": os.path.getsize(os.path.join(tmp, mode + ".log"))}
+    return results
+
+
+def bench_startup(repeat=3):
+    '''
+    导入 monitor 的耗时, 每次在新的子进程中测量, 取最小值
+    '''
+    samples = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, "-c", STARTUP_PROBE], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        if result.returncode != 0:
+            return {"error": result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "exit %s" % result.returncode}
+        samples.append(float(result.stdout.strip().splitlines()[-1]))
+    seconds = min(samples)
+    return {"import_ms": round(seconds * 1000, 2), "target_ms": STARTUP_TARGET_SECONDS * 1000,
+            "ok": seconds <= STARTUP_TARGET_SECONDS}
+
+
+async def run(args):
+    manifest = SlideVideoManifest()
+    manifest.load()
+    results = {"detection_ms": {}, "idle": {}}
+    for mode in ("polling", "events"):
+        results["detection_ms"][mode] = await bench_detection(manifest, mode, args)
+    results["fanout_ms"] = await bench_fanout(args)
+    results["rooms"] = await bench_rooms(args)
+    for mode in ("polling", "events"):
+        results["idle"][mode] = await bench_idle(manifest, mode, args)
+    results["discovery"] = {}
+    for mode in ("fixed", "backoff", "precheck"):
+        results["discovery"][mode] = await bench_discovery(manifest, mode, args)
+    results["stall"] = {}
+    for mode in ("inline", "worker"):
+        results["stall"][mode] = await bench_stall(manifest, mode, args)
+    results["assets"] = await bench_assets(manifest, args)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="monitor_service 离线性能测试")
+    parser.add_argument("--clients", type=int, default=50, help="模拟的数字人客户端数量")
+    parser.add_argument("--rounds", type=int, default=20, help="广播 playlist 的次数")
+    parser.add_argument("--slides", type=int, default=20, help="模拟演示文稿的幻灯片数量")
+    parser.add_argument("--changes", type=int, default=20, help="翻页次数")
+    parser.add_argument("--interval", type=float, default=0.2, help="平均翻页间隔 (秒)")
+    parser.add_argument("--poll-interval", type=float, default=0.5, help="轮询方式的间隔 (秒)")
+    parser.add_argument("--call-delay", type=float, default=0.0005, help="模拟每次 COM 调用的耗时 (秒)")
+    parser.add_argument("--idle-seconds", type=float, default=5.0, help="空闲 CPU 测量时长 (秒)")
+    parser.add_argument("--stall-seconds", type=float, default=2.0, help="模拟模态对话框阻塞 COM 调用的时长 (秒)")
+    parser.add_argument("--com-timeout", type=float, default=0.5, help="ComWorker 的调用超时 (秒)")
+    parser.add_argument("--rooms", type=int, default=20, help="多房间测试的房间数量")
+    parser.add_argument("--room-clients", type=int, default=10, help="多房间测试中每个房间的客户端数量")
+    parser.add_argument("--asset-clients", type=int, default=8, help="并发请求视频文件的连接数")
+    parser.add_argument("--asset-requests", type=int, default=400, help="视频文件 Range 请求的总数")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="结果另存为 JSON 文件")
+    parser.add_argument("--verbose", action="store_true", help="输出 monitor_service 日志")
+    args = parser.parse_args(argv)
+
+    logging.getLogger("monitor_service").setLevel(logging.DEBUG if args.verbose else logging.CRITICAL)
+    results = asyncio.run(run(args))
+    results["logging"] = bench_logging()
+    results["startup"] = bench_startup()
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    # 视频清单等相对路径相对 monitor_service; 只在作为程序运行时切换, 导入本模块不改变当前目录
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    sys.exit(main())
@@ -0,0 +1,113 @@
+import asyncio
+import collections
+import logging
+import time
+
+logger = logging.getLogger("monitor_service")
+
+# 同一类消息只有最新的一条有意义, 客户端跟不上时丢弃队列中较旧的同类消息
+# cue 与 playlist 都表示当前要播放的内容, 互相替代
+COALESCE_KEYS = {
+    "playlist": "playlist",
+    "cue": "playlist",
+    "deck": "deck",
+    "preload": "preload",
+    "pause": "playback",
+    "play": "playback"
+}
+
+
+class ClientChannel():
+    '''
+    一个客户端的发送通道: 有界的发送队列和单独的发送任务
+    广播只把消息放入队列后立即返回, 慢客户端不会阻塞主循环和其他客户端.
+    客户端跟不上时合并同类消息 (如 playlist 只保留最新的一条);
+    单条消息发送超过 send_timeout 秒, 或队列已满, 则断开该客户端.
+    '''
+    def __init__(self, websocket, client_addr=None, max_queue=32, send_timeout=5.0, on_sent=None):
+        self.websocket = websocket
+        self.client_addr = client_addr
+        self.max_queue = max_queue
+        self.send_timeout = send_timeout
+        # on_sent(trace): 带有 trace 的消息写入连接后调用
+        self.on_sent = on_sent
+        self.queue = collections.deque()
+        self.sent = 0
+        self.coalesced = 0
+        # 队列已满, 发送超时或失败的次数 (每次都会断开客户端)
+        self.failures = 0
+        self.closed = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._writer())
+
+    def enqueue(self, message, kind=None, trace=None):
+        '''
+        放入发送队列, 返回是否成功; 队列已满时断开客户端
+        '''
+        if self.closed:
+            return False
+        key = COALESCE_KEYS.get(kind)
+        if key is not None and self.queue:
+            before = len(self.queue)
+            self.queue = collections.deque(item for item in self.queue if item[0] != key)
+            self.coalesced += before - len(self.queue)
+        if len(self.queue) >= self.max_queue:
+            logger.warning("Client %s send queue full (%s), dropping client", self.client_addr, len(self.queue))
+            self.failures += 1
+            self.drop()
+            return False
+        self.queue.append((key, message, time.monotonic(), trace))
+        self._wakeup.set()
+        return True
+
+    async def _writer(self):
+        try:
+            # 检查 closed: wait_for 在发送刚好完成时可能吞掉 close() 的取消 (Python 3.11), 不能只依赖 cancel
+            while not self.closed:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self.queue:
+                    _key, message, _queued_at, trace = self.queue.popleft()
+                    try:
+                        await asyncio.wait_for(self.websocket.send(message), self.send_timeout)
+                        self.sent += 1
+                        if trace is not None and self.on_sent is not None:
+                            self.on_sent(trace)
+                    except asyncio.TimeoutError:
+                        logger.warning("Client %s stuck for %.1fs, dropping client", self.client_addr, self.send_timeout)
+                        self.failures += 1
+                        self.drop()
+                        return
+                    except Exception as e:
+                        logger.info("Client %s send failed: %s", self.client_addr, e)
+                        self.failures += 1
+                        self.drop()
+                        return
+        except asyncio.CancelledError:
+            pass
+
+    def drop(self):
+        '''
+        停止发送并断开连接, 接收循环随之结束并清理客户端
+        '''
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.clear()
+        if self._task is not asyncio.current_task():
+            self._task.cancel()
+        transport = getattr(self.websocket, "transport", None)
+        if transport is not None:
+            # 对端卡住时正常的关闭握手也会卡住, 直接中断连接
+            transport.abort()
+        else:
+            asyncio.create_task(self.websocket.close())
+
+    async def close(self):
+        self.closed = True
+        self.queue.clear()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
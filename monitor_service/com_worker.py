@@ -0,0 +1,272 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+
+from tracing import LatencyHistogram
+
+logger = logging.getLogger("monitor_service")
+
+
+class ComTimeoutError(TimeoutError):
+    '''
+    COM 调用在超时时间内没有完成, 例如 PowerPoint 弹出了模态对话框或正在保存文件
+    '''
+    pass
+
+
+class _ComJob():
+    __slots__ = ("fn", "args", "name", "future", "loop", "queued_at", "started_at", "finished", "cancelled", "timed_out",
+                 "hung")
+
+    def __init__(self, fn, args, name, future, loop):
+        self.fn = fn
+        self.args = args
+        self.name = name
+        self.future = future
+        self.loop = loop
+        self.queued_at = time.monotonic()
+        self.started_at = None
+        self.finished = False
+        self.cancelled = False
+        self.timed_out = False
+        self.hung = False
+
+
+def _resolve(future, result, error):
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class ComWorker():
+    '''
+    单线程单元 (STA) 的 COM 工作线程
+    COM 对象只能在创建它的线程中使用, 而 PowerPoint 忙碌时 (模态对话框, 保存文件, 渲染动画)
+    一次调用可能阻塞数秒. 所有对 PowerPointMonitor 的调用都放到这个线程中顺序执行,
+    事件循环只 await 结果, 慢调用不再阻塞 WebSocket 的收发.
+
+    call() 超时后抛出 ComTimeoutError:
+      还没有开始执行的调用直接取消, 不会再执行;
+      已经在执行的调用无法中断, 计为 hung, 完成后丢弃结果并记录耗时 (late);
+      hanging 为超时后仍在执行的调用数, 调用返回后减一.
+    job 的 started_at, finished, cancelled 在 _lock 内读写: 工作线程开始执行和执行结束时,
+    与事件循环标记超时或取消不会交错.
+    没有 pywin32 时 (测试, 模拟的 PowerPoint) 不初始化 COM, 其余行为相同.
+    '''
+    def __init__(self, default_timeout=2.0, pump_interval=0.05, name="com-sta"):
+        self.default_timeout = default_timeout
+        self.pump_interval = pump_interval
+        self.name = name
+        self.calls = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.hung = 0
+        self.hanging = 0
+        self.late = 0
+        self.cancelled = 0
+        # 每个方法的调用耗时, 只在事件循环中修改和读取 (record_latency)
+        self.latency = {}
+        self._jobs = queue.Queue()
+        self._current = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._ready.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+        self._ready.wait(5)
+
+    def stop(self, timeout=5):
+        '''
+        停止工作线程, 排队中的调用被取消; 正在执行的调用完成后线程退出
+        '''
+        if self._thread is None:
+            return
+        self._jobs.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+    @property
+    def pending(self):
+        return self._jobs.qsize()
+
+    @property
+    def busy_seconds(self):
+        '''
+        当前调用已经执行的时间, 空闲时为 0
+        '''
+        job = self._current
+        if job is None or job.started_at is None:
+            return 0.0
+        return time.monotonic() - job.started_at
+
+    async def call(self, fn, *args, timeout=None):
+        '''
+        在工作线程中执行 fn(*args) 并返回结果, fn 抛出的异常原样抛出
+        timeout: 秒, None 使用 default_timeout, 0 表示不限时
+        '''
+        if self._thread is None:
+            self.start()
+        loop = asyncio.get_running_loop()
+        name = getattr(fn, "__qualname__", None) or repr(fn)
+        job = _ComJob(fn, args, name, loop.create_future(), loop)
+        self.calls += 1
+        self._jobs.put(job)
+        timeout = self.default_timeout if timeout is None else timeout
+        try:
+            if timeout:
+                return await asyncio.wait_for(asyncio.shield(job.future), timeout)
+            return await asyncio.shield(job.future)
+        except asyncio.TimeoutError:
+            with self._lock:
+                job.timed_out = True
+                job.cancelled = True
+                started = job.started_at is not None
+                finished = job.finished
+            self.timeouts += 1
+            if finished:
+                # 超时的同时刚好执行完, 结果已经在投递给事件循环的途中, 丢弃
+                self.late += 1
+                logger.warning("COM 调用 %s 在超时 (%.1fs) 时才返回, 结果已丢弃", name, timeout)
+            elif started:
+                job.hung = True
+                self.hung += 1
+                self.hanging += 1
+                logger.warning("COM 调用 %s 超过 %.1fs 没有返回", name, timeout)
+            else:
+                logger.warning("COM 调用 %s 排队超过 %.1fs, 工作线程被 %s 占用", name, timeout, self._current_name())
+            raise ComTimeoutError("COM call %s timed out after %.1fs" % (name, timeout)) from None
+        except asyncio.CancelledError:
+            # 调用方被取消, 还没有开始的调用不再执行
+            with self._lock:
+                job.cancelled = True
+            self.cancelled += 1
+            raise
+
+    def _current_name(self):
+        job = self._current
+        return job.name if job is not None else "-"
+
+    def record_latency(self, name, seconds):
+        '''
+        记录一次 COM 调用的耗时, 必须在事件循环线程中调用
+        工作线程和 PowerPoint 事件线程 (ComEventSlideSource) 的调用通过 call_soon_threadsafe 汇总到这里,
+        /metrics 在事件循环中读取时不会与写入交错
+        '''
+        histogram = self.latency.get(name)
+        if histogram is None:
+            histogram = self.latency[name] = LatencyHistogram(max_samples=512)
+        histogram.add(seconds)
+
+    def _execute(self, job):
+        # 检查并认领: 事件循环已经按排队超时处理的调用不再执行
+        with self._lock:
+            if job.cancelled:
+                return
+            job.started_at = time.monotonic()
+        self._current = job
+        result = error = None
+        try:
+            result = job.fn(*job.args)
+            self.completed += 1
+        except Exception as e:
+            error = e
+            self.failed += 1
+        finally:
+            self._current = None
+        with self._lock:
+            job.finished = True
+            cancelled = job.cancelled
+            timed_out = job.timed_out
+        seconds = time.monotonic() - job.started_at
+        try:
+            job.loop.call_soon_threadsafe(self.record_latency, job.name, seconds)
+        except RuntimeError:
+            pass
+        if cancelled:
+            # 调用方已超时或被取消, 丢弃结果
+            if timed_out:
+                logger.info("COM 调用 %s 在 %.2fs 后返回, 结果已丢弃", job.name, seconds)
+                # late 和 hanging 只在事件循环中修改, 回调在 call() 处理超时之后执行
+                try:
+                    job.loop.call_soon_threadsafe(self._hang_ended, job)
+                except RuntimeError:
+                    pass
+            return
+        try:
+            job.loop.call_soon_threadsafe(_resolve, job.future, result, error)
+        except RuntimeError:
+            # 事件循环已关闭
+            pass
+
+    def _hang_ended(self, job):
+        self.late += 1
+        if job.hung:
+            job.hung = False
+            self.hanging -= 1
+
+    def _run(self):
+        try:
+            import pythoncom
+        except ImportError:
+            pythoncom = None
+        if pythoncom is not None:
+            pythoncom.CoInitialize()
+        self._ready.set()
+        try:
+            while True:
+                try:
+                    job = self._jobs.get(timeout=self.pump_interval if pythoncom is not None else None)
+                except queue.Empty:
+                    job = False
+                if pythoncom is not None:
+                    # STA 线程需要处理窗口消息, 否则 PowerPoint 回调本进程时会卡住
+                    pythoncom.PumpWaitingMessages()
+                if job is None:
+                    break
+                if job is not False:
+                    self._execute(job)
+        finally:
+            while True:
+                try:
+                    job = self._jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    continue
+                with self._lock:
+                    if job.cancelled:
+                        continue
+                    job.cancelled = True
+                try:
+                    job.loop.call_soon_threadsafe(_resolve, job.future, None, RuntimeError("COM worker stopped"))
+                except RuntimeError:
+                    pass
+            if pythoncom is not None:
+                pythoncom.CoUninitialize()
+
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "hung": self.hung,
+            "hanging": self.hanging,
+            "late": self.late,
+            "cancelled": self.cancelled,
+            "pending": self.pending,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "current": self._current_name(),
+            "latency_ms": {name: histogram.summary() for name, histogram in self.latency.items()}
+        }
@@ -0,0 +1,329 @@
+import asyncio
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import struct
+import sys
+
+logger = logging.getLogger("monitor_service")
+
+# 配置项: 类型, 可选值 (None 表示不限), 默认值
+CONFIG_SCHEMA = {
+    "websocket_port": (int, None, 8765),
+    "server_host": (str, None, "localhost"),
+    "work_mode": (str, ("manual", "collaboration", "auto"), "manual"),
+    "avatar_command": (str, None, "play"),
+    "slide_source": (str, ("events", "polling"), "events"),
+    # 轮询间隔 (秒): 放映中, 编辑演示文稿, 没有演示程序或演示文稿
+    "poll_interval_show": (float, None, 0.25),
+    "poll_interval_edit": (float, None, 0.5),
+    "poll_interval_idle": (float, None, 2.0),
+    "preload_slides": (int, None, 2),
+    "latency_export_file": (str, None, "../log/latency.json"),
+    # 会话录制文件 (NDJSON, 可以使用 strftime 格式), 为空时不录制
+    "record_file": (str, None, ""),
+    "com_call_timeout": (float, None, 2.0),
+    "auto_slide_seconds": (float, None, 5.0),
+    "auto_loop": (bool, None, True),
+    "cue_messages": (bool, None, True),
+    "asset_server_port": (int, None, 8766),
+    "asset_public_host": (str, None, ""),
+    "asset_cache_max_age": (int, None, 3600),
+    "rooms": (list, None, [])
+}
+
+# rooms 中每个房间的配置项: 类型, 可选值; 没有配置的项使用顶层的同名配置
+# presentation 为该房间跟踪的演示文稿, 没有时跟随当前活动的演示文稿
+ROOM_SCHEMA = {
+    "name": (str, None),
+    "presentation": (str, None),
+    "work_mode": (str, CONFIG_SCHEMA["work_mode"][1]),
+    "avatar_command": (str, None),
+    "slide_source": (str, CONFIG_SCHEMA["slide_source"][1])
+}
+
+WORK_MODE_DESCRIPTIONS = {
+    "manual": "讲解员模式, 检测ppt状态，不自动播放",
+    "collaboration": "协作模式, 讲解员决定内容播放",
+    "auto": "自动模式, ppt 启动后自动播放"
+}
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def validate_rooms(rooms):
+    '''
+    校验 rooms 配置: 每个房间是一个对象, name 不能为空, 不能重复, 不能包含 / \\ ? #
+    '''
+    names = set()
+    for room in rooms:
+        if not isinstance(room, dict):
+            raise ConfigError("rooms 中的每一项必须是 JSON 对象: %r" % (room,))
+        for key, (value_type, choices) in ROOM_SCHEMA.items():
+            if key not in room:
+                continue
+            value = room[key]
+            if not isinstance(value, value_type):
+                raise ConfigError("房间配置项 %s 的类型应为 %s: %r" % (key, value_type.__name__, value))
+            if choices is not None and value not in choices:
+                raise ConfigError("房间配置项 %s 的取值应为 %s: %r" % (key, "/".join(choices), value))
+        name = room.get("name")
+        if not name or any(c in name for c in "/\\?#"):
+            raise ConfigError("房间名称无效: %r" % (name,))
+        if name in names:
+            raise ConfigError("房间名称重复: %r" % name)
+        names.add(name)
+
+
+def validate_config(data):
+    '''
+    按 CONFIG_SCHEMA 校验配置, 缺少的配置项使用默认值, 未知的配置项原样保留
+    不合法时抛出 ConfigError
+    '''
+    if not isinstance(data, dict):
+        raise ConfigError("配置文件必须是 JSON 对象")
+    config = dict(data)
+    for key, (value_type, choices, default) in CONFIG_SCHEMA.items():
+        if key not in config:
+            config[key] = default
+            continue
+        value = config[key]
+        if value_type is float and isinstance(value, int) and not isinstance(value, bool):
+            value = config[key] = float(value)
+        if not isinstance(value, value_type) or (isinstance(value, bool) and value_type is not bool):
+            raise ConfigError("配置项 %s 的类型应为 %s: %r" % (key, value_type.__name__, value))
+        if choices is not None and value not in choices:
+            if key == "work_mode":
+                logger.warning("未知模式: %s, 按讲解员模式处理", value)
+                config[key] = default
+            else:
+                raise ConfigError("配置项 %s 的取值应为 %s: %r" % (key, "/".join(choices), value))
+    if not 0 < config["websocket_port"] < 65536:
+        raise ConfigError("websocket_port 超出范围: %r" % config["websocket_port"])
+    if not 0 <= config["asset_server_port"] < 65536:
+        raise ConfigError("asset_server_port 超出范围: %r" % config["asset_server_port"])
+    validate_rooms(config["rooms"])
+    if config["preload_slides"] < 0:
+        raise ConfigError("preload_slides 不能为负数: %r" % config["preload_slides"])
+    if config["com_call_timeout"] <= 0:
+        raise ConfigError("com_call_timeout 必须大于 0: %r" % config["com_call_timeout"])
+    if config["auto_slide_seconds"] <= 0:
+        raise ConfigError("auto_slide_seconds 必须大于 0: %r" % config["auto_slide_seconds"])
+    for key in ("poll_interval_show", "poll_interval_edit", "poll_interval_idle"):
+        if config[key] <= 0:
+            raise ConfigError("%s 必须大于 0: %r" % (key, config[key]))
+    return config
+
+
+class ConfigChange():
+    '''
+    单个配置项的变化
+    '''
+    __slots__ = ("key", "old", "new")
+
+    def __init__(self, key, old, new):
+        self.key = key
+        self.old = old
+        self.new = new
+
+    def __repr__(self):
+        return "ConfigChange(%s: %r -> %r)" % (self.key, self.old, self.new)
+
+
+class _StatPoller():
+    '''
+    通用的后备方式: 后台任务按间隔比较文件的 (mtime, size)
+    '''
+    def __init__(self, path, notify, interval=0.5):
+        self.path = path
+        self.notify = notify
+        self.interval = interval
+        self._task = None
+
+    def _signature(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        last = self._signature()
+        while True:
+            await asyncio.sleep(self.interval)
+            current = self._signature()
+            if current != last:
+                last = current
+                self.notify()
+
+    def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+
+class _InotifyWatcher():
+    '''
+    Linux 下使用 inotify 监听配置文件所在的目录, 编辑器先写临时文件再重命名的方式也能检测到
+    '''
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    _EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, path, notify):
+        self.path = os.path.abspath(path)
+        self.notify = notify
+        self._name = os.fsencode(os.path.basename(self.path))
+        self._fd = None
+        self._loop = None
+
+    def start(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        if libc.inotify_add_watch(fd, os.fsencode(os.path.dirname(self.path)), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, "inotify_add_watch failed")
+        self._fd = fd
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(fd, self._on_readable)
+
+    def _on_readable(self):
+        matched = False
+        while True:
+            try:
+                data = os.read(self._fd, 4096)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset + self._EVENT_HEADER.size <= len(data):
+                _wd, _mask, _cookie, length = self._EVENT_HEADER.unpack_from(data, offset)
+                offset += self._EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                if name == self._name:
+                    matched = True
+        if matched:
+            self.notify()
+
+    def close(self):
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+
+
+def watch_file(path, notify, poll_interval=0.5):
+    '''
+    监听文件变化, 变化时调用 notify(); Linux 使用 inotify, 其他平台按间隔比较 (mtime, size)
+    返回已启动的监听对象, 调用 close() 停止
+    '''
+    if sys.platform.startswith("linux"):
+        try:
+            watcher = _InotifyWatcher(path, notify)
+            watcher.start()
+            return watcher
+        except (OSError, AttributeError) as e:
+            logger.warning("inotify 不可用, 使用轮询方式监听 %s: %s", path, e)
+    watcher = _StatPoller(path, notify, poll_interval)
+    watcher.start()
+    return watcher
+
+
+class Config():
+    '''
+    操作员编辑的配置, 保存在 config.json
+    watch() 之后由文件监听驱动重新加载: Linux 使用 inotify, 其他平台按间隔比较 (mtime, size).
+    文件变化后等待 debounce 秒再解析, 避免读到写了一半的文件; 解析或校验失败时保留原配置.
+    重新加载后逐个比较配置项, 只为发生变化的配置项通知 subscribe() 注册的回调.
+    '''
+    def __init__(self, config_file="config.json"):
+        self.config_file = config_file
+        if not os.path.exists(self.config_file):
+            raise FileNotFoundError(f"Configuration file '{self.config_file}' not found.")
+        self.config = self._load()
+        self.reload_count = 0
+        self.reload_errors = 0
+        self._listeners = {}
+        self._watcher = None
+        self._debounce = 0.2
+        self._pending = None
+        self._retries = 0
+        logger.info("Current Configuration: %s", self.config)
+        logger.info(WORK_MODE_DESCRIPTIONS[self.config["work_mode"]])
+
+    def _load(self):
+        with open(self.config_file, "r", encoding='utf-8') as f:
+            return validate_config(json.load(f))
+
+    def subscribe(self, key, callback):
+        '''
+        注册配置项变化的回调, callback(ConfigChange); key 为 "*" 时接收所有配置项的变化
+        '''
+        self._listeners.setdefault(key, []).append(callback)
+
+    def reload(self):
+        '''
+        重新读取配置文件, 返回发生变化的配置项列表
+        '''
+        new_config = self._load()
+        changes = [ConfigChange(key, self.config.get(key), new_config.get(key))
+                   for key in sorted(set(self.config) | set(new_config))
+                   if self.config.get(key) != new_config.get(key)]
+        self.config = new_config
+        self.reload_count += 1
+        for change in changes:
+            logger.info("配置项变化: %s", change)
+            if change.key == "work_mode":
+                logger.info(WORK_MODE_DESCRIPTIONS[change.new])
+            for callback in self._listeners.get(change.key, []) + self._listeners.get("*", []):
+                try:
+                    callback(change)
+                except Exception:
+                    logger.exception("处理配置变化失败: %s", change)
+        return changes
+
+    async def watch(self, debounce=0.2, poll_interval=0.5):
+        self._debounce = debounce
+        self._watcher = watch_file(self.config_file, self._schedule_reload, poll_interval)
+
+    def close(self):
+        if self._pending:
+            self._pending.cancel()
+            self._pending = None
+        if self._watcher:
+            self._watcher.close()
+            self._watcher = None
+
+    def _schedule_reload(self):
+        # 连续的写入只触发一次重新加载
+        if self._pending:
+            self._pending.cancel()
+        self._pending = asyncio.get_running_loop().call_later(self._debounce, self._debounced_reload)
+
+    def _debounced_reload(self):
+        self._pending = None
+        try:
+            self.reload()
+            self._retries = 0
+        except (ValueError, OSError) as e:
+            # 文件可能还没有写完, 稍后重试; 多次失败则保留原配置
+            self._retries += 1
+            if self._retries <= 3:
+                self._schedule_reload()
+            else:
+                self._retries = 0
+                self.reload_errors += 1
+                logger.warning("配置文件无效, 保留原配置: %s", e)
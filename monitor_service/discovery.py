@@ -0,0 +1,150 @@
+import logging
+import random
+import sys
+import time
+
+logger = logging.getLogger("monitor_service")
+
+# 每个 COM 程序对应的进程映像名 (小写)
+PROCESS_NAMES = {
+    "PowerPoint.Application": ("powerpnt.exe",),
+    "Kwpp.Application": ("wpp.exe", "wps.exe")
+}
+
+
+def running_process_names():
+    '''
+    当前运行的进程映像名 (小写) 集合, 只在 Windows 上可用, 其他平台或失败时返回 None
+    使用 CreateToolhelp32Snapshot 枚举进程, 不经过 COM 和 WMI, 耗时约 1ms
+    '''
+    if sys.platform != "win32":
+        return None
+    import ctypes
+    from ctypes import wintypes
+
+    class PROCESSENTRY32W(ctypes.Structure):
+        _fields_ = [("dwSize", wintypes.DWORD),
+                    ("cntUsage", wintypes.DWORD),
+                    ("th32ProcessID", wintypes.DWORD),
+                    ("th32DefaultHeapID", ctypes.c_size_t),
+                    ("th32ModuleID", wintypes.DWORD),
+                    ("cntThreads", wintypes.DWORD),
+                    ("th32ParentProcessID", wintypes.DWORD),
+                    ("pcPriClassBase", ctypes.c_long),
+                    ("dwFlags", wintypes.DWORD),
+                    ("szExeFile", ctypes.c_wchar * 260)]
+
+    TH32CS_SNAPPROCESS = 0x00000002
+    kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    kernel32.CreateToolhelp32Snapshot.restype = wintypes.HANDLE
+    kernel32.CreateToolhelp32Snapshot.argtypes = [wintypes.DWORD, wintypes.DWORD]
+    kernel32.Process32FirstW.argtypes = [wintypes.HANDLE, ctypes.POINTER(PROCESSENTRY32W)]
+    kernel32.Process32NextW.argtypes = [wintypes.HANDLE, ctypes.POINTER(PROCESSENTRY32W)]
+    kernel32.CloseHandle.argtypes = [wintypes.HANDLE]
+    snapshot = kernel32.CreateToolhelp32Snapshot(TH32CS_SNAPPROCESS, 0)
+    if snapshot is None or snapshot == ctypes.c_void_p(-1).value:
+        return None
+    names = set()
+    try:
+        entry = PROCESSENTRY32W()
+        entry.dwSize = ctypes.sizeof(PROCESSENTRY32W)
+        more = kernel32.Process32FirstW(snapshot, ctypes.byref(entry))
+        while more:
+            names.add(entry.szExeFile.lower())
+            more = kernel32.Process32NextW(snapshot, ctypes.byref(entry))
+    finally:
+        kernel32.CloseHandle(snapshot)
+    return names
+
+
+class AppDiscovery():
+    '''
+    查找正在运行的演示程序 (PowerPoint, WPS) 的策略
+    GetActiveObject 失败的代价是每个程序一次跨进程查找 (运行对象表), 没有程序运行时不应每次轮询都查找:
+      查找之前先检查程序的进程是否存在 (process_check), 没有进程的程序不查找;
+      查找失败后按指数退避推迟下一次查找 (min_delay 起每次翻倍, 最多 max_delay),
+      并加上 ±jitter 的随机抖动, 多个房间不会同时查找;
+      程序的进程刚出现时立即查找, 启动 PowerPoint 后不需要等待退避结束.
+    不能检查进程时 (非 Windows, 模拟的 PowerPoint) 只按退避推迟.
+    '''
+    def __init__(self, prog_ids, min_delay=0.5, max_delay=10.0, jitter=0.2, process_check=running_process_names):
+        self.prog_ids = list(prog_ids)
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.process_check = process_check
+        self.failures = 0
+        self.next_attempt = 0.0
+        # 查找次数, 退避期间跳过的次数, 进程不存在而跳过的次数
+        self.attempts = 0
+        self.deferred = 0
+        self.no_process = 0
+        self._running = None
+
+    def _running_prog_ids(self):
+        '''
+        进程存在的程序, 无法检查时返回 None
+        '''
+        if self.process_check is None:
+            return None
+        try:
+            names = self.process_check()
+        except Exception as e:
+            logger.debug("检查进程失败: %s", e)
+            return None
+        if names is None:
+            return None
+        return [prog_id for prog_id in self.prog_ids
+                if prog_id not in PROCESS_NAMES or any(name in names for name in PROCESS_NAMES[prog_id])]
+
+    def candidates(self, now=None):
+        '''
+        本次应该用 GetActiveObject 查找的程序, 退避期间或没有程序运行时返回空列表
+        返回非空列表时, 调用方随后调用 succeeded() 或 failed()
+        '''
+        now = time.monotonic() if now is None else now
+        running = self._running_prog_ids()
+        if running is not None:
+            if not running:
+                self.no_process += 1
+                self._running = running
+                return []
+            if running != self._running:
+                # 程序刚刚启动, 立即查找
+                self._running = running
+                self.failures = 0
+                self.next_attempt = 0.0
+        else:
+            running = self.prog_ids
+        if now < self.next_attempt:
+            self.deferred += 1
+            return []
+        self.attempts += 1
+        return running
+
+    def failed(self, now=None):
+        now = time.monotonic() if now is None else now
+        self.failures += 1
+        delay = min(self.max_delay, self.min_delay * 2 ** (self.failures - 1))
+        delay *= random.uniform(1.0 - self.jitter, 1.0 + self.jitter)
+        self.next_attempt = now + delay
+
+    def succeeded(self):
+        self.failures = 0
+        self.next_attempt = 0.0
+
+    def reset(self):
+        '''
+        立即重新查找, 例如程序刚刚退出 (可能马上重新启动)
+        '''
+        self.succeeded()
+        self._running = None
+
+    def as_dict(self):
+        return {
+            "attempts": self.attempts,
+            "deferred": self.deferred,
+            "no_process": self.no_process,
+            "failures": self.failures,
+            "next_attempt_in": round(max(0.0, self.next_attempt - time.monotonic()), 3)
+        }
@@ -0,0 +1,357 @@
+import random
+import threading
+import time
+
+from slide_source import SlideSource
+
+
+class FakeComError(Exception):
+    '''
+    对应 pywintypes.com_error, 例如没有在放映时访问 SlideShowWindow
+    '''
+    pass
+
+
+class _ComObject():
+    '''
+    每次属性访问和方法调用都计数, 并按 call_delay 休眠, 模拟跨进程 COM 调用的开销
+    '''
+    def __init__(self, app):
+        object.__setattr__(self, "_app", app)
+
+    def _call(self):
+        app = self._app
+        with app._lock:
+            app.com_calls += 1
+        if app.call_delay:
+            time.sleep(app.call_delay)
+        # 模拟模态对话框: 阻塞到对话框关闭
+        remaining = app.stalled_until - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+
+class _FakeSlide(_ComObject):
+    def __init__(self, app, presentation, index):
+        super().__init__(app)
+        self._presentation = presentation
+        self._index = index
+
+    @property
+    def SlideIndex(self):
+        self._call()
+        return self._index
+
+    def Select(self):
+        self._call()
+        self._presentation._edit_index = self._index
+        self._app._notify("WindowSelectionChange")
+
+
+class _FakeSlides(_ComObject):
+    def __init__(self, app, presentation):
+        super().__init__(app)
+        self._presentation = presentation
+
+    @property
+    def Count(self):
+        self._call()
+        return self._presentation.slides_count
+
+    def __call__(self, index):
+        self._call()
+        if not 1 <= index <= self._presentation.slides_count:
+            raise FakeComError("slide index out of range: %s" % index)
+        return _FakeSlide(self._app, self._presentation, index)
+
+
+class _FakeEditView(_ComObject):
+    def __init__(self, app, presentation):
+        super().__init__(app)
+        self._presentation = presentation
+
+    @property
+    def Slide(self):
+        self._call()
+        return _FakeSlide(self._app, self._presentation, self._presentation._edit_index)
+
+
+class _FakeWindow(_ComObject):
+    def __init__(self, app, presentation):
+        super().__init__(app)
+        self._presentation = presentation
+
+    @property
+    def View(self):
+        self._call()
+        return _FakeEditView(self._app, self._presentation)
+
+
+class _FakeSlideShowView(_ComObject):
+    '''
+    放映窗口的视图, 只属于创建时的那一次放映: 放映结束后重新开始放映, 原来的视图失效
+    '''
+    def __init__(self, app, presentation):
+        super().__init__(app)
+        self._presentation = presentation
+        self._show_id = presentation._show_id
+
+    def _check(self):
+        if self._presentation._show_index < 0 or self._presentation._show_id != self._show_id:
+            raise FakeComError("slide show has ended")
+
+    @property
+    def Slide(self):
+        self._call()
+        self._check()
+        return _FakeSlide(self._app, self._presentation, self._presentation._show_index)
+
+    def GotoSlide(self, index):
+        self._call()
+        self._check()
+        if 1 <= index <= self._presentation.slides_count:
+            self._presentation._show_index = index
+            self._app._notify("SlideShowNextSlide")
+
+    def Next(self):
+        self._call()
+        self._check()
+        if self._presentation._show_index < self._presentation.slides_count:
+            self._presentation._show_index += 1
+            self._app._notify("SlideShowNextSlide")
+        else:
+            self._presentation.end_show()
+
+    def Previous(self):
+        self._call()
+        self._check()
+        if self._presentation._show_index > 1:
+            self._presentation._show_index -= 1
+            self._app._notify("SlideShowNextSlide")
+
+
+class _FakeSlideShowWindow(_ComObject):
+    def __init__(self, app, presentation):
+        super().__init__(app)
+        self._presentation = presentation
+
+    @property
+    def View(self):
+        self._call()
+        return _FakeSlideShowView(self._app, self._presentation)
+
+
+class _FakeSlideShowSettings(_ComObject):
+    def __init__(self, app, presentation):
+        super().__init__(app)
+        self._presentation = presentation
+
+    def Run(self):
+        self._call()
+        self._presentation.start_show()
+
+
+class FakePresentation(_ComObject):
+    '''
+    模拟 Presentation 对象; slides_count 张幻灯片, 初始在编辑模式第 1 页
+    '''
+    def __init__(self, app, name, slides_count):
+        super().__init__(app)
+        self.name = name
+        self.slides_count = slides_count
+        self._edit_index = 1
+        self._show_index = -1
+        # 每次开始放映加一, 对应 PowerPoint 每次放映新建的 SlideShowWindow
+        self._show_id = 0
+
+    def __eq__(self, other):
+        return self is other
+
+    def __hash__(self):
+        return id(self)
+
+    @property
+    def Name(self):
+        self._call()
+        return self.name
+
+    @property
+    def Slides(self):
+        self._call()
+        return _FakeSlides(self._app, self)
+
+    def Windows(self, index):
+        self._call()
+        return _FakeWindow(self._app, self)
+
+    @property
+    def SlideShowWindow(self):
+        self._call()
+        if self._show_index < 0:
+            raise FakeComError("no slide show running")
+        return _FakeSlideShowWindow(self._app, self)
+
+    @property
+    def SlideShowSettings(self):
+        self._call()
+        return _FakeSlideShowSettings(self._app, self)
+
+    def start_show(self, slide_index=1):
+        self._show_id += 1
+        self._show_index = slide_index
+        self._app._notify("SlideShowBegin")
+
+    def end_show(self):
+        self._show_index = -1
+        self._app._notify("SlideShowEnd")
+
+
+class _FakePresentations(_ComObject):
+    @property
+    def Count(self):
+        self._call()
+        return len(self._app.presentations)
+
+    def __call__(self, index):
+        self._call()
+        return self._app.presentations[index - 1]
+
+
+class FakePowerPointApp(_ComObject):
+    '''
+    不依赖 Windows 的 PowerPoint.Application 模拟
+    实现监控服务用到的 Presentations, ActivePresentation, SlideShowWindow.View
+    (Slide.SlideIndex, GotoSlide, Next, Previous) 和 SlideShowSettings.Run.
+    com_calls 统计 COM 调用次数, call_delay 模拟每次调用的耗时;
+    stall(seconds) 模拟 PowerPoint 弹出模态对话框, 之后 seconds 秒内的调用都会阻塞;
+    on_event(name) 回调模拟应用事件 (SlideShowNextSlide 等).
+    '''
+    def __init__(self, call_delay=0.0):
+        object.__setattr__(self, "_lock", threading.Lock())
+        super().__init__(self)
+        object.__setattr__(self, "call_delay", call_delay)
+        object.__setattr__(self, "com_calls", 0)
+        object.__setattr__(self, "presentations", [])
+        object.__setattr__(self, "active", None)
+        object.__setattr__(self, "visible", 1)
+        object.__setattr__(self, "on_event", None)
+        object.__setattr__(self, "stalled_until", 0.0)
+
+    def __setattr__(self, name, value):
+        if name == "Visible":
+            self._call()
+            object.__setattr__(self, "visible", value)
+        else:
+            object.__setattr__(self, name, value)
+
+    def stall(self, seconds):
+        self.stalled_until = time.monotonic() + seconds
+
+    def _notify(self, name):
+        if self.on_event is not None:
+            self.on_event(name)
+
+    @property
+    def Visible(self):
+        self._call()
+        return self.visible
+
+    @property
+    def Presentations(self):
+        self._call()
+        return _FakePresentations(self)
+
+    @property
+    def ActivePresentation(self):
+        self._call()
+        if self.active is None:
+            raise FakeComError("no active presentation")
+        return self.active
+
+    def open(self, name, slides_count):
+        presentation = FakePresentation(self, name, slides_count)
+        self.presentations.append(presentation)
+        self.active = presentation
+        self._notify("PresentationOpen")
+        return presentation
+
+    def close(self, presentation=None):
+        presentation = presentation or self.active
+        self.presentations.remove(presentation)
+        self.active = self.presentations[-1] if self.presentations else None
+        self._notify("PresentationClose")
+
+
+def fake_get_active_object(app, prog_id="PowerPoint.Application"):
+    '''
+    返回替代 win32com.client.GetActiveObject 的函数, 只有 prog_id 能连接到 app
+    '''
+    def get_active_object(name):
+        if name == prog_id and app is not None:
+            return app
+        raise FakeComError("Operation unavailable: %s" % name)
+    return get_active_object
+
+
+def generate_slide_script(slides_count, changes, mean_interval=1.0, seed=None):
+    '''
+    生成翻页脚本, [(相对上一步的等待秒数, 动作, 参数)], 动作为 next, previous, goto
+    大多数是下一页, 偶尔回退或跳转
+    '''
+    rng = random.Random(seed)
+    script = []
+    for _ in range(changes):
+        delay = rng.expovariate(1.0 / mean_interval) if mean_interval > 0 else 0.0
+        r = rng.random()
+        if r < 0.8:
+            script.append((delay, "next", None))
+        elif r < 0.9:
+            script.append((delay, "previous", None))
+        else:
+            script.append((delay, "goto", rng.randint(1, slides_count)))
+    return script
+
+
+def apply_slide_action(presentation, action, argument=None):
+    '''
+    在放映中执行翻页脚本的一步, 到最后一页后从第一页重新开始
+    '''
+    view = presentation.SlideShowWindow.View
+    if action == "next":
+        if presentation._show_index >= presentation.slides_count:
+            view.GotoSlide(1)
+        else:
+            view.Next()
+    elif action == "previous":
+        if presentation._show_index <= 1:
+            view.GotoSlide(presentation.slides_count)
+        else:
+            view.Previous()
+    elif action == "goto":
+        view.GotoSlide(argument)
+
+
+class FakeComEventSlideSource(SlideSource):
+    '''
+    对应 ComEventSlideSource 的事件方式: 模拟应用触发事件后读取状态并投递到队列
+    不需要消息泵和事件线程, 事件在事件循环线程中处理
+    '''
+    def __init__(self, monitor, app, queue=None):
+        super().__init__(queue)
+        self.monitor = monitor
+        self.app = app
+
+    async def start(self):
+        await super().start()
+        self.status = dict(self.monitor.get_current_ppt_status())
+        self.app.on_event = self._on_event
+
+    async def stop(self):
+        self.app.on_event = None
+
+    def _on_event(self, name):
+        changed_at = time.monotonic()
+        self._loop.call_soon(self._read_status, name, changed_at)
+
+    def _read_status(self, name, changed_at):
+        self.publish(self.monitor.get_current_ppt_status(), "event:" + name, changed_at)
@@ -0,0 +1,262 @@
+'''
+离线检查 slide_video.json 并编译视频清单, 在演示之前运行:
+
+    cd monitor_service && python ingest.py
+    python ingest.py --workers 8 --pptx-dir D:/slides --json ../log/ingest.json
+
+在进程池中并行完成:
+  检查每个视频文件是否存在, 计算内容的 SHA-256, 读取 WebM 头部 (时长, 分辨率, 编码, 透明通道);
+  从 .pptx (zip) 的 ppt/presentation.xml 读取幻灯片数量, 检查每一页是否配置了视频.
+结果写入编译好的清单 (assets/slide_video.cache.json) 和视频信息索引 (assets/media_index.json),
+监控服务启动时直接加载, 不再逐个检查文件. 发现缺失或损坏的视频, 或配置超出幻灯片数量时返回 1.
+'''
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import time
+import zipfile
+
+from manifest import IDLE_KEY, SLIDE_KEY_PREFIX, SlideVideoManifest, VideoAsset
+from media_probe import MediaInfo, MediaProbeError, probe_webm
+
+logger = logging.getLogger("monitor_service")
+
+HASH_CHUNK_BYTES = 1024 * 1024
+SLIDE_ID_PATTERN = re.compile(rb"<p:sldId\b")
+SLIDE_FILE_PATTERN = re.compile(r"^ppt/slides/slide\d+\.xml$")
+
+
+def file_digest(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        buf = bytearray(HASH_CHUNK_BYTES)
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            sha256.update(view[:n])
+    return sha256.hexdigest()
+
+
+def ingest_file(path):
+    '''
+    在工作进程中检查一个视频文件, 返回可以跨进程传递的 dict
+    '''
+    result = {"path": path, "exists": False, "size": -1, "mtime_ns": None, "digest": None, "info": None}
+    try:
+        st = os.stat(path)
+    except OSError:
+        return result
+    result.update(exists=True, size=st.st_size, mtime_ns=st.st_mtime_ns)
+    try:
+        result["digest"] = file_digest(path)
+        info = probe_webm(path)
+    except (MediaProbeError, OSError) as e:
+        info = MediaInfo(error=str(e))
+    result["info"] = info.as_dict()
+    return result
+
+
+def count_pptx_slides(path):
+    '''
+    .pptx 文件中的幻灯片数量: presentation.xml 中 sldIdLst 的条目数, 没有时按 ppt/slides/slideN.xml 计数
+    文件不存在或不是 zip 时抛出 OSError / zipfile.BadZipFile
+    '''
+    with zipfile.ZipFile(path) as pptx:
+        try:
+            presentation = pptx.read("ppt/presentation.xml")
+        except KeyError:
+            presentation = b""
+        count = len(SLIDE_ID_PATTERN.findall(presentation))
+        if count == 0:
+            count = sum(1 for name in pptx.namelist() if SLIDE_FILE_PATTERN.match(name))
+        return count
+
+
+def _count_slides_job(path):
+    try:
+        return count_pptx_slides(path), None
+    except (OSError, zipfile.BadZipFile) as e:
+        return None, str(e)
+
+
+def find_pptx(name, search_dirs):
+    '''
+    在 search_dirs 中查找演示文稿, slide_video.json 中的名称可能带有路径
+    '''
+    candidates = [name.replace("\\", "/")]
+    basename = candidates[0].rsplit("/", 1)[-1]
+    for directory in search_dirs:
+        for candidate in (candidates[0], basename):
+            path = os.path.join(directory, candidate)
+            if os.path.isfile(path):
+                return path
+    return None
+
+
+def _run_jobs(executor, fn, items, workers):
+    if executor is None:
+        return list(map(fn, items))
+    chunksize = max(1, len(items) // (workers * 4))
+    return list(executor.map(fn, items, chunksize=chunksize))
+
+
+def check_coverage(item, deck, pptx_error):
+    '''
+    一个演示文稿的问题列表: 缺失或损坏的视频, 没有配置视频的幻灯片, 超出幻灯片数量的配置
+    返回 (errors, warnings)
+    '''
+    errors = []
+    warnings = []
+    files = [file for key, file in item["videos"].items() if key != IDLE_KEY]
+    # 同一演示文稿的视频通常放在同一目录, 缺失的文件不在该目录下时提示 (例如漏写了 videos/)
+    directories = collections.Counter(os.path.dirname(file.replace("\\", "/")) for file in files)
+    common_dir = directories.most_common(1)[0][0] if directories else ""
+    for asset in deck.assets():
+        if not asset.exists:
+            hint = ""
+            directory = os.path.dirname(asset.file.replace("\\", "/"))
+            if common_dir and directory != common_dir:
+                hint = ", 其他视频位于 %s/, 是否缺少目录前缀?" % common_dir
+            errors.append("视频不存在: %s%s" % (asset.file, hint))
+        elif asset.error is not None:
+            errors.append("视频无法解析: %s (%s)" % (asset.file, asset.error))
+        elif not asset.duration:
+            warnings.append("视频没有时长信息: %s" % asset.file)
+    if deck.idle is None:
+        warnings.append("没有配置 idle 视频")
+    for key in item["videos"]:
+        if key != IDLE_KEY and not (key.startswith(SLIDE_KEY_PREFIX) and key[len(SLIDE_KEY_PREFIX):].isdigit()):
+            warnings.append("无法识别的配置: %s" % key)
+    if deck.slides_count is None:
+        warnings.append("无法读取幻灯片数量: %s" % pptx_error)
+        return errors, warnings
+    configured = deck.configured_slides()
+    extra = [i for i in configured if i > deck.slides_count]
+    if extra:
+        errors.append("配置了不存在的幻灯片 %s (共 %s 页)" % (extra, deck.slides_count))
+    uncovered = [i for i in range(1, deck.slides_count + 1) if deck.slide(i) is None]
+    if uncovered:
+        warnings.append("幻灯片 %s 没有配置视频" % uncovered)
+    return errors, warnings
+
+
+def ingest(assets_base_dir="../assets", workers=None, pptx_dirs=()):
+    '''
+    检查并编译 slide_video.json, 返回 (manifest, report); 编译好的清单已保存
+    '''
+    manifest = SlideVideoManifest(assets_base_dir)
+    started = time.monotonic()
+    source_mtime_ns = os.stat(manifest.config_file).st_mtime_ns
+    with open(manifest.config_file, "r", encoding='utf-8') as f:
+        config = json.load(f)
+    items = [item for item in config.get("slide_videos", []) if "name" in item and "videos" in item]
+    files = sorted({file for item in items for file in item["videos"].values()})
+    paths = [os.path.join(assets_base_dir, file) for file in files]
+    search_dirs = list(pptx_dirs) + [assets_base_dir]
+    pptx_paths = {item["name"]: find_pptx(item["name"], search_dirs) for item in items}
+    pptx_jobs = sorted({path for path in pptx_paths.values() if path})
+
+    workers = workers or os.cpu_count() or 1
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        results = _run_jobs(executor, ingest_file, paths, workers)
+        counted = dict(zip(pptx_jobs, _run_jobs(executor, _count_slides_job, pptx_jobs, workers)))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    assets = {}
+    for file, result in zip(files, results):
+        if not result["exists"]:
+            assets[file] = VideoAsset(file, result["path"], False)
+            continue
+        info = MediaInfo.from_dict(result["info"])
+        assets[file] = VideoAsset(file, result["path"], True, result["size"], result["mtime_ns"], info.duration,
+                                  info.width, info.height, info.codec, bool(info.alpha), info.error, result["digest"])
+        manifest.media_index.put(result["path"], result["size"], result["mtime_ns"], info)
+    slides_counts = {}
+    pptx_errors = {}
+    for name, path in pptx_paths.items():
+        if path is None:
+            pptx_errors[name] = "没有找到 %s" % name
+            continue
+        count, error = counted[path]
+        if count is None:
+            pptx_errors[name] = error
+        else:
+            slides_counts[name] = count
+
+    manifest.decks = manifest.compile(config, assets, slides_counts)
+    manifest.source_mtime_ns = source_mtime_ns
+    manifest.save()
+
+    report = {"decks": [], "files": len(files), "bytes": sum(r["size"] for r in results if r["exists"]),
+              "workers": workers, "errors": 0, "warnings": 0}
+    by_digest = collections.defaultdict(list)
+    for file, asset in assets.items():
+        if asset.digest:
+            by_digest[asset.digest].append(file)
+    report["duplicates"] = [sorted(group) for group in by_digest.values() if len(group) > 1]
+    for item in items:
+        deck = manifest.find_deck(item["name"])
+        if deck is None or deck.name != item["name"]:
+            # 重复配置的演示文稿, compile 已经记录
+            continue
+        errors, warnings = check_coverage(item, deck, pptx_errors.get(item["name"]))
+        report["decks"].append({"name": deck.name, "slides_count": deck.slides_count,
+                                "videos": len(deck.configured_slides()), "runtime": round(deck.runtime(), 3),
+                                "errors": errors, "warnings": warnings})
+        report["errors"] += len(errors)
+        report["warnings"] += len(warnings)
+    report["seconds"] = round(time.monotonic() - started, 3)
+    return manifest, report
+
+
+def print_report(report):
+    for deck in report["decks"]:
+        status = "错误 %s 个" % len(deck["errors"]) if deck["errors"] else "正常"
+        print("%s: %s 页, %s 个视频, 总时长 %.1fs, %s" % (deck["name"], deck["slides_count"] if deck["slides_count"] is not None else "?",
+                                                     deck["videos"], deck["runtime"], status))
+        for error in deck["errors"]:
+            print("  [错误] %s" % error)
+        for warning in deck["warnings"]:
+            print("  [警告] %s" % warning)
+    for group in report["duplicates"]:
+        print("内容相同的视频: %s" % ", ".join(group))
+    print("检查 %s 个视频 (%.1f MB), %s 个进程, 耗时 %.2fs; 错误 %s 个, 警告 %s 个" % (
+        report["files"], report["bytes"] / 1e6, report["workers"], report["seconds"], report["errors"], report["warnings"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="检查 slide_video.json 并编译视频清单")
+    parser.add_argument("--assets", default="../assets", help="资源目录 (相对 monitor_service)")
+    parser.add_argument("--workers", type=int, default=None, help="进程数, 默认为 CPU 核数, 1 表示不使用进程池")
+    parser.add_argument("--pptx-dir", action="append", default=[], help="查找 .pptx 文件的目录, 可以指定多次")
+    parser.add_argument("--json", help="检查结果另存为 JSON 文件")
+    parser.add_argument("--verbose", action="store_true", help="输出 monitor_service 日志")
+    args = parser.parse_args(argv)
+
+    # 命令行中的相对路径相对当前目录, 清单中的路径相对 monitor_service
+    pptx_dirs = [os.path.abspath(d) for d in args.pptx_dir]
+    json_file = os.path.abspath(args.json) if args.json else None
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL, format="%(message)s")
+
+    _manifest, report = ingest(args.assets, args.workers, pptx_dirs)
+    print_report(report)
+    if json_file:
+        with open(json_file, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 1 if report["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,216 @@
+import atexit
+import copy
+import datetime
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# 日志写到项目根目录的 log/monitor.log, 与启动时的工作目录无关
+LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "log")
+LOG_FILE = os.path.join(LOG_DIR, "monitor.log")
+
+# 等待写入的日志条数上限, 队列满时丢弃新的日志, 不阻塞事件循环
+QUEUE_SIZE = 10000
+# 单条日志消息的最大字符数, 超出部分截断 (播放列表, 视频表等完整消息)
+MAX_MESSAGE_CHARS = 2000
+# 同一位置的 INFO/DEBUG 日志每秒最多 RATE_PER_SECOND 条, 允许短时间内突发 RATE_BURST 条
+RATE_PER_SECOND = 5.0
+RATE_BURST = 20
+
+# LogRecord 的标准属性, 其余属性 (extra) 写入 JSON
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "suppressed"}
+
+_listener = None
+_queue_handler = None
+
+
+class preview():
+    '''
+    日志参数中的长消息, 格式化时只保留前 limit 个字符
+    logger.info("Broadcasting: %s", preview(message)), 字符串直接截取, 不序列化整个对象
+    '''
+    __slots__ = ("value", "limit")
+
+    def __init__(self, value, limit=200):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        text = self.value if isinstance(self.value, str) else repr(self.value)
+        return truncate(text, self.limit)
+
+
+def truncate(text, limit=MAX_MESSAGE_CHARS):
+    if len(text) <= limit:
+        return text
+    return "%s...(共 %s 字符)" % (text[:limit], len(text))
+
+
+class RateLimitFilter(logging.Filter):
+    '''
+    按调用位置 (模块, 行号) 限制 INFO/DEBUG 日志的频率 (令牌桶), WARNING 及以上不限制
+    被丢弃的条数记在该位置下一条通过的日志的 suppressed 属性中
+    事件循环, COM 线程和事件线程都会记录日志, 令牌桶的读取和更新在锁内进行
+    '''
+    def __init__(self, rate=RATE_PER_SECOND, burst=RATE_BURST):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.suppressed = 0
+        # (模块, 行号) -> [令牌数, 上次补充时间, 丢弃条数]
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            now = time.monotonic()
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(self.burst), now, 0]
+            else:
+                bucket[0] = min(float(self.burst), bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] < 1.0:
+                bucket[2] += 1
+                self.suppressed += 1
+                return False
+            bucket[0] -= 1.0
+            if bucket[2]:
+                record.suppressed = bucket[2]
+                bucket[2] = 0
+            return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    '''
+    在调用线程 (事件循环, COM 线程) 中只格式化消息文本并放入队列, 写文件和控制台由 QueueListener 的线程完成
+    队列满时丢弃并计数, 不等待
+    '''
+    def __init__(self, log_queue, max_chars=MAX_MESSAGE_CHARS):
+        super().__init__(log_queue)
+        self.max_chars = max_chars
+        self.dropped = 0
+
+    def prepare(self, record):
+        # 参数可能是之后会被修改的对象 (状态 dict), 在这里生成消息文本
+        record = copy.copy(record)
+        message = truncate(record.getMessage(), self.max_chars)
+        record.message = message
+        record.msg = message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class TextFormatter(logging.Formatter):
+    '''
+    控制台使用的文本格式, 带有被限流丢弃的条数
+    '''
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            text += " (此前省略 %s 条)" % suppressed
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    每条日志一行 JSON: ts, level, logger, thread, module, line, msg, 以及 extra 中的字段 (如 room, trace)
+    '''
+    def format(self, record):
+        data = {
+            "ts": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "module": record.module,
+            "line": record.lineno,
+            "msg": record.getMessage()
+        }
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            data["suppressed"] = suppressed
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                data[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def setup_logging(log_file=LOG_FILE, level=logging.DEBUG, console=True):
+    '''
+    配置 monitor_service 日志: 滚动文件 (JSON 行) 和控制台 (文本)
+    记录日志的线程只把消息放入队列, 由后台线程写入, 磁盘和控制台 I/O 不影响翻页处理.
+    只在程序入口调用, 导入模块时不创建目录和文件
+    '''
+    global _listener, _queue_handler
+    logger = logging.getLogger("monitor_service")
+    logger.setLevel(level)
+    if _queue_handler is None:
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        handlers = []
+        fh = RotatingFileHandler(log_file, maxBytes=5 * 1024 * 1024, backupCount=3, encoding='utf-8')
+        fh.setFormatter(JsonFormatter())
+        handlers.append(fh)
+        if console:
+            ch = logging.StreamHandler()
+            ch.setFormatter(TextFormatter('%(asctime)s %(levelname)s [%(name)s] %(message)s'))
+            handlers.append(ch)
+        log_queue = queue.Queue(QUEUE_SIZE)
+        _queue_handler = NonBlockingQueueHandler(log_queue)
+        _queue_handler.addFilter(RateLimitFilter())
+        _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        logger.addHandler(_queue_handler)
+        # 日志只由 monitor_service 的处理器输出, 不再传给 root logger
+        logger.propagate = False
+        atexit.register(stop_logging)
+    return logger
+
+
+def stop_logging():
+    '''
+    写完队列中剩余的日志并停止后台线程
+    '''
+    global _listener, _queue_handler
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    logging.getLogger("monitor_service").removeHandler(_queue_handler)
+    _listener = None
+    _queue_handler = None
+
+
+def log_stats():
+    '''
+    日志队列的状态, 用于状态查询
+    '''
+    if _queue_handler is None:
+        return None
+    rate_limit = _queue_handler.filters[0]
+    return {
+        "queued": _queue_handler.queue.qsize(),
+        "dropped": _queue_handler.dropped,
+        "suppressed": rate_limit.suppressed
+    }
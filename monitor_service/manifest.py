@@ -0,0 +1,358 @@
+import asyncio
+import json
+import logging
+import os
+import unicodedata
+
+from config import watch_file
+from media_probe import MediaIndex
+
+logger = logging.getLogger("monitor_service")
+
+MANIFEST_CACHE_VERSION = 3
+SLIDE_KEY_PREFIX = "slide-"
+IDLE_KEY = "idle"
+
+
+def normalize_deck_name(name):
+    '''
+    演示文稿名称归一化: 去掉路径, 统一 Unicode 形式和大小写
+    slide_video.json 中的 name 可能带有路径前缀, PowerPoint 返回的 Name 只有文件名
+    '''
+    name = name.replace("\\", "/").rsplit("/", 1)[-1]
+    return unicodedata.normalize("NFC", name).strip().casefold()
+
+
+class VideoAsset():
+    '''
+    一个视频文件的信息, 编译清单时记录一次
+    file: slide_video.json 中的相对路径
+    path: 供播放器使用的路径 (相对 monitor_service)
+    duration, width, height, codec, alpha: 从 WebM 头部读取, 见 media_probe
+    error: 文件存在但无法解析时的原因
+    digest: 文件内容的 SHA-256, 只有 ingest.py 编译的清单中有
+    '''
+    __slots__ = ("file", "path", "exists", "size", "mtime_ns", "duration", "width", "height", "codec", "alpha", "error",
+                 "digest")
+
+    def __init__(self, file, path, exists=False, size=-1, mtime_ns=None, duration=None,
+                 width=None, height=None, codec=None, alpha=False, error=None, digest=None):
+        self.file = file
+        self.path = path
+        self.exists = exists
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.duration = duration
+        self.width = width
+        self.height = height
+        self.codec = codec
+        self.alpha = alpha
+        self.error = error
+        self.digest = digest
+
+    @property
+    def playable(self):
+        return self.exists and self.error is None
+
+    def as_dict(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**{slot: d.get(slot) for slot in cls.__slots__})
+
+
+class DeckEntry():
+    '''
+    一个演示文稿的视频配置
+    slides 按幻灯片编号索引, slides[0] 不使用, 没有配置的编号为 None
+    slides_count: .pptx 文件中的幻灯片数量, 只有 ingest.py 编译的清单中有
+    '''
+    __slots__ = ("name", "idle", "slides", "slides_count")
+
+    def __init__(self, name, idle=None, slides=None, slides_count=None):
+        self.name = name
+        self.idle = idle
+        self.slides = slides if slides is not None else [None]
+        self.slides_count = slides_count
+
+    def slide(self, slide_index):
+        if 0 < slide_index < len(self.slides):
+            return self.slides[slide_index]
+        return None
+
+    def configured_slides(self):
+        return [i for i, asset in enumerate(self.slides) if asset is not None]
+
+    def runtime(self):
+        '''
+        所有幻灯片视频的总时长 (秒), 不包括 idle 视频和时长未知的视频
+        '''
+        return sum(asset.duration for asset in self.slides if asset is not None and asset.duration)
+
+    def unplayable(self):
+        '''
+        缺失或损坏的视频
+        '''
+        return [asset for asset in self.assets() if not asset.playable]
+
+    def assets(self):
+        if self.idle is not None:
+            yield self.idle
+        for asset in self.slides:
+            if asset is not None:
+                yield asset
+
+    def as_dict(self):
+        return {"name": self.name,
+                "idle": self.idle.as_dict() if self.idle else None,
+                "slides": [a.as_dict() if a else None for a in self.slides],
+                "slides_count": self.slides_count}
+
+    @classmethod
+    def from_dict(cls, d):
+        idle = VideoAsset.from_dict(d["idle"]) if d["idle"] else None
+        return cls(d["name"], idle, [VideoAsset.from_dict(a) if a else None for a in d["slides"]], d.get("slides_count"))
+
+
+class SlideVideoManifest():
+    '''
+    slide_video.json 的编译索引
+    演示文稿按归一化名称建立字典, 每个演示文稿的视频按幻灯片编号存放在列表中,
+    文件是否存在, 大小和时长等信息在编译时记录一次, 并以 slide_video.json 的 mtime 为键缓存到磁盘;
+    视频文件的大小或 mtime 变化时重新编译. 切换演示文稿只需要一次字典查找, 不访问文件系统.
+    '''
+    def __init__(self, assets_base_dir="../assets", config_name="slide_video.json", cache_name="slide_video.cache.json",
+                 media_index_name="media_index.json"):
+        self.assets_base_dir = assets_base_dir
+        self.config_file = os.path.join(assets_base_dir, config_name)
+        self.cache_file = os.path.join(assets_base_dir, cache_name)
+        # 视频头部信息按 (路径, 大小, mtime) 缓存, 重新编译时只需要 stat
+        self.media_index = MediaIndex(os.path.join(assets_base_dir, media_index_name))
+        self.decks = {}
+        self.source_mtime_ns = None
+        # 每次重新加载加一, 持有 DeckEntry 的对象据此判断是否需要重新查找
+        self.generation = 0
+        self._watcher = None
+        self._pending = None
+        # 正在线程池中编译的 Future, 以及编译期间 slide_video.json 是否又有变化
+        self._building = None
+        self._rebuild = False
+
+    def find_deck(self, presentation_name):
+        '''
+        按归一化的文件名查找; 找不到时与之前相同, 使用配置的 name 以演示文稿名称结尾的第一个演示文稿
+        '''
+        if not presentation_name:
+            return None
+        key = normalize_deck_name(presentation_name)
+        deck = self.decks.get(key)
+        if deck is not None:
+            return deck
+        for deck in self.decks.values():
+            if unicodedata.normalize("NFC", deck.name).strip().casefold().endswith(key):
+                logger.info("演示文稿 %s 按名称后缀匹配到配置 %s", presentation_name, deck.name)
+                return deck
+        return None
+
+    def load(self):
+        '''
+        加载清单, slide_video.json 未变化时使用磁盘缓存, 否则重新编译
+        返回是否加载成功
+        '''
+        return self._apply(self._build())
+
+    def _build(self):
+        '''
+        读取缓存或重新编译 (检查视频文件, 解析 WebM 头部, 保存缓存), 返回 (是否成功, decks, slide_video.json 的 mtime);
+        decks 为 None 时保留当前的清单. 不修改当前的清单, 可以在线程中执行
+        '''
+        try:
+            mtime_ns = os.stat(self.config_file).st_mtime_ns
+        except OSError as e:
+            # 编辑时文件可能暂时不存在 (保存时先删除或改名), 与解析失败相同, 保留当前的清单
+            logger.warning("处理 slide_video.json 失败: %s, 当前文件夹: %s", e, os.getcwd())
+            return False, None, None
+        decks = self._load_cache(mtime_ns)
+        if decks is not None:
+            return True, decks, mtime_ns
+        try:
+            with open(self.config_file, "r", encoding='utf-8') as f:
+                slide_video_config = json.load(f)
+        except Exception as e:
+            logger.warning("处理 slide_video.json 失败: %s, 当前文件夹: %s", e, os.getcwd())
+            return False, None, None
+        decks = self.compile(slide_video_config)
+        self._save(decks, mtime_ns)
+        return True, decks, mtime_ns
+
+    def _apply(self, result):
+        '''
+        换上 _build() 的结果, 在事件循环中执行
+        '''
+        ok, decks, mtime_ns = result
+        if decks is not None:
+            self.decks = decks
+        if ok:
+            self.source_mtime_ns = mtime_ns
+            self.generation += 1
+        return ok
+
+    def compile(self, slide_video_config, assets=None, slides_counts=None):
+        '''
+        assets: {slide_video.json 中的路径: VideoAsset}, 已经检查过的视频 (ingest.py 在进程池中检查), 其余的在这里检查
+        slides_counts: {演示文稿名称: 幻灯片数量}
+        '''
+        decks = {}
+        # 多个演示文稿共用同一个视频 (如 idle) 时只检查一次
+        assets = dict(assets) if assets else {}
+        slides_counts = slides_counts or {}
+
+        def make_asset(file):
+            if file not in assets:
+                path = os.path.join(self.assets_base_dir, file)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    logger.error("Video file %s does not exist", path)
+                    assets[file] = VideoAsset(file, path, False)
+                    return assets[file]
+                info = self.media_index.probe(path, st)
+                assets[file] = VideoAsset(file, path, True, st.st_size, st.st_mtime_ns, info.duration,
+                                          info.width, info.height, info.codec, bool(info.alpha), info.error)
+            return assets[file]
+
+        for item in slide_video_config.get("slide_videos", []):
+            if "name" not in item or "videos" not in item:
+                continue
+            deck = DeckEntry(item["name"], slides_count=slides_counts.get(item["name"]))
+            for key, file in item["videos"].items():
+                if key == IDLE_KEY:
+                    deck.idle = make_asset(file)
+                elif key.startswith(SLIDE_KEY_PREFIX) and key[len(SLIDE_KEY_PREFIX):].isdigit():
+                    slide_index = int(key[len(SLIDE_KEY_PREFIX):])
+                    if slide_index < 1:
+                        continue
+                    if slide_index >= len(deck.slides):
+                        deck.slides.extend([None] * (slide_index + 1 - len(deck.slides)))
+                    deck.slides[slide_index] = make_asset(file)
+                else:
+                    logger.warning("演示文稿 %s 的视频配置 %s 无法识别", item["name"], key)
+            normalized = normalize_deck_name(item["name"])
+            if normalized in decks:
+                logger.warning("演示文稿 %s 重复配置, 使用第一个配置", item["name"])
+                continue
+            decks[normalized] = deck
+            unplayable = deck.unplayable()
+            logger.info("演示文稿 %s: %s 个视频, 总时长 %.1fs%s", item["name"], len(deck.configured_slides()), deck.runtime(),
+                        ", %s 个视频缺失或损坏" % len(unplayable) if unplayable else "")
+        self.media_index.save()
+        logger.info("已编译 %s 个演示文稿, %s 个视频文件 (解析 %s 个)", len(decks), len(assets), self.media_index.probed)
+        return decks
+
+    def _assets_changed(self, decks):
+        '''
+        缓存中的视频文件是否有变化 (新增, 删除, 重新生成)
+        '''
+        checked = set()
+        for deck in decks.values():
+            for asset in deck.assets():
+                if asset.path in checked:
+                    continue
+                checked.add(asset.path)
+                try:
+                    st = os.stat(asset.path)
+                except OSError:
+                    if asset.exists:
+                        return True
+                    continue
+                if not asset.exists or st.st_size != asset.size or st.st_mtime_ns != asset.mtime_ns:
+                    return True
+        return False
+
+    def _load_cache(self, mtime_ns):
+        '''
+        缓存有效时返回缓存中的 decks, 否则返回 None
+        '''
+        try:
+            with open(self.cache_file, "r", encoding='utf-8') as f:
+                cache = json.load(f)
+            if (cache.get("version") != MANIFEST_CACHE_VERSION or cache.get("source_mtime_ns") != mtime_ns
+                    or cache.get("assets_base_dir") != self.assets_base_dir):
+                return None
+            decks = {key: DeckEntry.from_dict(d) for key, d in cache["decks"].items()}
+            if self._assets_changed(decks):
+                logger.info("视频文件已变化, 重新编译视频清单")
+                return None
+            logger.info("使用缓存的视频清单: %s 个演示文稿", len(decks))
+            return decks
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning("视频清单缓存无效: %s", e)
+            return None
+
+    def save(self):
+        '''
+        保存编译好的清单, 下次启动时 slide_video.json 和视频文件没有变化则直接加载
+        '''
+        self._save(self.decks, self.source_mtime_ns)
+
+    def _save(self, decks, source_mtime_ns):
+        cache = {
+            "version": MANIFEST_CACHE_VERSION,
+            "source_mtime_ns": source_mtime_ns,
+            "assets_base_dir": self.assets_base_dir,
+            "decks": {key: deck.as_dict() for key, deck in decks.items()}
+        }
+        try:
+            tmp_file = self.cache_file + ".tmp"
+            with open(tmp_file, "w", encoding='utf-8') as f:
+                json.dump(cache, f, ensure_ascii=False)
+            os.replace(tmp_file, self.cache_file)
+        except OSError as e:
+            logger.warning("保存视频清单缓存失败: %s", e)
+
+    def watch(self, debounce=0.2):
+        '''
+        slide_video.json 变化时在线程池中重新编译, 完成后在事件循环中换上新的清单, 需要在事件循环中调用
+        编译期间 (检查视频文件, 解析 WebM 头部) 房间继续使用原来的清单; 编译期间又有变化时, 完成后再编译一次
+        '''
+        def schedule():
+            if self._pending:
+                self._pending.cancel()
+            self._pending = asyncio.get_running_loop().call_later(debounce, reload)
+
+        def reload():
+            self._pending = None
+            if self._building is not None:
+                self._rebuild = True
+                return
+            logger.info("slide_video.json 已更新, 重新编译视频清单")
+            self._building = asyncio.get_running_loop().run_in_executor(None, self._build)
+            self._building.add_done_callback(built)
+
+        def built(future):
+            self._building = None
+            if future.cancelled():
+                return
+            try:
+                self._apply(future.result())
+            except Exception as e:
+                logger.error("重新编译视频清单失败: %s", e)
+            if self._rebuild:
+                self._rebuild = False
+                reload()
+
+        self._watcher = watch_file(self.config_file, schedule)
+
+    def close(self):
+        if self._pending:
+            self._pending.cancel()
+            self._pending = None
+        if self._building is not None:
+            self._building.cancel()
+            self._building = None
+        if self._watcher:
+            self._watcher.close()
+            self._watcher = None
@@ -0,0 +1,401 @@
+'''
+WebM/Matroska 头部解析: 只读取 EBML 头, Segment 的 Info 和 Tracks, 不解码视频
+    时长     Info/Duration, 没有时 (浏览器 MediaRecorder 录制的文件) 从文件尾部最后一个 Cluster 估算
+    分辨率   Tracks/TrackEntry/Video/PixelWidth, PixelHeight
+    编码     Tracks/TrackEntry/CodecID
+    透明通道 Tracks/TrackEntry/Video/AlphaMode
+'''
+
+import json
+import logging
+import os
+import struct
+
+logger = logging.getLogger("monitor_service")
+
+MEDIA_INDEX_VERSION = 1
+
+# 元素 ID (含长度标记位)
+EBML = 0x1A45DFA3
+DOC_TYPE = 0x4282
+SEGMENT = 0x18538067
+SEEK_HEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEK_ID = 0x53AB
+SEEK_POSITION = 0x53AC
+INFO = 0x1549A966
+TIMECODE_SCALE = 0x2AD7B1
+DURATION = 0x4489
+TRACKS = 0x1654AE6B
+TRACK_ENTRY = 0xAE
+TRACK_TYPE = 0x83
+CODEC_ID = 0x86
+DEFAULT_DURATION = 0x23E383
+VIDEO = 0xE0
+PIXEL_WIDTH = 0xB0
+PIXEL_HEIGHT = 0xBA
+ALPHA_MODE = 0x53C0
+CLUSTER = 0x1F43B675
+CLUSTER_TIMECODE = 0xE7
+SIMPLE_BLOCK = 0xA3
+BLOCK_GROUP = 0xA0
+BLOCK = 0xA1
+
+TRACK_TYPE_VIDEO = 1
+TRACK_TYPE_AUDIO = 2
+
+# 单个元素 (Info, Tracks, SeekHead) 最多读取的字节数
+MAX_ELEMENT_BYTES = 1024 * 1024
+# 估算时长时读取的文件尾部字节数
+TAIL_SCAN_BYTES = 512 * 1024
+# 在 Segment 中最多跳过的子元素个数
+MAX_SEGMENT_CHILDREN = 256
+
+
+class MediaProbeError(ValueError):
+    pass
+
+
+class MediaInfo():
+    '''
+    一个视频文件的头部信息
+    duration: 秒, 未知为 None
+    error: 文件无法解析时的原因, 正常为 None
+    '''
+    __slots__ = ("doc_type", "duration", "width", "height", "codec", "audio_codec", "alpha", "error")
+
+    def __init__(self, doc_type=None, duration=None, width=None, height=None, codec=None,
+                 audio_codec=None, alpha=False, error=None):
+        self.doc_type = doc_type
+        self.duration = duration
+        self.width = width
+        self.height = height
+        self.codec = codec
+        self.audio_codec = audio_codec
+        self.alpha = alpha
+        self.error = error
+
+    def as_dict(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**{slot: d.get(slot) for slot in cls.__slots__})
+
+    def __repr__(self):
+        return "MediaInfo(%s)" % ", ".join("%s=%r" % (slot, getattr(self, slot)) for slot in self.__slots__)
+
+
+def _read_vint(buf, pos, keep_marker):
+    '''
+    读取 EBML 变长整数, 返回 (值, 新位置, 是否为未知长度)
+    keep_marker: 元素 ID 保留长度标记位
+    '''
+    if pos >= len(buf):
+        raise MediaProbeError("truncated element")
+    first = buf[pos]
+    if first == 0:
+        raise MediaProbeError("invalid vint at %d" % pos)
+    length = 9 - first.bit_length()
+    if pos + length > len(buf):
+        raise MediaProbeError("truncated element")
+    value = first if keep_marker else first & (0xFF >> length)
+    for b in buf[pos + 1:pos + length]:
+        value = (value << 8) | b
+    unknown = not keep_marker and value == (1 << (7 * length)) - 1
+    return value, pos + length, unknown
+
+
+def _read_header(buf, pos):
+    '''
+    读取元素头, 返回 (ID, 数据开始位置, 数据长度), 未知长度为 None
+    '''
+    element_id, pos, _ = _read_vint(buf, pos, True)
+    size, pos, unknown = _read_vint(buf, pos, False)
+    return element_id, pos, None if unknown else size
+
+
+def _children(buf, start=0, end=None):
+    '''
+    遍历 buf[start:end] 中的子元素, 产生 (ID, 数据), 数据被截断时到 buf 结尾为止
+    '''
+    end = len(buf) if end is None else min(end, len(buf))
+    pos = start
+    while pos < end:
+        element_id, data_start, size = _read_header(buf, pos)
+        data_end = end if size is None else data_start + size
+        yield element_id, buf[data_start:min(data_end, end)]
+        pos = data_end
+
+
+def _uint(data):
+    return int.from_bytes(data, "big") if data else 0
+
+
+def _float(data):
+    if len(data) == 4:
+        return struct.unpack(">f", data)[0]
+    if len(data) == 8:
+        return struct.unpack(">d", data)[0]
+    if not data:
+        return 0.0
+    raise MediaProbeError("invalid float size %d" % len(data))
+
+
+def _string(data):
+    return data.rstrip(b"\0").decode("utf-8", "replace")
+
+
+class _BoundedReader():
+    '''
+    只按需读取文件的指定区间, 统计读取的字节数
+    '''
+    def __init__(self, f, size):
+        self.f = f
+        self.size = size
+        self.bytes_read = 0
+
+    def read(self, offset, length):
+        length = max(0, min(length, self.size - offset))
+        self.f.seek(offset)
+        data = self.f.read(length)
+        self.bytes_read += len(data)
+        return data
+
+    def header(self, offset):
+        '''
+        读取 offset 处的元素头, 返回 (ID, 数据在文件中的开始位置, 数据长度)
+        '''
+        element_id, data_start, size = _read_header(self.read(offset, 12), 0)
+        return element_id, offset + data_start, size
+
+
+def _parse_info(data, info, state):
+    duration = None
+    for element_id, value in _children(data):
+        if element_id == TIMECODE_SCALE:
+            state["timecode_scale"] = _uint(value)
+        elif element_id == DURATION:
+            duration = _float(value)
+    if duration:
+        info.duration = duration * state["timecode_scale"] / 1e9
+
+
+def _parse_tracks(data, info, state):
+    for element_id, entry in _children(data):
+        if element_id != TRACK_ENTRY:
+            continue
+        track_type = codec = default_duration = None
+        video = None
+        for child_id, value in _children(entry):
+            if child_id == TRACK_TYPE:
+                track_type = _uint(value)
+            elif child_id == CODEC_ID:
+                codec = _string(value)
+            elif child_id == DEFAULT_DURATION:
+                default_duration = _uint(value)
+            elif child_id == VIDEO:
+                video = value
+        if track_type == TRACK_TYPE_VIDEO and info.codec is None:
+            info.codec = codec
+            if default_duration:
+                state["frame_duration"] = default_duration / 1e9
+            if video is not None:
+                for child_id, value in _children(video):
+                    if child_id == PIXEL_WIDTH:
+                        info.width = _uint(value)
+                    elif child_id == PIXEL_HEIGHT:
+                        info.height = _uint(value)
+                    elif child_id == ALPHA_MODE:
+                        info.alpha = _uint(value) == 1
+        elif track_type == TRACK_TYPE_AUDIO and info.audio_codec is None:
+            info.audio_codec = codec
+    state["tracks"] = True
+
+
+def _parse_seek_head(data):
+    positions = {}
+    for element_id, seek in _children(data):
+        if element_id != SEEK:
+            continue
+        seek_id = position = None
+        for child_id, value in _children(seek):
+            if child_id == SEEK_ID:
+                seek_id = _uint(value)
+            elif child_id == SEEK_POSITION:
+                position = _uint(value)
+        if seek_id is not None and position is not None:
+            positions[seek_id] = position
+    return positions
+
+
+def _block_timecode(data):
+    # Block 数据: 轨道号 (vint), 相对 Cluster 的时间码 (int16), 标志
+    _track, pos, _ = _read_vint(data, 0, False)
+    if pos + 2 > len(data):
+        raise MediaProbeError("truncated block")
+    return struct.unpack(">h", data[pos:pos + 2])[0]
+
+
+def _last_block_time(tail):
+    '''
+    在文件尾部查找最后一个 Cluster, 返回其中最晚的 Block 时间码 (timecode_scale 单位)
+    Cluster 的 ID 也可能出现在帧数据中, 要求第一个子元素是 Timecode
+    '''
+    marker = CLUSTER.to_bytes(4, "big")
+    pos = len(tail)
+    while True:
+        pos = tail.rfind(marker, 0, pos)
+        if pos < 0:
+            return None
+        try:
+            _id, data_start, size = _read_header(tail, pos)
+            latest = None
+            cluster_timecode = None
+            for element_id, value in _children(tail, data_start, None if size is None else data_start + size):
+                if cluster_timecode is None:
+                    if element_id != CLUSTER_TIMECODE:
+                        break
+                    cluster_timecode = _uint(value)
+                elif element_id == SIMPLE_BLOCK:
+                    latest = max(latest or 0, _block_timecode(value))
+                elif element_id == BLOCK_GROUP:
+                    for child_id, block in _children(value):
+                        if child_id == BLOCK:
+                            latest = max(latest or 0, _block_timecode(block))
+                elif element_id == CLUSTER:
+                    break
+        except MediaProbeError:
+            # 最后一个元素被截断, 已经读到的时间码仍然有效
+            pass
+        if cluster_timecode is not None:
+            return cluster_timecode + (latest or 0)
+
+
+def probe_webm(path):
+    '''
+    解析 WebM/Matroska 文件头, 返回 MediaInfo; 文件不是合法的 WebM 时抛出 MediaProbeError
+    只读取头部的几 KB, 时长缺失时再读取文件尾部 TAIL_SCAN_BYTES 字节
+    '''
+    info = MediaInfo()
+    state = {"timecode_scale": 1000000, "frame_duration": 0.0, "tracks": False}
+    with open(path, "rb") as f:
+        reader = _BoundedReader(f, os.fstat(f.fileno()).st_size)
+        element_id, data_start, size = reader.header(0)
+        if element_id != EBML or size is None:
+            raise MediaProbeError("not an EBML file")
+        for child_id, value in _children(reader.read(data_start, size)):
+            if child_id == DOC_TYPE:
+                info.doc_type = _string(value)
+        if info.doc_type not in ("webm", "matroska"):
+            raise MediaProbeError("unsupported doc type: %r" % info.doc_type)
+
+        element_id, segment_start, segment_size = reader.header(data_start + size)
+        if element_id != SEGMENT:
+            raise MediaProbeError("segment not found")
+        segment_end = reader.size if segment_size is None else min(reader.size, segment_start + segment_size)
+
+        def read_element(offset):
+            child_id, child_start, child_size = reader.header(offset)
+            if child_size is None or child_size > MAX_ELEMENT_BYTES:
+                raise MediaProbeError("element 0x%X too large" % child_id)
+            return child_id, reader.read(child_start, child_size), child_start + child_size
+
+        seek_positions = {}
+        pos = segment_start
+        for _ in range(MAX_SEGMENT_CHILDREN):
+            if pos >= segment_end or (info.duration is not None and state["tracks"]):
+                break
+            child_id, child_start, child_size = reader.header(pos)
+            if child_id == CLUSTER or child_size is None:
+                # 媒体数据开始, 之后的元素通过 SeekHead 定位
+                break
+            if child_id in (INFO, TRACKS, SEEK_HEAD):
+                _id, data, _end = read_element(pos)
+                if child_id == INFO:
+                    _parse_info(data, info, state)
+                elif child_id == TRACKS:
+                    _parse_tracks(data, info, state)
+                else:
+                    seek_positions.update(_parse_seek_head(data))
+            pos = child_start + child_size
+
+        for wanted, parse in ((INFO, _parse_info), (TRACKS, _parse_tracks)):
+            if wanted in seek_positions and (wanted != TRACKS or not state["tracks"]) and (wanted != INFO or info.duration is None):
+                child_id, data, _end = read_element(segment_start + seek_positions[wanted])
+                if child_id == wanted:
+                    parse(data, info, state)
+
+        if info.duration is None:
+            tail_start = max(segment_start, reader.size - TAIL_SCAN_BYTES)
+            last = _last_block_time(reader.read(tail_start, reader.size - tail_start))
+            if last is not None:
+                info.duration = last * state["timecode_scale"] / 1e9 + state["frame_duration"]
+        if not state["tracks"]:
+            raise MediaProbeError("tracks not found")
+        logger.debug("Probed %s: %s (%s bytes read)", path, info, reader.bytes_read)
+    return info
+
+
+class MediaIndex():
+    '''
+    视频文件头部信息的持久化索引, 以 (路径, 大小, mtime) 为键
+    文件没有变化时不再打开文件, 重新编译视频清单只需要 stat
+    '''
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self.entries = {}
+        self.probed = 0
+        self._dirty = False
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_file, "r", encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get("version") == MEDIA_INDEX_VERSION:
+                self.entries = data.get("entries", {})
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning("视频信息索引无效: %s", e)
+
+    def probe(self, path, stat_result=None):
+        '''
+        返回文件的 MediaInfo, 索引中的记录与文件的大小和 mtime 一致时直接使用
+        解析失败时返回 error 不为 None 的 MediaInfo, 文件不存在时抛出 OSError
+        '''
+        if stat_result is None:
+            stat_result = os.stat(path)
+        key = os.path.normpath(path)
+        entry = self.entries.get(key)
+        if entry is not None and entry["size"] == stat_result.st_size and entry["mtime_ns"] == stat_result.st_mtime_ns:
+            return MediaInfo.from_dict(entry["info"])
+        try:
+            info = probe_webm(path)
+        except (MediaProbeError, OSError) as e:
+            logger.error("Video file %s is broken: %s", path, e)
+            info = MediaInfo(error=str(e))
+        self.probed += 1
+        self.put(path, stat_result.st_size, stat_result.st_mtime_ns, info)
+        return info
+
+    def put(self, path, size, mtime_ns, info):
+        '''
+        记录在其他进程中解析的结果 (见 ingest.py)
+        '''
+        self.entries[os.path.normpath(path)] = {"size": size, "mtime_ns": mtime_ns, "info": info.as_dict()}
+        self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        data = {"version": MEDIA_INDEX_VERSION, "entries": self.entries}
+        try:
+            tmp_file = self.index_file + ".tmp"
+            with open(tmp_file, "w", encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_file, self.index_file)
+            self._dirty = False
+        except OSError as e:
+            logger.warning("保存视频信息索引失败: %s", e)
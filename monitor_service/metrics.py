@@ -0,0 +1,229 @@
+import asyncio
+import collections
+import json
+import logging
+import time
+
+from logging_setup import log_stats
+from tracing import BUCKETS, LatencyHistogram
+
+logger = logging.getLogger("monitor_service")
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# 事件循环延迟超过该值 (秒) 时 /health 返回 503
+HEALTH_MAX_LOOP_LAG = 1.0
+# 导出的翻页延迟区间, 其余区间在状态查询中 (每个房间每个区间十几行, 全部导出会让 /metrics 过大)
+SLIDE_LATENCY_SEGMENTS = ("detected->started", "detected->rendered")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _client_label(client_addr):
+    if isinstance(client_addr, tuple):
+        return "%s:%s" % client_addr[:2]
+    return client_addr
+
+
+class _Exposition():
+    '''
+    按 Prometheus 文本格式 (0.0.4) 拼接指标
+    '''
+    def __init__(self):
+        self.lines = []
+
+    def family(self, name, kind, help_text):
+        self.lines.append("# HELP %s %s" % (name, help_text))
+        self.lines.append("# TYPE %s %s" % (name, kind))
+
+    def sample(self, name, value, labels=None):
+        if labels:
+            name = "%s{%s}" % (name, ",".join('%s="%s"' % (key, _escape(v)) for key, v in labels.items()))
+        self.lines.append("%s %s" % (name, repr(float(value)) if isinstance(value, float) else value))
+
+    def histogram(self, name, histogram, labels=None):
+        labels = labels or {}
+        cumulative = 0
+        for bound, count in zip(BUCKETS, histogram.buckets):
+            cumulative += count
+            self.sample(name + "_bucket", cumulative, dict(labels, le=repr(bound)))
+        self.sample(name + "_bucket", histogram.count, dict(labels, le="+Inf"))
+        self.sample(name + "_sum", histogram.sum, labels)
+        self.sample(name + "_count", histogram.count, labels)
+
+    def render(self):
+        return "\n".join(self.lines) + "\n"
+
+
+class Metrics():
+    '''
+    监控服务的运行指标: /metrics (Prometheus 文本格式) 和 /health (JSON)
+    请求时只读取各组件已有的计数器 (房间, ComWorker, AssetServer, Config, 日志队列);
+    常驻的开销只有每 sample_interval 秒一次的事件循环延迟采样: sleep 实际醒来的时间比预定晚多少.
+    消息速率按最近 rate_window 秒内的计数变化计算.
+    '''
+    RATE_SAMPLE_SECONDS = 5.0
+
+    def __init__(self, hub, config=None, sample_interval=0.5, rate_window=60.0):
+        self.hub = hub
+        self.config = config
+        self.sample_interval = sample_interval
+        self.started_at = time.time()
+        self.loop_lag = 0.0
+        self.loop_lag_histogram = LatencyHistogram(max_samples=512)
+        self.scrapes = 0
+        # (time.monotonic(), 发送总数, 接收总数), 每 RATE_SAMPLE_SECONDS 秒一项
+        self._rate_samples = collections.deque(maxlen=max(2, int(rate_window / self.RATE_SAMPLE_SECONDS) + 1))
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._sample())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _sample(self):
+        loop = asyncio.get_running_loop()
+        next_rate_sample = loop.time()
+        while True:
+            expected = loop.time() + self.sample_interval
+            await asyncio.sleep(self.sample_interval)
+            now = loop.time()
+            self.loop_lag = max(0.0, now - expected)
+            self.loop_lag_histogram.add(self.loop_lag)
+            if now >= next_rate_sample:
+                self._rate_samples.append((time.monotonic(), *self._message_totals()))
+                next_rate_sample = now + self.RATE_SAMPLE_SECONDS
+
+    def _message_totals(self):
+        sent = received = 0
+        for room in self.hub.rooms.values():
+            sent += room.sent
+            received += room.received
+        return sent, received
+
+    def message_rates(self):
+        '''
+        最近一段时间每秒发送和接收的消息数, 采样不足时为 (0.0, 0.0)
+        '''
+        if len(self._rate_samples) < 2:
+            return 0.0, 0.0
+        (t0, sent0, received0), (t1, sent1, received1) = self._rate_samples[0], self._rate_samples[-1]
+        seconds = t1 - t0
+        return (sent1 - sent0) / seconds, (received1 - received0) / seconds
+
+    def prometheus(self):
+        '''
+        GET /metrics
+        '''
+        self.scrapes += 1
+        out = _Exposition()
+        out.family("process_start_time_seconds", "gauge", "Start time of the monitor process since unix epoch.")
+        out.sample("process_start_time_seconds", self.started_at)
+
+        out.family("monitor_event_loop_lag_seconds", "histogram", "Sampled delay of the asyncio scheduler.")
+        out.histogram("monitor_event_loop_lag_seconds", self.loop_lag_histogram)
+        out.family("monitor_event_loop_lag_last_seconds", "gauge", "Most recent event loop lag sample.")
+        out.sample("monitor_event_loop_lag_last_seconds", self.loop_lag)
+
+        rooms = list(self.hub.rooms.values())
+        out.family("monitor_clients", "gauge", "Connected avatar clients.")
+        for room in rooms:
+            out.sample("monitor_clients", len(room.clients), {"room": room.name})
+        out.family("monitor_messages_sent_total", "counter", "Messages written to client connections.")
+        for room in rooms:
+            out.sample("monitor_messages_sent_total", room.sent, {"room": room.name})
+        out.family("monitor_messages_received_total", "counter", "Messages received from clients.")
+        for room in rooms:
+            out.sample("monitor_messages_received_total", room.received, {"room": room.name})
+        out.family("monitor_send_failures_total", "counter", "Client sends that failed, timed out or overflowed the queue.")
+        for room in rooms:
+            out.sample("monitor_send_failures_total", room.send_failures, {"room": room.name})
+        sent_rate, received_rate = self.message_rates()
+        out.family("monitor_messages_per_second", "gauge", "Message rate over the recent window.")
+        out.sample("monitor_messages_per_second", round(sent_rate, 3), {"direction": "sent"})
+        out.sample("monitor_messages_per_second", round(received_rate, 3), {"direction": "received"})
+        out.family("monitor_client_queue_depth", "gauge", "Messages waiting in each client's send queue.")
+        for room in rooms:
+            for channel in room.clients.values():
+                out.sample("monitor_client_queue_depth", len(channel.queue), {"room": room.name, "client": _client_label(channel.client_addr)})
+        out.family("monitor_last_slide_change_timestamp_seconds", "gauge", "Time of the last detected slide change.")
+        for room in rooms:
+            if room.last_slide_change is not None:
+                out.sample("monitor_last_slide_change_timestamp_seconds", room.last_slide_change, {"room": room.name})
+        out.family("monitor_slide_latency_seconds", "histogram", "Slide change latency between trace stages.")
+        for room in rooms:
+            for segment in SLIDE_LATENCY_SEGMENTS:
+                histogram = room.tracer.histograms[segment]
+                if histogram.count:
+                    out.histogram("monitor_slide_latency_seconds", histogram, {"room": room.name, "segment": segment})
+
+        worker = self.hub.com_worker
+        if worker is not None:
+            out.family("monitor_com_call_duration_seconds", "histogram", "PowerPoint COM call duration per method.")
+            for name, histogram in list(worker.latency.items()):
+                out.histogram("monitor_com_call_duration_seconds", histogram, {"method": name})
+            out.family("monitor_com_calls_total", "counter", "PowerPoint COM calls by outcome.")
+            for outcome in ("completed", "failed", "timeouts", "hung", "cancelled"):
+                out.sample("monitor_com_calls_total", getattr(worker, outcome), {"outcome": outcome})
+            out.family("monitor_com_pending_calls", "gauge", "COM calls waiting for the worker thread.")
+            out.sample("monitor_com_pending_calls", worker.pending)
+            out.family("monitor_com_hanging_calls", "gauge", "Timed-out COM calls that are still running.")
+            out.sample("monitor_com_hanging_calls", worker.hanging)
+            out.family("monitor_com_busy_seconds", "gauge", "How long the current COM call has been running.")
+            out.sample("monitor_com_busy_seconds", round(worker.busy_seconds, 3))
+
+        if self.config is not None:
+            out.family("monitor_config_reloads_total", "counter", "config.json reloads.")
+            out.sample("monitor_config_reloads_total", self.config.reload_count)
+            out.family("monitor_config_reload_errors_total", "counter", "config.json reloads that failed validation.")
+            out.sample("monitor_config_reload_errors_total", self.config.reload_errors)
+
+        assets = self.hub.asset_server
+        if assets is not None:
+            out.family("monitor_asset_requests_total", "counter", "HTTP requests to the video file service.")
+            out.sample("monitor_asset_requests_total", assets.requests)
+            out.family("monitor_asset_sent_bytes_total", "counter", "Video bytes sent.")
+            out.sample("monitor_asset_sent_bytes_total", assets.bytes_sent)
+
+        stats = log_stats()
+        if stats is not None:
+            out.family("monitor_log_dropped_total", "counter", "Log records dropped because the queue was full.")
+            out.sample("monitor_log_dropped_total", stats["dropped"])
+            out.family("monitor_log_suppressed_total", "counter", "Log records suppressed by the rate limit.")
+            out.sample("monitor_log_suppressed_total", stats["suppressed"])
+        return 200, PROMETHEUS_CONTENT_TYPE, out.render()
+
+    def health(self):
+        '''
+        GET /health: 事件循环延迟过大, 或 COM 调用卡住超过超时时间时返回 503
+        '''
+        problems = []
+        if self.loop_lag > HEALTH_MAX_LOOP_LAG:
+            problems.append("event loop lag %.3fs" % self.loop_lag)
+        worker = self.hub.com_worker
+        if worker is not None and worker.default_timeout and worker.busy_seconds > worker.default_timeout:
+            problems.append("COM call running for %.1fs" % worker.busy_seconds)
+        now = time.time()
+        body = {
+            "status": "unhealthy" if problems else "ok",
+            "problems": problems,
+            "uptime_seconds": round(now - self.started_at, 1),
+            "loop_lag_ms": round(self.loop_lag * 1000, 2),
+            "rooms": {room.name: {"clients": len(room.clients),
+                                  "last_slide_change_age": round(now - room.last_slide_change, 1) if room.last_slide_change else None}
+                      for room in self.hub.rooms.values()}
+        }
+        if worker is not None:
+            body["com_pending"] = worker.pending
+        if self.config is not None:
+            body["config_reload_errors"] = self.config.reload_errors
+        return 503 if problems else 200, "application/json; charset=utf-8", json.dumps(body, ensure_ascii=False)
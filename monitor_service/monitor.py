@@ -1,458 +1,265 @@
-import win32com.client
 import asyncio
-import json
-import os
-import websockets
-import time
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
-from pathlib import Path
+import time
 
-# Logger setup: write logs to project root `monitor.log`
-if not os.path.exists("../log"):
-    os.mkdir("log")
-LOG_FILE = os.path.join("../log", "monitor.log")
+import protocol
+from asset_server import AssetServer
+from com_worker import ComTimeoutError, ComWorker
+from config import Config
+from manifest import SlideVideoManifest
+from metrics import Metrics
+from ppt_com import PowerPointMonitor
+from recorder import RECORDED_CONFIG_KEYS, RECORDING_VERSION, SessionRecorder
+from server import export_latency, handler, serve
+from slide_source import EMPTY_PPT_STATUS, PollIntervals, SlideChange, create_slide_source
+from state_store import AvatarEvent, StateChange, StateStore
+from timeline import AdvanceSlide, AutoScheduler, Timeline
+
+# 导入本模块不依赖 pywin32, websockets 和 tendo, 也不创建日志目录;
+# COM 后端在第一次连接 PowerPoint 时导入, 日志在 main() 中配置
 logger = logging.getLogger("monitor_service")
-logger.setLevel(logging.DEBUG)
-if not logger.handlers:
-    fh = RotatingFileHandler(LOG_FILE, maxBytes=5 * 1024 * 1024, backupCount=3, encoding='utf-8')
-    formatter = logging.Formatter('%(asctime)s %(levelname)s [%(name)s] %(message)s')
-    fh.setFormatter(formatter)
-    logger.addHandler(fh)
-    ch = logging.StreamHandler()
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
-
-class Config():
-    def __init__(self, work_mode="manual", server_host="localhost", websocket_port=8765):
-        '''
-        work_mode: 工作模式, manual 手动, collaboration 协同, auto 自动
-        server_host: WebSocket 服务器监听地址
-        websocket_port: WebSocket 服务器监听端口
-        '''
-        self.__CONFIG_FILE = "config.json"
-        if not os.path.exists(self.__CONFIG_FILE):
-            raise FileNotFoundError(f"Configuration file '{self.__CONFIG_FILE}' not found.")
-        self.config = {}
-        self.__last_update_time = None
-        self.update()
-        self.isUpdated = False
-
-    def update(self):
-        self.isUpdated = False
-        if not self.__last_update_time == os.path.getmtime(self.__CONFIG_FILE):
-            logger.info("Configuration file updated, reloading...")
-            with open(self.__CONFIG_FILE, "r", encoding='utf-8') as f:
-                self.config = json.load(f)
-            self.__last_update_time = os.path.getmtime(self.__CONFIG_FILE)
-            self.isUpdated = True
-        if self.isUpdated:
-            logger.info("Current Configuration: %s", self.config)
-            if self.config["work_mode"] == "manual":
-                logger.info('讲解员模式, 检测ppt状态，不自动播放')
-            elif self.config["work_mode"] == "collaboration":
-                logger.info("协作模式, 讲解员决定内容播放")
-            elif self.config["work_mode"] == "auto":
-                logger.info("自动模式, ppt 启动后自动播放")
-            else:
-                logger.warning("未知模式: %s, 按讲解员模式处理", self.config["work_mode"])
-                self.config["work_mode"] = "manual"
-
-class PowerPointMonitor():
-    def __init__(self):
-        self._ppt_app_list = ["PowerPoint.Application", "Kwpp.Application"]
-        self.ppt_app_name = None
-        self.ppt_app = None
-        self.slide_show_active = False
-        self.presentation_name = None
-        self.slide_video_list = None
-        self.__assets_base_dir = "../assets"
-        self.__slide_video_config = "slide_video.json"
-        self.__slide_index_prefix = "slide-"
-        self.__idle_video_prefix = "idle"
-        # 只让 ppt_add 没有连接的信息出现一次
-        self.__ppt_app_warning_flag = True
-
-    def connect_powerpoint(self):
-        for app_name in self._ppt_app_list:
-            try:
-                self.ppt_app = win32com.client.GetActiveObject(app_name)
-                if self.ppt_app:
-                    self.ppt_app_name = app_name
-                    logger.info("连接PPT应用: %s 成功!", app_name)
-                    break
-            except Exception as e:
-                self.ppt_app = None
-        if self.ppt_app is None:
-            if self.__ppt_app_warning_flag:
-                logger.warning("没有可用的PPT应用")
-                self.__ppt_app_warning_flag = False
-            return
-        else:
-             self.__ppt_app_warning_flag = True
-        
-        if not self.ppt_app.Visible:
-            try:
-                logger.info("PPT应用不可见,设置PPT可见")
-                self.ppt_app.Visible = 1
-            except:
-                logger.warning("设置可见性失败!")
-
-        presentation_name = self.get_presentation_name()
-        if presentation_name:
-            self.update_slide_video_list(presentation_name)
-
-    def get_presentation_name(self):
-        '''
-        获取当前活动的演示文稿名称
-        '''
-        if self.isConnected():
-            try:
-                presentation = self.ppt_app.ActivePresentation
-                self.presentation_name = presentation.Name
-                return self.presentation_name
-            except:
-                self.presentation_name = None
-                return None
-    def isConnected(self):
-        return True if self.get_presentations_count() > 0 else False
-
-    def get_presentations_count(self):
-        '''
-        根据 PowerPoint 应用程序对象判断是否连接
-        -1: 未连接
-        0: 已连接但无打开的演示文稿
-        n: 已连接且打开了 n 个演示文稿
-        '''
-        if self.ppt_app:
-            return self.ppt_app.Presentations.Count
-        return -1
-
-    def get_slides_count(self):
-        if self.get_presentations_count()>0:
-            try:
-                presentation = self.ppt_app.ActivePresentation
-                return presentation.Slides.Count
-            except:
-                return -1
-        return -1
-
-    def get_edit_slide_index(self):
-        '''
-        获取编辑的幻灯片编号
-        '''
-        if self.get_presentations_count()>0:
-            try:
-                presentation = self.ppt_app.ActivePresentation
-                slide = presentation.Windows(1).View.Slide
-                return slide.SlideIndex
-            except:
-                return -1
-
-    def get_present_slide_index(self):
-        '''
-        获取播放的幻灯片编号
-        '''
-        if self.get_presentations_count()>0:
-            try:
-                presentation = self.ppt_app.ActivePresentation
-                slide = presentation.SlideShowWindow.View.Slide
-                return slide.SlideIndex
-            except:
-                return -1
-
-    def get_current_ppt_status(self):
-        '''
-        获取当前幻灯片的播放状态和编号, 返回 
-        {"present_count": 打开的ppt数量,
-        "present_name": ppt名字,
-        "slides_count": 胶片数量,
-        "edit_slide_index": 当前编辑的胶片的索引,
-        "present_slide_index": 放映的胶片的索引}
-        编号为 -1 无效
-        '''
-        # 检查当前连接状态
-        current_ppt_status = {
-            "present_count": -1,
-            "present_name": "",
-            "slides_count": -1,
-            "edit_slide_index": -1,
-            "present_slide_index": -1
-        }
-        # 如果没有连接 PowerPoint，则尝试连接
-        if not self.isConnected():
-            self.connect_powerpoint()
-        present_count = self.get_presentations_count()
-        # 根据当前连接状态返回结果
-        if present_count == -1:
-            return current_ppt_status
-        if present_count == 0:
-            current_ppt_status["present_count"] = present_count
-            return current_ppt_status
-        if present_count > 0:
-            current_ppt_status["present_count"] = present_count
-            presentation = self.ppt_app.ActivePresentation
-            current_ppt_status["present_name"] = presentation.Name
-            current_ppt_status["slides_count"] = presentation.Slides.Count
-            current_ppt_status["edit_slide_index"] = presentation.Windows(1).View.Slide.SlideIndex
-            # 则获取当前幻灯片编号
-            present_slide_index = -1
-            try:
-                present_slide_index = presentation.SlideShowWindow.View.Slide.SlideIndex
-                current_ppt_status["present_slide_index"] = present_slide_index
-            except:
-                pass
-            return current_ppt_status
-
-    def update_slide_video_list(self, presentation_name):
-        '''
-        获取当前幻灯片中的视频列表
-        '''
-        self.slide_video_list = None
-        try:
-            with open(os.path.join(self.__assets_base_dir, self.__slide_video_config), "r", encoding='utf-8') as f:
-                slide_video_config = json.load(f)
-        except Exception as e:
-            logger.warning("处理 slide_video.json 失败: %s, 当前文件夹: %s", e, os.getcwd())
-            return
 
-        for item in slide_video_config["slide_videos"]:
-            if "name" in item and "videos" in item:
-                print(item["name"])
-                if item["name"].endswith(presentation_name):
-                    self.slide_video_list = item["videos"]
-                    logger.info("当前演示文稿 %s 包含 %s 个视频", presentation_name, len(self.slide_video_list))
-                    break
-        if self.slide_video_list is None:
-            logger.warning("当前演示文稿 %s 没有配置数字人视频,无法播放数字人!", presentation_name)
-        else:
-            # 确认视频是否存在,并补充完整路径
-            for video_file_index in self.slide_video_list:
-                video_file = os.path.join(self.__assets_base_dir, self.slide_video_list[video_file_index])
-                if not os.path.exists(video_file):
-                    logger.error("Video file %s does not exist", video_file)
-                    self.slide_video_list[video_file_index] = None
-                else:
-                    self.slide_video_list[video_file_index] = video_file
-
-    def get_slide_video_file(self, prensentation_index):
-        index = self.__slide_index_prefix + str(prensentation_index)
-        return self.get_video_file(index)
-
-    def get_idle_video_file(self, prensentation_index = None):
-        index = self.__idle_video_prefix
-        return self.get_video_file(index)
-
-    def get_video_file(self, prensentation_index):
-        if self.slide_video_list is None:
-            logger.warning("当前幻灯片没有配置数字人视频")
-            return []
-        if not prensentation_index in self.slide_video_list:
-            logger.warning("当前幻灯片 %s 没有配置数字人视频" , prensentation_index)
-            return []
-        return self.slide_video_list[prensentation_index]
-
-    def goto_page(self, dest_slide_index = 0):
-        '''
-        ppt 跳转到指定页面, -1, 指代上一页; 0 指代下一页; 正数指定特定页面
-        如果是播放状态, 跳转播放
-        如果是非播放状态, 则跳转编辑的页面
-        '''
-        current_ppt_status = self.get_current_ppt_status()
-        logger.info(current_ppt_status)
-        if current_ppt_status["slides_count"] > 0:
-            if current_ppt_status["present_slide_index"] > 0:
-                # 下一页
-                if dest_slide_index == 0:
-                    if current_ppt_status["present_slide_index"] < current_ppt_status["slides_count"]:
-                        self.ppt_app.ActivePresentation.SlideShowWindow.View.Next()
-                elif dest_slide_index == -1:
-                    # 上一页
-                    if current_ppt_status["present_slide_index"] > 1:
-                        self.ppt_app.ActivePresentation.SlideShowWindow.View.Previous()
-                else:
-                    if dest_slide_index >= 1 and dest_slide_index <= current_ppt_status["slides_count"]:
-                        self.ppt_app.ActivePresentation.SlideShowWindow.View.GotoSlide(dest_slide_index)
-            elif current_ppt_status["edit_slide_index"] > 0:
-                # 下一页
-                if dest_slide_index == 0:
-                    if current_ppt_status["edit_slide_index"] < current_ppt_status["slides_count"]:
-                        self.ppt_app.ActivePresentation.Slides(current_ppt_status["edit_slide_index"] + 1).Select()
-                elif dest_slide_index == -1:
-                    # 上一页
-                    if current_ppt_status["edit_slide_index"] > 1:
-                        self.ppt_app.ActivePresentation.Slides(current_ppt_status["edit_slide_index"] - 1).Select()
-                else:
-                    if dest_slide_index >= 1 and current_ppt_status["edit_slide_index"] <= dest_slide_index:
-                        self.ppt_app.ActivePresentation.Slides(dest_slide_index).Select()
 
-    def goto_next_page(self):
-        self.goto_page(0)
+async def send_preload(room, ppt_page, count):
+    '''
+    通知数字人客户端预加载 idle 视频和之后几页的视频, 翻页时不需要重新加载
+    '''
+    videos = room.ppt_monitor.get_preload_videos(ppt_page, count)
+    if videos:
+        await room.send_to_clients("preload", protocol.preload_message(videos))
 
-    def goto_previous_page(self):
-        self.goto_page(-1)
 
-    def start_slideshow(self):
-        if self.get_presentations_count() <= 0:
-            return
-        try:
-            self.ppt_app.ActivePresentation.SlideShowSettings.Run()
-            self.slide_show_active = True
-        except:
-            logger.warning("开始幻灯片放映失败")
+async def send_slide_playlist(room, ppt_page, slide_change, preload_count, use_cue=True):
+    '''
+    向房间的客户端下发一页的视频和 idle 视频, 并预加载之后几页, 返回延迟追踪的 trace
+    use_cue: 视频表下发过后只发送 cue 消息, 否则发送完整的 playlist
+    '''
+    ppt_monitor = room.ppt_monitor
+    trace = room.tracer.begin(slide_change, ppt_page)
+    table = ppt_monitor.get_video_table() if use_cue else None
+    if table is not None:
+        await room.send_deck(table)
+        await room.send_cue(ppt_page, trace)
+    else:
+        playlist = protocol.slide_playlist(ppt_monitor.get_slide_video_file(ppt_page), ppt_monitor.get_idle_video_file(ppt_page))
+        await room.send_playlist(playlist, trace, ppt_page)
+    await send_preload(room, ppt_page, preload_count)
+    return trace
+
 
+def build_timeline(ppt_monitor, ppt_status, default_seconds):
+    '''
+    按当前演示文稿的视频时长生成自动模式的时间表, 没有配置视频时返回 None
+    '''
+    if ppt_status["slides_count"] <= 0:
+        return None
+    durations = [ppt_monitor.get_slide_video_duration(i) for i in range(1, ppt_status["slides_count"] + 1)]
+    if ppt_monitor.deck is None:
+        return None
+    key = (ppt_status["present_name"], ppt_status["slides_count"], ppt_monitor.manifest.generation)
+    return Timeline(ppt_status["present_name"], durations, default_seconds, key)
 
-global ppt_monitor
-ppt_monitor = None
 
-def parse_event(event: dict) -> str:
+async def com_call(worker, fn, *args, default=None):
     '''
-    根据事件, 返回数字人的状态
-    idle
-    playing
-    unknown
+    在 COM 工作线程中调用 fn, 超时或失败时记录日志并返回 default
     '''
-    global ppt_monitor
-    if "event" in event and "type" in event and "src" in event:
-        if event["event"] == "started":
-            if event["type"] == "video":
-                if event["src"] == ppt_monitor.get_idle_video_file():
-                    return "idle"
-                else:
-                    return "playing"
-        elif event["event"] == "finished":
-            return "idle"
-    return "unknown"
+    try:
+        return await worker.call(fn, *args)
+    except ComTimeoutError:
+        return default
+    except Exception as e:
+        logger.warning("COM 调用 %s 失败: %s", getattr(fn, "__name__", fn), e)
+        return default
 
 
-async def broadcast_slide_change():
-    # 首次启动使用当前的配置作为基础配置
-    logger.info("读取配置...")
-    cfg = Config()
-    previous_config = cfg.config.copy()
-
-    logger.info("初始化 Presentation 监控...")
-    global ppt_monitor
-    ppt_monitor = PowerPointMonitor()
-    ppt_monitor.connect_powerpoint()
-    previous_ppt_status = ppt_monitor.get_current_ppt_status()
-    if previous_ppt_status["present_count"] < 0:
-        logger.warning("PPT应用没有打开")
-    else:
-        logger.info("PPT应用名称: %s", ppt_monitor.ppt_app_name)
-        logger.info("初始化PPT文件名: %s", previous_ppt_status["present_name"])
-        logger.info("初始化PPT状态: %s", previous_ppt_status)
+def room_configs(config):
+    '''
+    配置中的房间: {房间名: 房间配置}, 房间没有配置的项使用顶层的配置
+    没有配置 rooms 时只有一个默认房间, 跟随当前活动的演示文稿
+    '''
+    rooms = config["rooms"] or [{"name": handler.DEFAULT_ROOM}]
+    result = {}
+    for room in rooms:
+        result[room["name"]] = {
+            "presentation": room.get("presentation"),
+            "work_mode": room.get("work_mode", config["work_mode"]),
+            "avatar_command": room.get("avatar_command", config["avatar_command"]),
+            "slide_source": room.get("slide_source", config["slide_source"])
+        }
+    return result
+
+
+async def run_room(room, room_config, cfg, manifest, com_worker, asset_url=None, poll_intervals=None):
+    '''
+    一个房间的主循环: 跟踪房间的演示文稿, 按房间的工作模式向房间的客户端下发播放内容
+    '''
+    # 运行状态和事件队列, 数字人事件不再写入 config.json
+    store = StateStore(room_config["work_mode"], room_config["avatar_command"])
+    room.store = store
+    room.session.set_work_mode(store.work_mode)
+
+    logger.info("[%s] 初始化 Presentation 监控: %s", room.name, room_config["presentation"] or "当前活动的演示文稿")
+    ppt_monitor = PowerPointMonitor(manifest, presentation_name=room_config["presentation"])
+    if asset_url is not None:
+        ppt_monitor.set_asset_url(asset_url)
+    # 所有对 ppt_monitor 的 COM 调用都在 com_worker 线程中执行, PowerPoint 忙碌时不阻塞事件循环
+    await com_call(com_worker, ppt_monitor.connect_powerpoint, True)
+    room.ppt_monitor = ppt_monitor
+    # 自动模式按视频时长预先安排翻页
+    scheduler = AutoScheduler(store.inbox, cfg.config["auto_loop"])
+    room.scheduler = scheduler
+
+    # 幻灯片变化由 slide_source 投递到与数字人事件相同的队列, 事件方式下翻页后立即响应
+    slide_source = create_slide_source(room_config["slide_source"], ppt_monitor,
+                                       lambda: PowerPointMonitor(manifest, presentation_name=room_config["presentation"]),
+                                       interval=poll_intervals or PollIntervals.from_config(cfg.config),
+                                       queue=store.inbox, worker=com_worker)
+    await slide_source.start()
+    try:
+        previous_ppt_status = dict(slide_source.status)
+        if previous_ppt_status["present_count"] < 0:
+            logger.warning("PPT应用没有打开")
+        else:
+            logger.info("PPT应用名称: %s", ppt_monitor.ppt_app_name)
+            logger.info("[%s] 初始化PPT文件名: %s", room.name, previous_ppt_status["present_name"])
+            logger.info("[%s] 初始化PPT状态: %s", room.name, previous_ppt_status)
+
+        await run_state_machine(room, store, ppt_monitor, scheduler, com_worker, cfg, manifest, previous_ppt_status)
+    finally:
+        scheduler.stop()
+        # 房间重新启动时新的主循环可能已经设置了 store
+        if room.store is store:
+            room.store = None
+        await slide_source.stop()
+
+
+async def run_state_machine(room, store, ppt_monitor, scheduler, com_worker, cfg, manifest, previous_ppt_status):
+    '''
+    房间的状态机: 按到达顺序处理事件队列中的数字人事件, 状态变化, 幻灯片变化和时间表到期, 向房间的客户端下发播放内容
+    run_room 和 replay.py 共用; previous_ppt_status 为开始时的幻灯片状态.
+    房间设置了 recorder 时记录每个事件, 每次 COM 调用的结果和下发的消息 (见 recorder.py)
+    '''
+    if room.recorder is not None:
+        room.recorder.record("start", room.name, presentation=ppt_monitor.presentation_name, work_mode=store.work_mode,
+                             avatar_command=store.avatar_command, status=previous_ppt_status)
+
+    async def com(fn, *args, default=None):
+        result = await com_call(com_worker, fn, *args, default=default)
+        if room.recorder is not None:
+            room.recorder.record("com", room.name, method=fn.__name__, args=list(args), result=result)
+        return result
+
+    def update_timeline(ppt_status):
+        key = (ppt_status["present_name"], ppt_status["slides_count"], manifest.generation)
+        if scheduler.timeline is not None and scheduler.timeline.key == key:
+            return
+        timeline = build_timeline(ppt_monitor, ppt_status, cfg.config["auto_slide_seconds"])
+        if timeline is not None:
+            scheduler.load(timeline)
+        else:
+            scheduler.stop()
+            scheduler.timeline = None
+
+    def status_page(ppt_status):
+        # 放映中为放映的页面, 否则为编辑的页面
+        if ppt_status["present_slide_index"] > 0:
+            return ppt_status["present_slide_index"]
+        return ppt_status["edit_slide_index"]
+
+    update_timeline(previous_ppt_status)
 
     # 数字人状态: idle, playing, pause, unknown
     avatar_status = "idle"
-
-    # 启动 WebSocket 服务器
-    async with websockets.serve(handler.handler, cfg.config["server_host"], cfg.config["websocket_port"]):
-        logger.info('WebSocket server started at ws://%s:%s', cfg.config["server_host"], cfg.config["websocket_port"])
-        while True:
-            # 监测配置文件更新
-            # 检测三个参数变化 work_mode , avatar_command, avatar_status
-            # avatar_command 记录需要发送到数字人的命令, 变化时, play, pause指令, 将内容变化给客户端
-            # avatar_status 记录数字人播放器返回的状态事件
-            # work_mode 从 auto 或 collaboration 切换到 manual, 需要发送停止播放的消息
-            cfg.update()
-            if cfg.isUpdated:
-                # 优先处理事件,减少事件问题导致状态的变化
-                if previous_config["avatar_event"] != cfg.config["avatar_event"]:
-                    logger.info("数字人事件:", cfg.config["avatar_event"])
-                    # 根据工作模式处理事件
-                    avatar_status = parse_event(cfg.config["avatar_event"])
-                    logger.info("数字人状态切换: %s", avatar_status)
-                    if avatar_status == "idle":
-                        if cfg.config["work_mode"] == "auto":
-                            ppt_monitor.goto_next_page()
-                    elif avatar_status == "playing":
-                        pass
-                    elif avatar_status == "unknown":
-                        pass
-
-                # 处理 work_mode 变化
-                if previous_config["work_mode"] != cfg.config["work_mode"]:
-                    logger.info("Switching to %s mode.", cfg.config["work_mode"])
-                    if cfg.config["work_mode"] == "manual":
-                        # 讲解员模式: 主要的讲解任务在讲解员。数字人不参与
-                        # 发送空的播放列表以停止播放
-                        message = json.dumps({
-                            "tasks": "playlist",
-                            "playlist": []
-                        })
-                        await handler.send_to_clients(message)
-                    elif cfg.config["work_mode"] == "collaboration":
-                        # 协作模式下, 数字人站在旁边，通过数字人按钮决定播放
-                        message = json.dumps({
-                            "tasks": "playlist",
-                            "playlist": [
-                                {"video": ppt_monitor.get_idle_video_file(ppt_page), "loop": -1}
-                            ]
-                        })
-                        await handler.send_to_clients(message)
-                        # 协作模式: 如果当前数字人状态为 playing, 则不做处理
-                        
-                        pass
-                        # TODO:
-                    elif cfg.config["work_mode"] == "auto":
-                        # 自动模式
-                        # 开始播放视频
-                        logger.info("检测到自动模式, 数字人状态: %s", avatar_status)
-                        if not avatar_status == "playing":
-                            # 切换页面
-                            ppt_monitor.goto_next_page()
-                        # TODO:
-
-                # 处理 avatar_command 变化
-                if previous_config["avatar_command"] != cfg.config["avatar_command"]:
-                    # 处理数字人指令
-                    # 如果当前数字人是播放状态, 则发送暂停指令
-                    if avatar_status == "playing":
-                        logger.info("发送暂停指令")
-                        message = json.dumps({
-                            "tasks": "pause"
-                        })
-                        await handler.send_to_clients(message)
-                        avatar_status = "pause"
-                    elif avatar_status == "pause":
-                        logger.info("发送恢复指令")
-                        message = json.dumps({
-                            "tasks": "play"
-                        })
-                        await handler.send_to_clients(message)
-                        avatar_status = "playing"
-                    else:
-                        # 如果是其他状态,应该播放当前的页面
-                        current_ppt_status = ppt_monitor.get_current_ppt_status()
-                        if current_ppt_status["slides_count"] > 0:
-                            ppt_page = current_ppt_status["present_slide_index"]
-                            if ppt_page == -1:
-                                ppt_page = current_ppt_status["edit_slide_index"]
-                            message = json.dumps({
-                                "tasks": "playlist",
-                                "playlist": [
-                                    {"video": ppt_monitor.get_slide_video_file(ppt_page), "loop": 1},
-                                    {"video": ppt_monitor.get_idle_video_file(ppt_page), "loop": -1}
-                                ]
-                            })
-                            await handler.send_to_clients(message)
-                    # logger.info("发送任务")
-                    # message = json.dumps({
-                    #         "tasks": cfg.config["avatar_command"]
-                    #     })
-                    # await handler.send_to_clients(message)
-
-            # 更新 previous_config
-            previous_config = cfg.config.copy()
- 
+    # 主循环按事件队列的顺序看到的工作模式; store.work_mode 是最新的值, 连续切换时队列中还有未处理的 StateChange
+    work_mode = store.work_mode
+    # ppt_page 表示当前的 ppt 页面编号
+    ppt_page = -1
+
+    while True:
+        # 处理三类事件, 按到达顺序:
+        # AvatarEvent 数字人播放器返回的状态事件
+        # StateChange work_mode 或 avatar_command 变化, avatar_command 变化时, play, pause指令, 将内容变化给客户端
+        #             work_mode 从 auto 或 collaboration 切换到 manual, 需要发送停止播放的消息
+        # SlideChange 幻灯片状态变化
+        # AdvanceSlide 自动模式的时间表到期
+        item = await store.next_event()
+        if room.recorder is not None:
+            room.recorder.record_item(room.name, item)
+
+        if isinstance(item, AvatarEvent):
+            logger.info("数字人事件: %s", item.event)
+            # 根据工作模式处理事件
+            avatar_status = protocol.parse_event(item.event, ppt_monitor.get_idle_video_file())
+            logger.info("数字人状态切换: %s", avatar_status)
+            if work_mode == "auto":
+                scheduler.on_avatar_event(item.event, item.received_at)
+            if avatar_status == "idle":
+                # 有时间表时由 AdvanceSlide 翻页
+                if work_mode == "auto" and not scheduler.active:
+                    await com(ppt_monitor.goto_next_page)
+
+        elif isinstance(item, StateChange) and item.key == "work_mode":
+            # 处理 work_mode 变化, 按队列中的每一次切换 (item.old -> item.new) 处理
+            work_mode = item.new
+            logger.info("[%s] Switching from %s to %s mode.", room.name, item.old, work_mode)
+            room.session.set_work_mode(work_mode)
+            if work_mode != "auto":
+                scheduler.stop()
+            if work_mode == "manual":
+                # 讲解员模式: 主要的讲解任务在讲解员。数字人不参与
+                # 发送空的播放列表以停止播放
+                await room.send_playlist([])
+            elif work_mode == "collaboration":
+                # 协作模式下, 数字人站在旁边，通过数字人按钮决定播放; 先循环播放 idle 视频
+                # 使用幻灯片来源最近一次的状态, 还没有下发过任何一页时 ppt_page 为 -1
+                await room.send_playlist(protocol.idle_playlist(ppt_monitor.get_idle_video_file(status_page(previous_ppt_status))))
+            elif work_mode == "auto":
+                # 自动模式: 数字人没有在播放时翻到下一页, 检测到翻页后开始播放
+                logger.info("检测到自动模式, 数字人状态: %s", avatar_status)
+                if not avatar_status == "playing":
+                    await com(ppt_monitor.goto_next_page)
+
+        elif isinstance(item, StateChange) and item.key == "avatar_command":
+            # 处理数字人指令
+            # 如果当前数字人是播放状态, 则发送暂停指令
+            if avatar_status == "playing":
+                logger.info("发送暂停指令")
+                await room.send_pause()
+                avatar_status = "pause"
+                scheduler.pause()
+            elif avatar_status == "pause":
+                logger.info("发送恢复指令")
+                await room.send_play()
+                avatar_status = "playing"
+                scheduler.resume()
+            else:
+                # 如果是其他状态,应该播放当前的页面
+                current_ppt_status = await com(ppt_monitor.get_current_ppt_status, default=dict(EMPTY_PPT_STATUS))
+                if current_ppt_status["slides_count"] > 0:
+                    ppt_page = status_page(current_ppt_status)
+                    trace = await send_slide_playlist(room, ppt_page, None, cfg.config["preload_slides"], cfg.config["cue_messages"])
+                    if work_mode == "auto":
+                        update_timeline(current_ppt_status)
+                        scheduler.play(ppt_page, trace, ppt_monitor.get_slide_video_file(ppt_page))
+
+        elif isinstance(item, AdvanceSlide):
+            # 先下发 playlist, 再让 PowerPoint 翻页, 之后检测到的 SlideChange 不再重复下发
+            if work_mode == "auto" and scheduler.is_current(item):
+                ppt_page = item.slide
+                logger.info("自动模式: 切换到第 %s 页 (延迟 %.0f ms)", ppt_page, (scheduler.clock() - item.due_at) * 1000)
+                trace = await send_slide_playlist(room, ppt_page, None, cfg.config["preload_slides"], cfg.config["cue_messages"])
+                scheduler.play(ppt_page, trace, ppt_monitor.get_slide_video_file(ppt_page))
+                await com(ppt_monitor.goto_page, ppt_page)
+
+        elif isinstance(item, SlideChange):
             # 监测 PPT 状态变化
             # 优先处理 PPT 激活文件的变化
-            # ppt_page 表示当前的 ppt 页面编号
             ppt_changed = False
             ppt_page = -1
 
-            current_ppt_status = ppt_monitor.get_current_ppt_status()
+            current_ppt_status = item.status
             if current_ppt_status["present_name"] != "" and current_ppt_status["present_name"] != previous_ppt_status["present_name"]:
                 logger.info("检测到PPT发生变化,重新加载视频配置")
                 ppt_monitor.update_slide_video_list(current_ppt_status["present_name"])
@@ -474,88 +281,155 @@ async def broadcast_slide_change():
 
             # 如果发生变化
             if ppt_changed:
+                room.last_slide_change = time.time()
                 logger.info("pptChanged: %s", current_ppt_status)
-            
-            # print(ppt_page)
-            # 如果是自动模式,播放当前页面
-            if cfg.config["work_mode"] == "auto":
-                if ppt_page != -1:
-                    message = json.dumps({
-                        "tasks": "playlist",
-                        "playlist": [
-                            {"video": ppt_monitor.get_slide_video_file(ppt_page), "loop": 1},
-                            {"video": ppt_monitor.get_idle_video_file(ppt_page), "loop": -1}
-                        ]
-                    })
-                    await handler.send_to_clients(message)
-            await asyncio.sleep(0.5)
+                update_timeline(current_ppt_status)
+
+            # 如果是自动模式,播放当前页面; 时间表已经下发过的页面 (AdvanceSlide 引起的翻页) 不再重复下发
+            if work_mode == "auto":
+                if ppt_page != -1 and not (scheduler.active and scheduler.current == ppt_page):
+                    trace = await send_slide_playlist(room, ppt_page, item, cfg.config["preload_slides"], cfg.config["cue_messages"])
+                    scheduler.play(ppt_page, trace, ppt_monitor.get_slide_video_file(ppt_page))
 
             # 更新参数
             previous_ppt_status = current_ppt_status.copy()
 
-def update_avatar_event(event):
-    with open("config.json", "r", encoding="utf-8") as f:
-        j = json.load(f)
-    if not "avatar_event" in j:
-        return
-    j["avatar_event"] = event
-    with open("config.json", "w", encoding="utf-8") as f:
-        json.dump(j, f)
-
-# 管理所有连接的客户端
-class handler:
-    clients = set()
-
-    @classmethod
-    async def handler(cls, websocket, path=None):
-        cls.clients.add(websocket)
-        client_addr = None
+
+async def broadcast_slide_change():
+    # 首次启动使用当前的配置作为基础配置
+    logger.info("读取配置...")
+    cfg = Config()
+
+    logger.info("初始化视频清单...")
+    manifest = SlideVideoManifest()
+    manifest.load()
+    manifest.watch()
+    # 所有房间共用一个 COM 工作线程 (同一个 PowerPoint 进程)
+    com_worker = ComWorker(cfg.config["com_call_timeout"])
+    com_worker.start()
+    cfg.subscribe("com_call_timeout", lambda change: setattr(com_worker, "default_timeout", change.new))
+    handler.com_worker = com_worker
+
+    def set_auto_loop(change):
+        for room in handler.rooms.values():
+            if room.scheduler is not None:
+                room.scheduler.loop_deck = change.new
+
+    cfg.subscribe("auto_loop", set_auto_loop)
+    # 所有房间共用的轮询间隔, 修改配置后下一次轮询生效
+    poll_intervals = PollIntervals.from_config(cfg.config)
+    for key in ("poll_interval_show", "poll_interval_edit", "poll_interval_idle"):
+        cfg.subscribe(key, lambda change: poll_intervals.update(cfg.config))
+    # 视频通过 HTTP 提供给数字人客户端, 播放列表中为 URL; 端口为 0 时使用文件路径
+    asset_server = None
+    if cfg.config["asset_server_port"]:
+        asset_server = AssetServer(manifest, cfg.config["server_host"], cfg.config["asset_server_port"],
+                                   cfg.config["asset_public_host"], cfg.config["asset_cache_max_age"])
         try:
-            # 尝试获取客户端地址以便打印日志
-            try:
-                client_addr = websocket.remote_address
-            except Exception:
-                client_addr = None
-            logger.info("Client connected: %s", client_addr)
-            try:
-                async for message in websocket:
-                    try:
-                        logger.info("Received from %s: %s", client_addr, message)
-                    except Exception as e:
-                        logger.exception("Error printing received message: %s", e)
-                    # 尝试解析为 JSON 并打印解析后的内容
-                    try:
-                        parsed = json.loads(message)
-                        update_avatar_event(parsed)
-                        logger.info("Parsed message: %s", parsed)
-                    except Exception:
-                        logger.exception("Error parsing received message: %s", e)
-            except websockets.exceptions.ConnectionClosed:
-                # 连接被客户端正常或异常关闭
-                logger.info("Client %s closed", client_addr)
-                pass
-        finally:
-            cls.clients.remove(websocket)
-            logger.info("Client disconnected: %s", client_addr)
-    
-    @classmethod
-    async def send_to_clients(cls, message):
-        logger.info("Broadcasting message to %s clients: %s", len(cls.clients), message)
-        if cls.clients:
-            # 原版
-            # await asyncio.wait([client.send(message) for client in cls.clients])
-            # 某些版本下会出现
-            # Passing coroutines coroutines is forbidden use tasks explicitly
-            # 的提示, 需要先转换为任务
-            tasks = [asyncio.create_task(client.send(message)) for client in cls.clients]
-            await asyncio.wait(tasks)
+            await asset_server.start()
+        except OSError as e:
+            logger.error("视频文件服务启动失败: %s, 播放列表使用文件路径", e)
+            asset_server = None
+        else:
+            handler.asset_server = asset_server
+    asset_url = asset_server.url if asset_server is not None else None
+
+    # 运行指标, 由视频文件服务的 /metrics 和 /health 提供
+    metrics = Metrics(handler, cfg)
+    metrics.start()
+    if asset_server is not None:
+        asset_server.add_route("/metrics", metrics.prometheus)
+        asset_server.add_route("/health", metrics.health)
+
+    if cfg.config["latency_export_file"]:
+        asyncio.create_task(export_latency(cfg.config["latency_export_file"]))
+
+    # 会话录制, 用 replay.py 回放; 文件名中可以使用 strftime 格式, 例如 ../log/session-%Y%m%d.ndjson
+    recorder = None
+    if cfg.config["record_file"]:
+        record_file = time.strftime(cfg.config["record_file"])
+        try:
+            recorder = SessionRecorder(record_file)
+        except OSError as e:
+            logger.error("无法打开录制文件 %s: %s", record_file, e)
+        else:
+            logger.info("录制会话到 %s", record_file)
+            atexit.register(recorder.close)
+            recorder.record("session", version=RECORDING_VERSION, started_at=time.time(),
+                            asset_base=asset_server.base_url if asset_server is not None else None,
+                            config={key: cfg.config[key] for key in RECORDED_CONFIG_KEYS})
+            for key in RECORDED_CONFIG_KEYS:
+                cfg.subscribe(key, lambda change: recorder.record("config", key=change.key, value=change.new))
+
+    # 房间名 -> (房间配置, 主循环任务)
+    running = {}
+
+    def on_room_done(name, task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("[%s] 房间主循环异常退出", name, exc_info=task.exception())
+
+    def start_room(name, room_config):
+        room = handler.room(name)
+        room.configured = True
+        room.recorder = recorder
+        task = asyncio.create_task(run_room(room, room_config, cfg, manifest, com_worker, asset_url, poll_intervals))
+        task.add_done_callback(lambda t: on_room_done(name, t))
+        running[name] = (room_config, task)
+
+    def apply_rooms(change=None):
+        '''
+        按配置启动, 停止房间; 只有 work_mode, avatar_command 变化的房间转换为 StateChange 事件, 其余变化重新启动该房间
+        '''
+        configs = room_configs(cfg.config)
+        for name in list(running):
+            if name not in configs:
+                logger.info("[%s] 房间已从配置中删除", name)
+                running.pop(name)[1].cancel()
+                room = handler.room(name)
+                room.configured = False
+                handler.release(room)
+        for name, room_config in configs.items():
+            if name not in running:
+                start_room(name, room_config)
+                continue
+            old_config, task = running[name]
+            if old_config == room_config:
+                continue
+            unchanged = all(old_config[key] == room_config[key] for key in ("presentation", "slide_source"))
+            room = handler.room(name)
+            if unchanged and not task.done() and room.store is not None:
+                # 操作员修改的 work_mode, avatar_command 转换为 StateChange 事件
+                room.store.set_work_mode(room_config["work_mode"])
+                room.store.set_avatar_command(room_config["avatar_command"])
+                running[name] = (room_config, task)
+            else:
+                logger.info("[%s] 房间配置变化, 重新启动", name)
+                task.cancel()
+                start_room(name, room_config)
 
+    for key in ("rooms", "work_mode", "avatar_command", "slide_source"):
+        cfg.subscribe(key, apply_rooms)
+    await cfg.watch()
 
-if __name__ == "__main__":
+    # 启动 WebSocket 服务器
+    async with serve(cfg.config["server_host"], cfg.config["websocket_port"]):
+        logger.info('WebSocket server started at ws://%s:%s', cfg.config["server_host"], cfg.config["websocket_port"])
+        apply_rooms()
+        logger.info("房间: %s", ", ".join(running))
+        await asyncio.Event().wait()
+
+
+def main():
+    from logging_setup import setup_logging
+    setup_logging()
     import tendo.singleton
     try:
-        single = tendo.singleton.SingleInstance()
+        single = tendo.singleton.SingleInstance()  # noqa: F841
     except:
         logger.error("Another instance of the program is already running.")
         exit(1)
     asyncio.run(broadcast_slide_change())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,332 @@
+import logging
+
+import protocol
+from discovery import AppDiscovery, running_process_names
+from manifest import SlideVideoManifest
+from ppt_snapshot import PresentationSnapshot
+from slide_source import EMPTY_PPT_STATUS
+
+logger = logging.getLogger("monitor_service")
+
+
+class PowerPointMonitor():
+    def __init__(self, manifest=None, get_active_object=None, presentation_name=None):
+        '''
+        get_active_object: 替代 win32com.client.GetActiveObject, 用于在没有 PowerPoint 的环境中测试
+        presentation_name: 只跟踪指定的演示文稿 (多展位), None 时跟随当前活动的演示文稿
+        '''
+        self.bound_presentation = presentation_name
+        self._ppt_app_list = ["PowerPoint.Application", "Kwpp.Application"]
+        # 没有演示程序运行时推迟查找; 模拟的 PowerPoint 没有进程, 不检查进程
+        self.discovery = AppDiscovery(self._ppt_app_list, process_check=None if get_active_object else running_process_names)
+        self._get_active_object = get_active_object
+        self.ppt_app_name = None
+        self.ppt_app = None
+        # 缓存 COM 句柄的状态快照, 连接应用后创建
+        self.snapshot = None
+        self.slide_show_active = False
+        self.presentation_name = None
+        # 编译好的 slide_video.json 索引, 多个监控对象可以共用
+        if manifest is None:
+            manifest = SlideVideoManifest()
+            manifest.load()
+        self.manifest = manifest
+        self.deck = None
+        self.__deck_generation = None
+        # get_video_table() 的缓存, 演示文稿或视频清单变化时重新生成
+        self.__video_table = None
+        # 视频在播放列表中的地址, 见 set_asset_url()
+        self.__asset_url = None
+        # 只让 ppt_add 没有连接的信息出现一次
+        self.__ppt_app_warning_flag = True
+
+    def connect_powerpoint(self, force=False):
+        '''
+        连接正在运行的 PowerPoint 或 WPS
+        没有找到时由 discovery 推迟下一次查找, 在此之前的调用直接返回; force 为 True 时立即查找
+        '''
+        if self._get_active_object is None:
+            # 仅在 Windows 上可用, 首次连接时才导入
+            import win32com.client
+            self._get_active_object = win32com.client.GetActiveObject
+        if force:
+            self.discovery.reset()
+        candidates = self.discovery.candidates()
+        self.ppt_app = None
+        for app_name in candidates:
+            try:
+                self.ppt_app = self._get_active_object(app_name)
+                if self.ppt_app:
+                    self.ppt_app_name = app_name
+                    logger.info("连接PPT应用: %s 成功!", app_name)
+                    break
+            except Exception as e:
+                self.ppt_app = None
+        if candidates:
+            if self.ppt_app is None:
+                self.discovery.failed()
+            else:
+                self.discovery.succeeded()
+        self.snapshot = PresentationSnapshot(self.ppt_app, self.bound_presentation) if self.ppt_app else None
+        if self.ppt_app is None:
+            if self.__ppt_app_warning_flag:
+                logger.warning("没有可用的PPT应用")
+                self.__ppt_app_warning_flag = False
+            return
+        else:
+             self.__ppt_app_warning_flag = True
+        
+        if not self.ppt_app.Visible:
+            try:
+                logger.info("PPT应用不可见,设置PPT可见")
+                self.ppt_app.Visible = 1
+            except:
+                logger.warning("设置可见性失败!")
+
+        presentation_name = self.get_presentation_name()
+        if presentation_name:
+            self.update_slide_video_list(presentation_name)
+
+    def get_presentation_name(self):
+        '''
+        获取当前活动的演示文稿名称, 指定了演示文稿时返回指定的名称
+        '''
+        if self.bound_presentation:
+            self.presentation_name = self.bound_presentation
+            return self.presentation_name
+        if self.isConnected():
+            try:
+                presentation = self.ppt_app.ActivePresentation
+                self.presentation_name = presentation.Name
+                return self.presentation_name
+            except:
+                self.presentation_name = None
+                return None
+    def isConnected(self):
+        return True if self.get_presentations_count() > 0 else False
+
+    def get_presentations_count(self):
+        '''
+        根据 PowerPoint 应用程序对象判断是否连接
+        -1: 未连接
+        0: 已连接但无打开的演示文稿
+        n: 已连接且打开了 n 个演示文稿
+        '''
+        if self.ppt_app:
+            try:
+                return self.ppt_app.Presentations.Count
+            except Exception:
+                return -1
+        return -1
+
+    def get_slides_count(self):
+        if self.get_presentations_count()>0:
+            try:
+                presentation = self.ppt_app.ActivePresentation
+                return presentation.Slides.Count
+            except:
+                return -1
+        return -1
+
+    def get_edit_slide_index(self):
+        '''
+        获取编辑的幻灯片编号
+        '''
+        if self.get_presentations_count()>0:
+            try:
+                presentation = self.ppt_app.ActivePresentation
+                slide = presentation.Windows(1).View.Slide
+                return slide.SlideIndex
+            except:
+                return -1
+
+    def get_present_slide_index(self):
+        '''
+        获取播放的幻灯片编号
+        '''
+        if self.get_presentations_count()>0:
+            try:
+                presentation = self.ppt_app.ActivePresentation
+                slide = presentation.SlideShowWindow.View.Slide
+                return slide.SlideIndex
+            except:
+                return -1
+
+    def get_current_ppt_status(self):
+        '''
+        获取当前幻灯片的播放状态和编号, 返回 
+        {"present_count": 打开的ppt数量,
+        "present_name": ppt名字,
+        "slides_count": 胶片数量,
+        "edit_slide_index": 当前编辑的胶片的索引,
+        "present_slide_index": 放映的胶片的索引}
+        编号为 -1 无效
+        '''
+        # 没有连接时尝试连接 (按 discovery 的退避); 已连接但没有打开的演示文稿时不重新连接, 快照只读取演示文稿数量
+        if self.snapshot is None:
+            self.connect_powerpoint()
+        if self.snapshot is None:
+            return dict(EMPTY_PPT_STATUS)
+        current_ppt_status = self.snapshot.refresh()
+        if current_ppt_status is None:
+            # 应用已被关闭, 可能马上重新启动, 立即开始查找
+            self.ppt_app = None
+            self.snapshot = None
+            self.discovery.reset()
+            return dict(EMPTY_PPT_STATUS)
+        return current_ppt_status
+
+    def update_slide_video_list(self, presentation_name):
+        '''
+        获取当前幻灯片中的视频列表
+        '''
+        self.presentation_name = presentation_name
+        self.deck = self.manifest.find_deck(presentation_name)
+        self.__deck_generation = self.manifest.generation
+        if self.deck is None:
+            logger.warning("当前演示文稿 %s 没有配置数字人视频,无法播放数字人!", presentation_name)
+        else:
+            logger.info("当前演示文稿 %s 包含 %s 个视频, 总时长 %.1fs", presentation_name,
+                        len(self.deck.configured_slides()), self.deck.runtime())
+            for asset in self.deck.unplayable():
+                logger.warning("视频 %s 无法播放: %s", asset.path, asset.error or "文件不存在")
+
+    def set_asset_url(self, asset_url):
+        '''
+        asset_url(asset) 返回播放列表, 视频表和预加载中使用的视频地址 (例如 AssetServer.url);
+        None 时使用相对 monitor_service 的文件路径
+        '''
+        self.__asset_url = asset_url
+        self.__video_table = None
+
+    def _asset_ref(self, asset):
+        if self.__asset_url is not None:
+            return self.__asset_url(asset)
+        return asset.path
+
+    def _current_deck(self):
+        # slide_video.json 重新编译后重新查找
+        if self.__deck_generation != self.manifest.generation and self.presentation_name:
+            self.update_slide_video_list(self.presentation_name)
+        return self.deck
+
+    def get_slide_video_file(self, prensentation_index):
+        deck = self._current_deck()
+        if deck is None:
+            logger.warning("当前幻灯片没有配置数字人视频")
+            return []
+        asset = deck.slide(prensentation_index)
+        if asset is None:
+            logger.warning("当前幻灯片 %s 没有配置数字人视频", prensentation_index)
+            return []
+        return self._asset_ref(asset) if asset.playable else None
+
+    def get_slide_video_duration(self, slide_index):
+        '''
+        幻灯片视频的时长 (秒), 没有配置或未知时返回 None
+        '''
+        deck = self._current_deck()
+        asset = deck.slide(slide_index) if deck is not None else None
+        return asset.duration if asset is not None and asset.playable else None
+
+    def get_idle_video_file(self, prensentation_index = None):
+        deck = self._current_deck()
+        if deck is None:
+            logger.warning("当前幻灯片没有配置数字人视频")
+            return []
+        if deck.idle is None:
+            logger.warning("当前幻灯片 idle 没有配置数字人视频")
+            return []
+        return self._asset_ref(deck.idle) if deck.idle.playable else None
+
+    def get_video_table(self):
+        '''
+        当前演示文稿的视频表, 供数字人客户端缓存后按 cue 消息的编号播放
+        {"deck": 名称, "idle": 地址, "slides": [None, 第1页地址, ...], "version": 内容哈希}
+        没有配置视频时返回 None; 缺失或损坏的视频为 None
+        '''
+        deck = self._current_deck()
+        if deck is None:
+            return None
+        if self.__video_table is not None and self.__video_table[0] is deck:
+            return self.__video_table[1]
+        table = protocol.video_table(
+            deck.name,
+            self._asset_ref(deck.idle) if deck.idle is not None and deck.idle.playable else None,
+            [self._asset_ref(asset) if asset is not None and asset.playable else None for asset in deck.slides]
+        )
+        self.__video_table = (deck, table)
+        return table
+
+    def get_preload_videos(self, slide_index, count=2):
+        '''
+        返回需要预加载的视频: idle 视频和之后 count 页的视频, [{"video": 地址, "size": 字节数}]
+        '''
+        deck = self._current_deck()
+        if deck is None or slide_index < 0:
+            return []
+        assets = [deck.idle] + [deck.slide(i) for i in range(slide_index + 1, slide_index + 1 + count)]
+        videos = []
+        for asset in assets:
+            if asset is not None and asset.playable:
+                ref = self._asset_ref(asset)
+                if all(v["video"] != ref for v in videos):
+                    videos.append({"video": ref, "size": asset.size})
+        return videos
+
+    def goto_page(self, dest_slide_index = 0):
+        '''
+        ppt 跳转到指定页面, -1, 指代上一页; 0 指代下一页; 正数指定特定页面
+        如果是播放状态, 跳转播放
+        如果是非播放状态, 则跳转编辑的页面
+        '''
+        current_ppt_status = self.get_current_ppt_status()
+        logger.debug("goto_page(%s): %s", dest_slide_index, current_ppt_status)
+        if current_ppt_status["slides_count"] > 0:
+            if current_ppt_status["present_slide_index"] > 0:
+                # 下一页
+                if dest_slide_index == 0:
+                    if current_ppt_status["present_slide_index"] < current_ppt_status["slides_count"]:
+                        self.snapshot.show_view.Next()
+                elif dest_slide_index == -1:
+                    # 上一页
+                    if current_ppt_status["present_slide_index"] > 1:
+                        self.snapshot.show_view.Previous()
+                else:
+                    if dest_slide_index >= 1 and dest_slide_index <= current_ppt_status["slides_count"]:
+                        self.snapshot.show_view.GotoSlide(dest_slide_index)
+            elif current_ppt_status["edit_slide_index"] > 0:
+                # 下一页
+                if dest_slide_index == 0:
+                    if current_ppt_status["edit_slide_index"] < current_ppt_status["slides_count"]:
+                        self.snapshot.presentation.Slides(current_ppt_status["edit_slide_index"] + 1).Select()
+                elif dest_slide_index == -1:
+                    # 上一页
+                    if current_ppt_status["edit_slide_index"] > 1:
+                        self.snapshot.presentation.Slides(current_ppt_status["edit_slide_index"] - 1).Select()
+                else:
+                    # 与放映时相同, 可以向前跳转 (自动模式循环播放时回到第 1 页)
+                    if dest_slide_index >= 1 and dest_slide_index <= current_ppt_status["slides_count"]:
+                        self.snapshot.presentation.Slides(dest_slide_index).Select()
+
+    def goto_next_page(self):
+        self.goto_page(0)
+
+    def goto_previous_page(self):
+        self.goto_page(-1)
+
+    def start_slideshow(self):
+        if self.get_presentations_count() <= 0:
+            return
+        try:
+            if self.bound_presentation:
+                # 指定的演示文稿不一定是活动窗口
+                if self.snapshot is None or self.snapshot.presentation is None:
+                    self.get_current_ppt_status()
+                presentation = self.snapshot.presentation if self.snapshot is not None else None
+            else:
+                presentation = self.ppt_app.ActivePresentation
+            presentation.SlideShowSettings.Run()
+            self.slide_show_active = True
+        except:
+            logger.warning("开始幻灯片放映失败")
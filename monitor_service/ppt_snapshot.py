@@ -0,0 +1,214 @@
+import logging
+import time
+
+from manifest import normalize_deck_name
+from slide_source import EMPTY_PPT_STATUS
+
+logger = logging.getLogger("monitor_service")
+
+
+class ComCallStats():
+    '''
+    统计每次刷新 (tick) 的 COM 调用次数和耗时
+    '''
+    def __init__(self):
+        self.ticks = 0
+        self.total_calls = 0
+        self.total_seconds = 0.0
+        self.last_tick_calls = 0
+        self.last_tick_seconds = 0.0
+        self._tick_calls = 0
+        self._tick_seconds = 0.0
+
+    def begin_tick(self):
+        self._tick_calls = 0
+        self._tick_seconds = 0.0
+
+    def end_tick(self):
+        self.ticks += 1
+        self.last_tick_calls = self._tick_calls
+        self.last_tick_seconds = self._tick_seconds
+
+    def record(self, seconds):
+        self._tick_calls += 1
+        self._tick_seconds += seconds
+        self.total_calls += 1
+        self.total_seconds += seconds
+
+    def as_dict(self):
+        return {
+            "ticks": self.ticks,
+            "total_calls": self.total_calls,
+            "total_seconds": round(self.total_seconds, 6),
+            "avg_calls_per_tick": round(self.total_calls / self.ticks, 2) if self.ticks else 0,
+            "last_tick_calls": self.last_tick_calls,
+            "last_tick_seconds": round(self.last_tick_seconds, 6)
+        }
+
+
+class PresentationSnapshot():
+    '''
+    PowerPoint 状态快照
+    每一次跨进程的 COM 调用都很昂贵, 快照缓存 Presentations 集合, 活动演示文稿,
+    编辑窗口视图和放映窗口视图的 dispatch 句柄, 直到活动演示文稿发生变化.
+    每次 refresh() 只重新读取易变的字段: 演示文稿数量, 活动演示文稿, 编辑/放映的幻灯片编号.
+    bound_name: 只跟踪指定名称的演示文稿 (多个展位共用一个 PowerPoint 时每个房间一个演示文稿),
+    不读取 ActivePresentation; 演示文稿数量变化时才重新按名称查找.
+    '''
+    # 每隔多少次刷新重新读取一次胶片数量 (编辑模式下可能增删胶片)
+    SLIDES_COUNT_REFRESH_TICKS = 20
+
+    def __init__(self, app, bound_name=None):
+        self.app = app
+        self.bound_name = bound_name
+        self._bound_key = normalize_deck_name(bound_name) if bound_name else None
+        self.stats = ComCallStats()
+        self._presentations = None
+        # 上次查找指定演示文稿时的演示文稿数量
+        self._bound_count = None
+        self.presentation = None
+        self.presentation_name = ""
+        self.slides_count = -1
+        self.edit_view = None
+        self.show_view = None
+        self._ticks_since_slides_count = 0
+
+    def _com(self, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.stats.record(time.perf_counter() - start)
+
+    def invalidate(self):
+        '''
+        丢弃缓存的句柄, 下一次刷新重新获取
+        '''
+        self.presentation = None
+        self.presentation_name = ""
+        self.slides_count = -1
+        self.edit_view = None
+        self.show_view = None
+
+    def _load_presentation(self, presentation):
+        self.invalidate()
+        self.presentation = presentation
+        self.presentation_name = self._com(getattr, presentation, "Name")
+        self.slides_count = self._com(getattr, self._com(getattr, presentation, "Slides"), "Count")
+        self._ticks_since_slides_count = 0
+        try:
+            self.edit_view = self._com(getattr, self._com(presentation.Windows, 1), "View")
+        except Exception:
+            self.edit_view = None
+
+    def _find_bound(self, present_count):
+        '''
+        按名称查找指定的演示文稿, 没有打开时返回 None
+        '''
+        if self.presentation is not None and present_count == self._bound_count:
+            return self.presentation
+        self._bound_count = present_count
+        for index in range(1, present_count + 1):
+            try:
+                presentation = self._com(self._presentations, index)
+                if presentation == self.presentation:
+                    return presentation
+                if normalize_deck_name(self._com(getattr, presentation, "Name")) == self._bound_key:
+                    return presentation
+            except Exception:
+                continue
+        return None
+
+    def _slide_index(self, view):
+        return self._com(getattr, self._com(getattr, view, "Slide"), "SlideIndex")
+
+    def _read_edit_slide_index(self):
+        if self.edit_view is None:
+            return -1
+        try:
+            return self._slide_index(self.edit_view)
+        except Exception:
+            # 编辑窗口被关闭或切换了视图
+            self.edit_view = None
+            return -1
+
+    def _read_present_slide_index(self):
+        if self.show_view is not None:
+            try:
+                return self._slide_index(self.show_view)
+            except Exception:
+                # 缓存的放映视图已失效: 放映已结束, 或者结束后又重新开始 (新的放映窗口)
+                self.show_view = None
+        # 在本次刷新中重新获取放映视图, 重新开始放映时不会出现一次 -1
+        try:
+            self.show_view = self._com(getattr, self._com(getattr, self.presentation, "SlideShowWindow"), "View")
+        except Exception:
+            # 没有在放映
+            return -1
+        try:
+            return self._slide_index(self.show_view)
+        except Exception:
+            self.show_view = None
+            return -1
+
+    def refresh(self):
+        '''
+        读取当前状态, 返回结构同 PowerPointMonitor.get_current_ppt_status()
+        应用已经不可用 (被关闭) 时返回 None
+        '''
+        status = dict(EMPTY_PPT_STATUS)
+        self.stats.begin_tick()
+        try:
+            try:
+                if self._presentations is None:
+                    self._presentations = self._com(getattr, self.app, "Presentations")
+                present_count = self._com(getattr, self._presentations, "Count")
+            except Exception as e:
+                logger.warning("PPT应用不可用: %s", e)
+                self._presentations = None
+                self.invalidate()
+                return None
+            status["present_count"] = present_count
+            if present_count <= 0:
+                self.invalidate()
+                return status
+
+            if self._bound_key is not None:
+                presentation = self._find_bound(present_count)
+                if presentation is None:
+                    # 指定的演示文稿没有打开
+                    self.invalidate()
+                    return status
+            else:
+                try:
+                    presentation = self._com(getattr, self.app, "ActivePresentation")
+                except Exception:
+                    # 没有活动窗口, 例如所有演示文稿都最小化到后台
+                    self.invalidate()
+                    return status
+            if self.presentation is None or presentation != self.presentation:
+                self._load_presentation(presentation)
+            else:
+                self._ticks_since_slides_count += 1
+                if self._ticks_since_slides_count >= self.SLIDES_COUNT_REFRESH_TICKS:
+                    self._ticks_since_slides_count = 0
+                    try:
+                        self.slides_count = self._com(getattr, self._com(getattr, presentation, "Slides"), "Count")
+                    except Exception:
+                        pass
+
+            status["present_name"] = self.presentation_name
+            status["slides_count"] = self.slides_count
+            status["edit_slide_index"] = self._read_edit_slide_index()
+            status["present_slide_index"] = self._read_present_slide_index()
+            if self._bound_key is not None and status["edit_slide_index"] < 0 and status["present_slide_index"] < 0:
+                # 句柄可能已经失效 (演示文稿关闭后又打开了另一个), 下一次刷新重新查找
+                self._bound_count = None
+            if self.slides_count > 0 and max(status["edit_slide_index"], status["present_slide_index"]) > self.slides_count:
+                # 胶片数量已变化
+                self.slides_count = self._com(getattr, self._com(getattr, presentation, "Slides"), "Count")
+                status["slides_count"] = self.slides_count
+            return status
+        finally:
+            # 每次刷新的调用次数和耗时在 stats 中 (状态查询的 com 字段), 不逐次记录日志
+            self.stats.end_tick()
@@ -0,0 +1,124 @@
+'''
+监控服务与数字人客户端之间的消息
+
+服务端 -> 客户端: {"tasks": "playlist" | "deck" | "cue" | "preload" | "pause" | "play" | "snapshot", "seq": N, "epoch": ..., ...}
+客户端 -> 服务端: {"event": "started" | "finished" | "rendered" | "need_deck", "type": ..., "src": ..., "trace": ...}
+
+翻页时不再下发完整的 playlist: 每个演示文稿的视频表 (deck) 只下发一次, 带有内容哈希 version;
+之后每次翻页只下发 {"tasks": "cue", "slide": 7, "seq": N, "version": ...}, 客户端按缓存的视频表
+播放该页视频, 结束后循环 idle 视频. 客户端没有对应版本的视频表时回复 {"event": "need_deck"}.
+
+广播的消息带有递增的 seq 和服务进程的 epoch, 客户端丢弃同一 epoch 中 seq 不大于已处理序号的消息;
+只发给一个客户端的回复 (status, need_deck 的视频表) 不带序号. 客户端连接后首先收到 snapshot.
+
+*_message 返回消息对象 (dict), 广播时由 encode() 序列化一次, 录制直接使用消息对象.
+'''
+import hashlib
+import json
+
+
+def parse_event(event: dict, idle_video_file=None) -> str:
+    '''
+    根据事件, 返回数字人的状态
+    idle
+    playing
+    unknown
+    idle_video_file: 当前的 idle 视频, 开始播放 idle 视频时数字人为 idle 状态
+    '''
+    if "event" in event and "type" in event and "src" in event:
+        if event["event"] == "started":
+            if event["type"] == "video":
+                if event["src"] == idle_video_file:
+                    return "idle"
+                else:
+                    return "playing"
+        elif event["event"] == "finished":
+            return "idle"
+    return "unknown"
+
+
+def playlist_message(playlist, trace=None):
+    '''
+    playlist: [{"video": 文件, "loop": 次数}], loop 为 -1 时循环播放, 空列表表示停止播放
+    '''
+    message = {
+        "tasks": "playlist",
+        "playlist": playlist
+    }
+    if trace is not None:
+        message["trace"] = trace
+    return message
+
+
+def slide_playlist(slide_video, idle_video):
+    '''
+    播放一页的讲解视频, 结束后循环播放 idle 视频; 没有配置或缺失的视频不放入列表
+    与客户端按 cue 在视频表中查到的列表一致
+    '''
+    playlist = []
+    if slide_video:
+        playlist.append({"video": slide_video, "loop": 1})
+    if idle_video:
+        playlist.append({"video": idle_video, "loop": -1})
+    return playlist
+
+
+def idle_playlist(idle_video):
+    return slide_playlist(None, idle_video)
+
+
+def pause_message():
+    return {"tasks": "pause"}
+
+
+def play_message():
+    return {"tasks": "play"}
+
+
+def preload_message(videos):
+    return {
+        "tasks": "preload",
+        "videos": videos
+    }
+
+
+def video_table(deck_name, idle_video, slide_videos):
+    '''
+    slide_videos 按幻灯片编号索引, [0] 不使用, 没有视频的页为 None
+    version 只取决于内容, 视频清单重新编译但内容不变时客户端不需要重新下载
+    '''
+    table = {"deck": deck_name, "idle": idle_video, "slides": list(slide_videos)}
+    content = json.dumps(table, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    table["version"] = hashlib.sha1(content).hexdigest()[:12]
+    return table
+
+
+def deck_message(table):
+    message = {"tasks": "deck"}
+    message.update(table)
+    return message
+
+
+def cue_message(slide, version, trace=None):
+    message = {
+        "tasks": "cue",
+        "slide": slide,
+        "version": version
+    }
+    if trace is not None:
+        message["trace"] = trace
+    return message
+
+
+def encode(message):
+    return json.dumps(message, ensure_ascii=False)
+
+
+def with_sequence(message, seq, epoch):
+    '''
+    在已经序列化的 JSON 对象前面插入 seq 和 epoch, 广播时不需要重新解析和序列化
+    '''
+    prefix = '{"seq": %d, "epoch": %s' % (seq, json.dumps(epoch))
+    if message.lstrip().startswith("{}"):
+        return prefix + "}"
+    return prefix + ", " + message.lstrip()[1:]
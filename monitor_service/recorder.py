@@ -0,0 +1,109 @@
+'''
+会话录制: 把每个房间状态机的输入和输出按到达顺序追加到 NDJSON 文件, 用 replay.py 回放
+
+每行一条记录, t 为录制开始后的单调时钟秒数, room 为房间名 (全局记录为 null):
+  session  录制开始: 版本, 开始时间, 视频文件服务地址, 状态机用到的配置
+  config   配置变化: key, value
+  start    房间的主循环开始: presentation, work_mode, avatar_command, 初始的幻灯片状态 status
+  slide    幻灯片状态变化 (SlideChange): status, origin
+  avatar   数字人事件 (AvatarEvent): event
+  state    工作模式或数字人指令变化 (StateChange): key, old, new
+  advance  自动模式的时间表到期 (AdvanceSlide): slide
+  com      主循环中的 COM 调用: method, args, result
+  out      广播给房间客户端的消息 (不含 seq, epoch): message
+'''
+import json
+import logging
+import time
+
+from slide_source import SlideChange
+from state_store import AvatarEvent, StateChange
+from timeline import AdvanceSlide
+
+logger = logging.getLogger("monitor_service")
+
+RECORDING_VERSION = 1
+# session 记录中保存的配置, 回放时状态机按这些配置运行
+RECORDED_CONFIG_KEYS = ("preload_slides", "cue_messages", "auto_slide_seconds", "auto_loop")
+
+
+class SessionRecorder():
+    '''
+    只追加的 NDJSON 录制文件
+    写入先进入文件缓冲区, 距上次写入磁盘超过 flush_interval 秒时写入, 每条记录只有一次 json.dumps.
+    keep 为 True 时同时保留在内存中 (records, 回放时使用, path 可以为 None); origin 为 t=0 对应的 clock() 时间.
+    '''
+    def __init__(self, path=None, clock=time.monotonic, flush_interval=1.0, keep=False, origin=None):
+        self.path = path
+        self.clock = clock
+        self.flush_interval = flush_interval
+        self.origin = clock() if origin is None else origin
+        self.count = 0
+        self.records = [] if keep else None
+        self._file = open(path, "a", encoding="utf-8", buffering=64 * 1024) if path else None
+        self._flushed_at = self.origin
+
+    def record(self, kind, room=None, **fields):
+        now = self.clock()
+        data = {"t": round(now - self.origin, 6), "kind": kind, "room": room}
+        data.update(fields)
+        self.count += 1
+        if self.records is not None:
+            self.records.append(data)
+        if self._file is None:
+            return
+        try:
+            self._file.write(json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=str) + "\n")
+            if now - self._flushed_at >= self.flush_interval:
+                self._flushed_at = now
+                self._file.flush()
+        except OSError as e:
+            logger.error("写入录制文件失败, 停止录制: %s", e)
+            self.close()
+
+    def record_item(self, room, item):
+        '''
+        记录主循环从事件队列中取出的一项
+        '''
+        if isinstance(item, SlideChange):
+            self.record("slide", room, status=item.status, origin=item.origin)
+        elif isinstance(item, AvatarEvent):
+            self.record("avatar", room, event=item.event)
+        elif isinstance(item, StateChange):
+            self.record("state", room, key=item.key, old=item.old, new=item.new)
+        elif isinstance(item, AdvanceSlide):
+            self.record("advance", room, slide=item.slide)
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+            self._file = None
+
+
+def read_recording(path):
+    '''
+    读取录制文件, 返回会话列表, 每个会话是以 session 记录开始的记录列表
+    无法解析的行 (例如进程退出时写了一半) 跳过
+    '''
+    sessions = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logger.warning("录制文件第 %s 行无法解析, 已跳过", line_number)
+                continue
+            if record.get("kind") == "session" or not sessions:
+                sessions.append([])
+            sessions[-1].append(record)
+    return sessions
@@ -0,0 +1,374 @@
+'''
+回放录制的会话 (recorder.py, 配置项 record_file), 比较回放时下发的消息与录制的消息:
+
+    cd monitor_service && python replay.py ../log/session-20261017.ndjson
+    python replay.py session.ndjson --speed 1000 --room hall-a --json ../log/replay.json
+
+按录制的时间把幻灯片变化, 数字人事件, 工作模式和数字人指令的变化, 配置变化重新送入房间的状态机
+(monitor.run_state_machine). 事件循环使用虚拟时钟, 按 --speed 倍速运行 (0 表示不等待),
+自动模式的时间表与录制时一样按虚拟时间到期, 一整天的展览可以在几分钟内回放完.
+不需要 PowerPoint: 主循环中 COM 调用的结果 (get_current_ppt_status) 按录制的顺序返回, 翻页调用不执行,
+录制中随后的幻灯片变化会送入状态机. 视频清单使用当前的 assets/slide_video.json.
+下发的消息 (不比较 seq, epoch 和 trace) 或 COM 调用与录制不一致, 或状态机异常时返回 1.
+'''
+import argparse
+import asyncio
+import collections
+import difflib
+import functools
+import json
+import logging
+import os
+import selectors
+import sys
+import time
+
+from asset_server import asset_url
+from config import CONFIG_SCHEMA
+from manifest import SlideVideoManifest
+from monitor import run_state_machine
+from ppt_com import PowerPointMonitor
+from recorder import SessionRecorder, read_recording
+from server import Room
+from slide_source import EMPTY_PPT_STATUS, SlideChange
+from state_store import AvatarEvent, StateChange, StateStore
+from timeline import AutoScheduler
+
+logger = logging.getLogger("monitor_service")
+
+# 录制的最后一条记录之后继续运行的虚拟秒数, 回放的时间稍晚于录制时也能比较到最后的消息
+SETTLE_SECONDS = 0.5
+# 每段报告中列出的不一致项数
+MAX_REPORTED_DIFFERENCES = 20
+
+
+class _ScaledSelector():
+    '''
+    事件循环的 selector: 等待 timeout 虚拟秒时实际只等待 timeout / speed 秒, 期间没有 I/O 时虚拟时钟直接前进 timeout
+    '''
+    def __init__(self, speed):
+        self.speed = speed
+        self.loop = None
+        self._selector = selectors.DefaultSelector()
+
+    def select(self, timeout=None):
+        if timeout is None or not self.speed:
+            real_timeout = None if timeout is None else 0
+        else:
+            real_timeout = max(0.0, timeout) / self.speed
+        started = time.monotonic()
+        events = self._selector.select(real_timeout)
+        if timeout is not None and not events:
+            self.loop.virtual_time += max(0.0, timeout)
+        elif self.speed:
+            elapsed = (time.monotonic() - started) * self.speed
+            self.loop.virtual_time += elapsed if timeout is None else min(elapsed, max(0.0, timeout))
+        return events
+
+    def __getattr__(self, name):
+        return getattr(self._selector, name)
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    '''
+    loop.time() 返回虚拟时钟的事件循环, asyncio.sleep, call_later 和 wait_for 都按虚拟时间到期
+    '''
+    def __init__(self, speed=100.0):
+        selector = _ScaledSelector(speed)
+        self.virtual_time = 0.0
+        super().__init__(selector)
+        selector.loop = self
+
+    def time(self):
+        return self.virtual_time
+
+
+class InlineWorker():
+    '''
+    代替 ComWorker, 在事件循环中直接调用 (回放的 PowerPoint 不执行 COM 调用)
+    '''
+    default_timeout = None
+
+    async def call(self, fn, *args, timeout=None):
+        return fn(*args)
+
+
+class ReplayPowerPointMonitor(PowerPointMonitor):
+    '''
+    回放使用的 PowerPoint: 不连接 PowerPoint, get_current_ppt_status 按顺序返回录制的结果, 翻页不执行
+    '''
+    def __init__(self, manifest, statuses):
+        super().__init__(manifest, get_active_object=lambda prog_id: None)
+        self.statuses = collections.deque(statuses)
+        self.last_status = dict(EMPTY_PPT_STATUS)
+
+    def connect_powerpoint(self, force=False):
+        pass
+
+    def get_current_ppt_status(self):
+        if self.statuses:
+            self.last_status = self.statuses.popleft()
+        return dict(self.last_status)
+
+    def goto_page(self, dest_slide_index=0):
+        pass
+
+    def goto_next_page(self):
+        pass
+
+    def goto_previous_page(self):
+        pass
+
+    def start_slideshow(self):
+        pass
+
+
+class _ReplayConfig():
+    '''
+    状态机读取的配置 (cfg.config), 来自录制的 session 记录和 config 记录, 缺少的项使用默认值
+    '''
+    def __init__(self, config):
+        self.config = {key: schema[2] for key, schema in CONFIG_SCHEMA.items()}
+        self.config.update(config)
+
+
+def split_segments(session, room=None):
+    '''
+    按房间的 start 记录 (房间主循环开始) 把一个会话分段, 返回 (session 记录, 全局的 config 记录, 段列表)
+    段: {"room": 房间名, "start": start 记录, "records": 之后该房间的记录}
+    '''
+    header = session[0] if session and session[0]["kind"] == "session" else {}
+    config_records = [record for record in session if record["kind"] == "config"]
+    segments = []
+    current = {}
+    for record in session:
+        name = record.get("room")
+        if name is None or (room is not None and name != room):
+            continue
+        if record["kind"] == "start":
+            current[name] = {"room": name, "start": record, "records": []}
+            segments.append(current[name])
+        elif name in current:
+            current[name]["records"].append(record)
+    return header, config_records, segments
+
+
+def _comparable(record):
+    '''
+    比较用的形式: 下发的消息去掉 trace (每次运行不同), COM 调用只比较方法和参数 (结果是录制的输入)
+    '''
+    if record["kind"] == "out":
+        message = {key: value for key, value in record["message"].items() if key != "trace"}
+        return "out " + json.dumps(message, ensure_ascii=False, sort_keys=True)
+    return "com %s%s" % (record["method"], json.dumps(record["args"]))
+
+
+def compare(expected, actual):
+    '''
+    比较录制的和回放的输出 (out, com 记录), 返回 (一致的条数, 不一致项, 一致项的时间偏差列表)
+    用最长公共子序列对齐, 一条消息缺失或多出时后面的消息仍然能对齐
+    '''
+    expected_keys = [_comparable(record) for record in expected]
+    actual_keys = [_comparable(record) for record in actual]
+    matcher = difflib.SequenceMatcher(None, expected_keys, actual_keys, autojunk=False)
+    matched = 0
+    differences = []
+    drift = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            matched += i2 - i1
+            drift.extend(actual[j]["t"] - expected[i]["t"] for i, j in zip(range(i1, i2), range(j1, j2)))
+            continue
+        pairs = min(i2 - i1, j2 - j1)
+        for offset in range(pairs):
+            differences.append({"type": "changed", "t": expected[i1 + offset]["t"],
+                                "expected": expected_keys[i1 + offset], "actual": actual_keys[j1 + offset]})
+        for i in range(i1 + pairs, i2):
+            differences.append({"type": "missing", "t": expected[i]["t"], "expected": expected_keys[i]})
+        for j in range(j1 + pairs, j2):
+            differences.append({"type": "extra", "t": actual[j]["t"], "actual": actual_keys[j]})
+    return matched, differences, drift
+
+
+async def _sleep_until(loop, at):
+    delay = at - loop.time()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+async def replay_segment(segment, manifest, cfg, asset_base, origin, schedulers):
+    '''
+    在当前 (虚拟时钟的) 事件循环中回放一段, 返回该段的报告
+    origin: 录制时 t=0 对应的 loop.time()
+    '''
+    loop = asyncio.get_running_loop()
+    start = segment["start"]
+    records = segment["records"]
+    room = Room(segment["room"])
+    room.recorder = SessionRecorder(clock=loop.time, keep=True, origin=origin)
+
+    store = StateStore(start["work_mode"], start["avatar_command"])
+    room.store = store
+    room.session.set_work_mode(store.work_mode)
+    ppt_monitor = ReplayPowerPointMonitor(manifest, [record["result"] for record in records
+                                                     if record["kind"] == "com" and record["method"] == "get_current_ppt_status"])
+    if asset_base is not None:
+        ppt_monitor.set_asset_url(functools.partial(asset_url, asset_base))
+    if start["presentation"]:
+        ppt_monitor.update_slide_video_list(start["presentation"])
+    room.ppt_monitor = ppt_monitor
+    scheduler = AutoScheduler(store.inbox, cfg.config["auto_loop"], clock=loop.time)
+    room.scheduler = scheduler
+    schedulers.append(scheduler)
+
+    await _sleep_until(loop, origin + start["t"])
+    machine = asyncio.create_task(run_state_machine(room, store, ppt_monitor, scheduler, InlineWorker(), cfg, manifest,
+                                                    dict(start["status"])))
+    inputs = 0
+    for record in records:
+        kind = record["kind"]
+        if kind not in ("slide", "avatar", "state"):
+            continue
+        await _sleep_until(loop, origin + record["t"])
+        if machine.done():
+            break
+        inputs += 1
+        if kind == "slide":
+            store.inbox.put_nowait(SlideChange(record["status"], loop.time(), record["origin"]))
+        elif kind == "avatar":
+            store.inbox.put_nowait(AvatarEvent(record["event"], received_at=loop.time()))
+        else:
+            setattr(store, record["key"], record["new"])
+            store.inbox.put_nowait(StateChange(record["key"], record["old"], record["new"]))
+    end = max([start["t"]] + [record["t"] for record in records])
+    await _sleep_until(loop, origin + end + SETTLE_SECONDS)
+
+    error = None
+    if machine.done():
+        error = repr(machine.exception()) if machine.exception() is not None else "状态机提前退出"
+    else:
+        machine.cancel()
+        try:
+            await machine
+        except asyncio.CancelledError:
+            pass
+    scheduler.stop()
+
+    expected = [record for record in records if record["kind"] in ("out", "com")]
+    actual = [record for record in room.recorder.records if record["kind"] in ("out", "com") and record["t"] <= end + SETTLE_SECONDS]
+    matched, differences, drift = compare(expected, actual)
+    return {
+        "room": segment["room"],
+        "start": start["t"],
+        "seconds": round(end - start["t"], 3),
+        "inputs": inputs,
+        "expected": len(expected),
+        "replayed": len(actual),
+        "matched": matched,
+        "differences": len(differences),
+        "first_differences": differences[:MAX_REPORTED_DIFFERENCES],
+        "drift_ms": {
+            "max": round(max((abs(d) for d in drift), default=0.0) * 1000, 3),
+            "mean": round(sum(drift) / len(drift) * 1000, 3) if drift else 0.0
+        },
+        "error": error
+    }
+
+
+async def replay_session(session, manifest, room=None):
+    '''
+    回放一个会话: 所有房间的段在同一个事件循环中按录制的时间并发运行
+    '''
+    loop = asyncio.get_running_loop()
+    header, config_records, segments = split_segments(session, room)
+    cfg = _ReplayConfig(header.get("config", {}))
+    origin = loop.time()
+    schedulers = []
+
+    async def apply_config():
+        for record in config_records:
+            await _sleep_until(loop, origin + record["t"])
+            cfg.config[record["key"]] = record["value"]
+            if record["key"] == "auto_loop":
+                for scheduler in schedulers:
+                    scheduler.loop_deck = record["value"]
+
+    config_task = asyncio.create_task(apply_config())
+    try:
+        return await asyncio.gather(*(replay_segment(segment, manifest, cfg, header.get("asset_base"), origin, schedulers)
+                                      for segment in segments))
+    finally:
+        config_task.cancel()
+
+
+def replay(path, speed=100.0, room=None, manifest=None):
+    '''
+    回放录制文件中的所有会话, 返回报告
+    '''
+    if manifest is None:
+        manifest = SlideVideoManifest()
+        manifest.load()
+    started = time.monotonic()
+    segments = []
+    virtual_seconds = 0.0
+    for session in read_recording(path):
+        loop = VirtualTimeLoop(speed)
+        try:
+            segments.extend(loop.run_until_complete(replay_session(session, manifest, room)))
+            virtual_seconds += loop.time()
+        finally:
+            loop.close()
+    return {
+        "file": path,
+        "speed": speed,
+        "segments": segments,
+        "virtual_seconds": round(virtual_seconds, 3),
+        "seconds": round(time.monotonic() - started, 3),
+        "differences": sum(segment["differences"] for segment in segments),
+        "errors": sum(1 for segment in segments if segment["error"])
+    }
+
+
+def print_report(report):
+    for segment in report["segments"]:
+        status = "不一致 %s 处" % segment["differences"] if segment["differences"] else "一致"
+        print("[%s] t=%.3fs, %.1fs, 输入 %s 条, 录制输出 %s 条, 回放输出 %s 条, %s, 时间偏差最大 %.1f ms" % (
+            segment["room"], segment["start"], segment["seconds"], segment["inputs"], segment["expected"],
+            segment["replayed"], status, segment["drift_ms"]["max"]))
+        if segment["error"]:
+            print("  [错误] %s" % segment["error"])
+        for difference in segment["first_differences"]:
+            print("  [%s] t=%.3fs" % (difference["type"], difference["t"]))
+            if "expected" in difference:
+                print("    录制: %s" % difference["expected"])
+            if "actual" in difference:
+                print("    回放: %s" % difference["actual"])
+    print("回放 %s 段, 虚拟时间 %.1fs, 耗时 %.2fs; 不一致 %s 处, 错误 %s 个" % (
+        len(report["segments"]), report["virtual_seconds"], report["seconds"], report["differences"], report["errors"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="回放录制的会话并比较下发的消息")
+    parser.add_argument("file", help="录制文件 (配置项 record_file)")
+    parser.add_argument("--speed", type=float, default=100.0, help="回放倍速, 0 表示不等待")
+    parser.add_argument("--room", help="只回放该房间")
+    parser.add_argument("--json", help="回放结果另存为 JSON 文件")
+    parser.add_argument("--verbose", action="store_true", help="输出 monitor_service 日志")
+    args = parser.parse_args(argv)
+
+    # 命令行中的相对路径相对当前目录, 视频清单的路径相对 monitor_service
+    path = os.path.abspath(args.file)
+    json_file = os.path.abspath(args.json) if args.json else None
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL, format="%(message)s")
+
+    report = replay(path, args.speed, args.room)
+    print_report(report)
+    if json_file:
+        with open(json_file, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 1 if report["differences"] or report["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,298 @@
+import asyncio
+import json
+import logging
+import os
+import urllib.parse
+
+import protocol
+from broadcast import ClientChannel
+from logging_setup import log_stats, preview
+from session import SessionState
+from tracing import LatencyTracer
+
+logger = logging.getLogger("monitor_service")
+
+
+class Room():
+    '''
+    一个展位 (房间): 一个演示文稿和订阅该房间的数字人客户端
+    每个房间有自己的客户端集合, 会话状态和序号, 事件队列和延迟统计, 广播只发给本房间的客户端,
+    与其他房间的客户端数量无关.
+    '''
+    def __init__(self, name):
+        self.name = name
+        # websocket -> ClientChannel, 每个客户端有独立的发送队列和发送任务
+        self.clients = {}
+        # 由 run_room 设置, 收到的事件直接放入队列
+        self.store = None
+        # 翻页到数字人开始播放的延迟统计
+        self.tracer = LatencyTracer()
+        # 由 run_room 设置, 用于状态查询
+        self.ppt_monitor = None
+        self.scheduler = None
+        # 当前演示文稿的视频表, 客户端回复 need_deck 时下发
+        self.deck_message = None
+        self.deck_version = None
+        # 会话状态和广播消息的序号, 客户端连接时下发快照
+        self.session = SessionState()
+        # 配置中有该房间 (客户端也可以订阅还没有配置的房间, 等待配置; 没有配置的房间在最后一个客户端离开时删除)
+        self.configured = False
+        # 收到的客户端消息数; 已离开的客户端发送的消息数和发送失败次数 (当前客户端的在 ClientChannel 中)
+        self.received = 0
+        self._left_sent = 0
+        self._left_failures = 0
+        # 最近一次检测到翻页的时间 (time.time())
+        self.last_slide_change = None
+        # 会话录制 (recorder.SessionRecorder), 由 broadcast_slide_change 设置
+        self.recorder = None
+
+    def join(self, websocket, channel):
+        self.clients[websocket] = channel
+        channel.on_sent = lambda trace: self.tracer.mark(trace, "written")
+        # 新连接或重新连接的客户端立即恢复当前的视频表, 播放列表, 播放位置和暂停状态
+        channel.enqueue(protocol.encode(self.session.snapshot()), "snapshot")
+
+    def leave(self, websocket):
+        channel = self.clients.pop(websocket, None)
+        if channel is not None:
+            self._left_sent += channel.sent
+            self._left_failures += channel.failures
+
+    @property
+    def sent(self):
+        return self._left_sent + sum(channel.sent for channel in self.clients.values())
+
+    @property
+    def send_failures(self):
+        return self._left_failures + sum(channel.failures for channel in self.clients.values())
+
+    def on_client_message(self, channel, parsed, client_addr):
+        if parsed.get("event") == "need_deck":
+            # 客户端没有当前版本的视频表
+            if self.deck_message is not None:
+                channel.enqueue(self.deck_message, "deck")
+            return
+        if parsed.get("event") == "started":
+            self.session.on_avatar_event(parsed)
+        if "trace" in parsed and parsed.get("event") in ("started", "rendered"):
+            self.tracer.mark(parsed["trace"], parsed["event"])
+        if parsed.get("event") == "rendered":
+            # 只用于延迟统计, 不改变数字人状态
+            return
+        if self.store is not None:
+            self.store.post_avatar_event(parsed, client_addr)
+
+    async def send_to_clients(self, kind, message, trace=None):
+        '''
+        放入本房间每个客户端的发送队列后立即返回, 不等待发送完成
+        kind: 消息类型 (tasks 字段), 客户端跟不上时按类型合并; message: protocol 中的消息对象, 在这里序列化一次
+        trace: 延迟追踪的关联 ID, 消息写入连接后记录 written 阶段
+        '''
+        if self.recorder is not None:
+            self.recorder.record("out", self.name, message=message)
+        message = protocol.with_sequence(protocol.encode(message), self.session.next_seq(), self.session.epoch)
+        logger.info("Broadcasting message to %s clients in %s: %s", len(self.clients), self.name, preview(message))
+        if trace is not None:
+            self.tracer.mark(trace, "sent")
+        if self.clients:
+            for channel in list(self.clients.values()):
+                channel.enqueue(message, kind, trace)
+
+    async def send_deck(self, table):
+        '''
+        视频表有变化时广播, 返回是否下发
+        '''
+        if table["version"] == self.deck_version:
+            return False
+        message = protocol.deck_message(table)
+        # 已序列化的视频表, 客户端回复 need_deck 时直接下发
+        self.deck_message = protocol.encode(message)
+        self.deck_version = table["version"]
+        self.session.set_deck(table)
+        logger.info("[%s] 下发视频表: %s (version %s)", self.name, table["deck"], table["version"])
+        await self.send_to_clients("deck", message)
+        return True
+
+    async def send_cue(self, slide, trace=None):
+        deck = self.session.deck
+        self.session.set_playlist(protocol.slide_playlist(deck["slides"][slide] if 0 < slide < len(deck["slides"]) else None,
+                                                          deck["idle"]), slide, trace)
+        await self.send_to_clients("cue", protocol.cue_message(slide, self.deck_version, trace), trace)
+
+    async def send_playlist(self, playlist, trace=None, slide=None):
+        '''
+        下发播放列表, 空列表表示停止播放
+        '''
+        self.session.set_playlist(playlist, slide, trace)
+        await self.send_to_clients("playlist", protocol.playlist_message(playlist, trace), trace)
+
+    async def send_pause(self):
+        self.session.set_paused(True)
+        await self.send_to_clients("pause", protocol.pause_message())
+
+    async def send_play(self):
+        self.session.set_paused(False)
+        await self.send_to_clients("play", protocol.play_message())
+
+    def status(self):
+        status = {
+            "room": self.name,
+            "clients": len(self.clients),
+            "work_mode": self.store.work_mode if self.store is not None else None,
+            "latency_ms": self.tracer.summary(),
+            "recent": self.tracer.recent()
+        }
+        if self.ppt_monitor is not None:
+            status["presentation"] = self.ppt_monitor.presentation_name
+            if self.ppt_monitor.snapshot is not None:
+                status["com"] = self.ppt_monitor.snapshot.stats.as_dict()
+            status["discovery"] = self.ppt_monitor.discovery.as_dict()
+        if self.scheduler is not None:
+            status["auto"] = self.scheduler.status()
+        return status
+
+
+def room_from_path(path):
+    '''
+    连接地址中的房间名: ws://host:port/booth-1 或 ws://host:port/?room=booth-1, 没有时为 None
+    '''
+    if not path:
+        return None
+    parts = urllib.parse.urlsplit(path)
+    room = urllib.parse.parse_qs(parts.query).get("room")
+    if room:
+        return room[0]
+    return urllib.parse.unquote(parts.path.strip("/")) or None
+
+
+# 所有房间和连接的客户端
+class handler:
+    # 没有配置 rooms, 或客户端连接时没有指定房间
+    DEFAULT_ROOM = "default"
+    # 房间名 -> Room
+    rooms = {}
+    # 由 broadcast_slide_change 设置, 所有房间共用
+    com_worker = None
+    asset_server = None
+
+    @classmethod
+    def room(cls, name=None):
+        '''
+        返回房间, 不存在时创建
+        '''
+        name = name or cls.DEFAULT_ROOM
+        room = cls.rooms.get(name)
+        if room is None:
+            room = cls.rooms[name] = Room(name)
+        return room
+
+    @classmethod
+    def release(cls, room):
+        '''
+        删除没有配置并且没有客户端的房间, 客户端订阅的任意房间名不会一直留在 rooms 中
+        '''
+        if not room.configured and not room.clients and cls.rooms.get(room.name) is room:
+            del cls.rooms[room.name]
+
+    @staticmethod
+    def _request_path(websocket, path):
+        if path is not None:
+            return path
+        request = getattr(websocket, "request", None)
+        if request is not None:
+            return request.path
+        return getattr(websocket, "path", None)
+
+    @classmethod
+    async def handler(cls, websocket, path=None):
+        from websockets.exceptions import ConnectionClosed
+        client_addr = None
+        # 尝试获取客户端地址以便打印日志
+        try:
+            client_addr = websocket.remote_address
+        except Exception:
+            client_addr = None
+        room = cls.room(room_from_path(cls._request_path(websocket, path)))
+        if not room.configured:
+            logger.warning("客户端 %s 订阅的房间 %s 没有配置", client_addr, room.name)
+        channel = ClientChannel(websocket, client_addr)
+        room.join(websocket, channel)
+        try:
+            logger.info("Client connected: %s (room %s)", client_addr, room.name)
+            try:
+                async for message in websocket:
+                    logger.info("Received from %s: %s", client_addr, preview(message))
+                    room.received += 1
+                    try:
+                        parsed = json.loads(message)
+                        if parsed.get("query") == "status":
+                            # 状态查询, 只回复给查询的客户端
+                            channel.enqueue(json.dumps(cls.status(room)), "status")
+                            continue
+                        if "subscribe" in parsed:
+                            # 切换房间, 丢弃原房间还没有发送的消息
+                            room.leave(websocket)
+                            cls.release(room)
+                            channel.queue.clear()
+                            room = cls.room(parsed["subscribe"])
+                            room.join(websocket, channel)
+                            logger.info("Client %s subscribed to room %s", client_addr, room.name)
+                            continue
+                        room.on_client_message(channel, parsed, client_addr)
+                    except Exception as e:
+                        logger.exception("Error parsing received message: %s", e)
+            except ConnectionClosed:
+                # 连接被客户端正常或异常关闭
+                logger.info("Client %s closed", client_addr)
+                pass
+        finally:
+            room.leave(websocket)
+            cls.release(room)
+            await channel.close()
+            logger.info("Client disconnected: %s", client_addr)
+
+    @classmethod
+    def status(cls, room):
+        '''
+        {"query": "status"} 的回复: 客户端所在房间的状态和所有房间的客户端数量
+        '''
+        status = {"tasks": "status"}
+        status.update(room.status())
+        status["rooms"] = {name: len(r.clients) for name, r in cls.rooms.items()}
+        if cls.com_worker is not None:
+            status["com_worker"] = cls.com_worker.as_dict()
+        if cls.asset_server is not None:
+            status["assets"] = cls.asset_server.as_dict()
+        stats = log_stats()
+        if stats is not None:
+            status["logging"] = stats
+        return status
+
+
+def latency_file(path, room_name):
+    '''
+    默认房间使用配置的文件名, 其他房间在文件名后加上房间名: latency.json -> latency.booth-1.json
+    '''
+    if room_name == handler.DEFAULT_ROOM:
+        return path
+    base, ext = os.path.splitext(path)
+    return "%s.%s%s" % (base, room_name, ext)
+
+
+async def export_latency(path, interval=60):
+    '''
+    定期把每个房间的延迟统计导出到本地文件
+    '''
+    while True:
+        await asyncio.sleep(interval)
+        for room in list(handler.rooms.values()):
+            if room.configured:
+                room.tracer.export(latency_file(path, room.name))
+
+
+def serve(host, port):
+    '''
+    启动 WebSocket 服务器, 返回 websockets.serve 的异步上下文管理器
+    '''
+    import websockets
+    return websockets.serve(handler.handler, host, port)
@@ -0,0 +1,121 @@
+import itertools
+import logging
+import os
+import time
+
+logger = logging.getLogger("monitor_service")
+
+
+class SessionState():
+    '''
+    服务端的会话状态: 演示文稿的视频表, 当前页, 工作模式, 正在播放的 playlist, 播放位置和暂停状态
+    每次广播的消息都带有单调递增的 seq 和本进程的 epoch, 客户端丢弃重复和乱序的消息;
+    新连接或重新连接的客户端立即收到 snapshot(), 不需要等到下一次翻页.
+    version 在状态每次变化时加一.
+    '''
+    def __init__(self):
+        # 监控服务重启后 seq 重新计数, 客户端据此区分
+        self.epoch = "%x-%s" % (int(time.time()), os.urandom(3).hex())
+        self.version = 0
+        self.seq = 0
+        self._seq = itertools.count(1)
+        self.work_mode = None
+        self.deck = None
+        self.slide = None
+        self.playlist = []
+        self.trace = None
+        self.paused = False
+        # 当前播放的是 playlist 中的第几项, 以及开始播放的时间 (time.monotonic())
+        self.item_index = 0
+        self.item_started_at = None
+        self._paused_at = None
+        self._paused_seconds = 0.0
+
+    def next_seq(self):
+        self.seq = next(self._seq)
+        return self.seq
+
+    def _changed(self):
+        self.version += 1
+
+    def set_work_mode(self, work_mode):
+        if work_mode != self.work_mode:
+            self.work_mode = work_mode
+            self._changed()
+
+    def set_deck(self, table):
+        self.deck = table
+        self._changed()
+
+    def set_playlist(self, playlist, slide=None, trace=None):
+        self.playlist = list(playlist)
+        self.slide = slide
+        self.trace = trace
+        self.paused = False
+        self.item_index = 0
+        self.item_started_at = None
+        self._paused_at = None
+        self._paused_seconds = 0.0
+        self._changed()
+
+    def set_paused(self, paused, at=None):
+        if paused == self.paused:
+            return
+        at = time.monotonic() if at is None else at
+        if paused:
+            self._paused_at = at
+        elif self._paused_at is not None:
+            self._paused_seconds += at - self._paused_at
+            self._paused_at = None
+        self.paused = paused
+        self._changed()
+
+    def on_avatar_event(self, event, received_at=None):
+        '''
+        客户端开始播放 playlist 中的某一项时记录位置; position 为客户端从中间开始播放时的起点 (秒)
+        '''
+        if event.get("event") != "started" or not self.playlist:
+            return
+        src = event.get("src")
+        for index in range(self.item_index, len(self.playlist)):
+            if self.playlist[index].get("video") == src or self.playlist[index].get("image") == src:
+                received_at = time.monotonic() if received_at is None else received_at
+                self.item_index = index
+                self.item_started_at = received_at - float(event.get("position") or 0)
+                self._paused_seconds = 0.0
+                self._paused_at = received_at if self.paused else None
+                self._changed()
+                return
+
+    def position(self, now=None):
+        '''
+        当前项已经播放的秒数, 未开始时为 0
+        '''
+        if self.item_started_at is None:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        end = self._paused_at if self._paused_at is not None else now
+        return max(0.0, end - self.item_started_at - self._paused_seconds)
+
+    def snapshot(self):
+        '''
+        客户端恢复播放所需的全部状态, seq 为最后一次广播的序号
+        playlist 从当前项开始, position 只对播放一次的视频有意义, 循环的项从头播放
+        '''
+        playlist = self.playlist[self.item_index:]
+        position = 0.0
+        if playlist and playlist[0].get("video") and playlist[0].get("loop") == 1:
+            position = round(self.position(), 3)
+        return {
+            "tasks": "snapshot",
+            "epoch": self.epoch,
+            "seq": self.seq,
+            "version": self.version,
+            "work_mode": self.work_mode,
+            "deck": self.deck,
+            "slide": self.slide,
+            "playlist": playlist,
+            "trace": self.trace,
+            "position": position,
+            "paused": self.paused
+        }
@@ -0,0 +1,368 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+
+logger = logging.getLogger("monitor_service")
+
+# 与 PowerPointMonitor.get_current_ppt_status() 返回的结构一致, 编号为 -1 无效
+EMPTY_PPT_STATUS = {
+    "present_count": -1,
+    "present_name": "",
+    "slides_count": -1,
+    "edit_slide_index": -1,
+    "present_slide_index": -1
+}
+
+
+class SlideChange():
+    '''
+    一次幻灯片状态变化
+    status: 变化后的状态, 结构同 get_current_ppt_status()
+    detected_at: 检测到变化的 time.monotonic() 时间戳
+    origin: 变化来源, 如 poll, event:SlideShowNextSlide, fake
+    changed_at: PowerPoint 触发事件的 time.monotonic() 时间戳, 轮询方式无法得知, 为 None
+    '''
+    __slots__ = ("status", "detected_at", "origin", "changed_at")
+
+    def __init__(self, status, detected_at=None, origin="", changed_at=None):
+        self.status = status
+        self.detected_at = time.monotonic() if detected_at is None else detected_at
+        self.origin = origin
+        self.changed_at = changed_at
+
+    def __repr__(self):
+        return "SlideChange(origin=%r, status=%r)" % (self.origin, self.status)
+
+
+class PollIntervals():
+    '''
+    按状态选择轮询间隔 (秒): 放映中 show, 打开了演示文稿 edit, 没有演示程序或演示文稿 idle
+    放映中翻页需要尽快检测; 编辑时只需要及时发现开始放映; 空闲时只需要发现程序启动和打开演示文稿.
+    '''
+    __slots__ = ("show", "edit", "idle")
+
+    def __init__(self, show=0.5, edit=None, idle=None):
+        self.show = show
+        self.edit = show if edit is None else edit
+        self.idle = show if idle is None else idle
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config["poll_interval_show"], config["poll_interval_edit"], config["poll_interval_idle"])
+
+    def update(self, config):
+        self.show = config["poll_interval_show"]
+        self.edit = config["poll_interval_edit"]
+        self.idle = config["poll_interval_idle"]
+
+    def for_status(self, status):
+        if status["present_slide_index"] > 0:
+            return self.show
+        if status["slides_count"] > 0:
+            return self.edit
+        return self.idle
+
+
+class SlideSource():
+    '''
+    幻灯片状态来源的基类
+    检测到的状态变化以 SlideChange 的形式放入 asyncio 队列, 主循环 await next_change()
+    即可在一个事件循环周期内响应, 不需要固定间隔轮询.
+    子类只需要在检测到新状态时调用 publish() (事件循环线程) 或 publish_threadsafe() (其他线程).
+    '''
+    def __init__(self, queue=None):
+        self.queue = queue if queue is not None else asyncio.Queue()
+        self.status = dict(EMPTY_PPT_STATUS)
+        self._loop = None
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+
+    async def stop(self):
+        pass
+
+    def publish(self, status, origin="", changed_at=None, detected_at=None):
+        '''
+        状态与上一次不同时放入队列, 返回是否发生了变化
+        必须在事件循环线程中调用
+        '''
+        if status is None or status == self.status:
+            return False
+        self.status = dict(status)
+        self.queue.put_nowait(SlideChange(dict(status), detected_at, origin, changed_at))
+        return True
+
+    def publish_threadsafe(self, status, origin="", changed_at=None):
+        if self._loop is None or self._loop.is_closed():
+            return
+        self._loop.call_soon_threadsafe(self.publish, status, origin, changed_at, time.monotonic())
+
+    async def next_change(self, timeout=None):
+        '''
+        等待下一次状态变化, 超时返回 None
+        '''
+        try:
+            if timeout is None:
+                return await self.queue.get()
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class PollingSlideSource(SlideSource):
+    '''
+    轮询方式: 定期调用 monitor.get_current_ppt_status()
+    作为事件方式不可用时 (如 WPS 不提供应用事件) 的后备方案
+    interval: 秒, 或 PollIntervals (按上一次读取的状态选择间隔)
+    worker: ComWorker, 指定时在 COM 工作线程中读取状态, 不阻塞事件循环
+    '''
+    def __init__(self, monitor, interval=0.5, queue=None, worker=None):
+        super().__init__(queue)
+        self.monitor = monitor
+        self.intervals = interval if isinstance(interval, PollIntervals) else PollIntervals(interval)
+        # 当前使用的间隔
+        self.interval = self.intervals.for_status(self.status)
+        self.worker = worker
+        self._task = None
+
+    async def start(self):
+        await super().start()
+        try:
+            self.status = dict(await self._read_status())
+        except Exception as e:
+            logger.warning("读取PPT状态失败: %s", e)
+        self.interval = self.intervals.for_status(self.status)
+        self._task = asyncio.create_task(self._run())
+
+    async def _read_status(self):
+        if self.worker is None:
+            return self.monitor.get_current_ppt_status()
+        return await self.worker.call(self.monitor.get_current_ppt_status)
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                status = await self._read_status()
+            except Exception as e:
+                logger.warning("读取PPT状态失败: %s", e)
+                continue
+            self.publish(status, "poll")
+            self.interval = self.intervals.for_status(status)
+
+
+class _PowerPointEvents():
+    '''
+    PowerPoint.Application 事件接收器, 由 win32com.client.WithEvents 实例化
+    source 属性在 WithEvents 之后设置
+    '''
+    source = None
+
+    def _notify(self, name):
+        if self.source is not None:
+            self.source.on_com_event(name)
+
+    def OnSlideShowBegin(self, Wn):
+        self._notify("SlideShowBegin")
+
+    def OnSlideShowNextSlide(self, Wn):
+        self._notify("SlideShowNextSlide")
+
+    def OnSlideShowEnd(self, Pres):
+        self._notify("SlideShowEnd")
+
+    def OnWindowSelectionChange(self, Sel):
+        self._notify("WindowSelectionChange")
+
+    def OnWindowActivate(self, Pres, Wn):
+        self._notify("WindowActivate")
+
+    def OnPresentationOpen(self, Pres):
+        self._notify("PresentationOpen")
+
+    def OnPresentationClose(self, Pres):
+        self._notify("PresentationClose")
+
+
+class ComEventSlideSource(SlideSource):
+    '''
+    事件方式: 在独立线程中订阅 PowerPoint 应用事件
+    (SlideShowNextSlide, WindowSelectionChange 等), 收到事件后立即读取状态并投递到队列.
+    COM 对象只能在创建它的线程使用, 所以事件线程使用 monitor_factory 创建自己的监控对象.
+    应用未启动或不支持事件 (WPS) 时, 线程按 fallback_interval (秒或 PollIntervals) 轮询, 并定期重试订阅事件.
+    worker: ComWorker, 事件线程读取状态的耗时汇总到它的 latency 中 (/metrics)
+    '''
+    def __init__(self, monitor_factory, fallback_interval=0.5, event_poll_interval=2.0, queue=None, worker=None):
+        super().__init__(queue)
+        self.monitor_factory = monitor_factory
+        self.worker = worker
+        self.fallback_interval = fallback_interval if isinstance(fallback_interval, PollIntervals) else PollIntervals(fallback_interval)
+        self.event_poll_interval = event_poll_interval
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._ready = threading.Event()
+        self._monitor = None
+        self._sink = None
+        self._pending_event = None
+
+    async def start(self):
+        await super().start()
+        self._stop_event.clear()
+        self._ready.clear()
+        self._thread = threading.Thread(target=self._run, name="ppt-events", daemon=True)
+        self._thread.start()
+        # 等待事件线程读取到初始状态
+        await asyncio.get_running_loop().run_in_executor(None, self._ready.wait, 5)
+
+    async def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            await asyncio.get_running_loop().run_in_executor(None, self._thread.join, 5)
+            self._thread = None
+
+    def on_com_event(self, name):
+        # 在事件线程的消息泵中调用, 这里只做标记, 读取状态放到消息泵之后, 避免在事件回调中重入 COM
+        if self._pending_event is None:
+            self._pending_event = (name, time.monotonic())
+
+    def _subscribe(self, win32com_client):
+        app = self._monitor.ppt_app
+        if app is None:
+            return False
+        try:
+            self._sink = win32com_client.WithEvents(app, _PowerPointEvents)
+            self._sink.source = self
+            logger.info("已订阅 %s 应用事件", self._monitor.ppt_app_name)
+            return True
+        except Exception as e:
+            logger.info("%s 不支持应用事件, 使用轮询方式: %s", self._monitor.ppt_app_name, e)
+            self._sink = None
+            return False
+
+    def _get_status(self):
+        '''
+        在事件线程中读取状态, 耗时与 ComWorker 中的调用记在同一个方法名下
+        '''
+        start = time.monotonic()
+        try:
+            return self._monitor.get_current_ppt_status()
+        finally:
+            if self.worker is not None and self._loop is not None and not self._loop.is_closed():
+                try:
+                    self._loop.call_soon_threadsafe(self.worker.record_latency,
+                                                    "PowerPointMonitor.get_current_ppt_status", time.monotonic() - start)
+                except RuntimeError:
+                    pass
+
+    def _read_status(self, origin, changed_at=None):
+        try:
+            status = self._get_status()
+        except Exception as e:
+            logger.warning("读取PPT状态失败: %s", e)
+            return None
+        self.publish_threadsafe(status, origin, changed_at)
+        return status
+
+    def _run(self):
+        import pythoncom
+        import win32com.client
+        pythoncom.CoInitialize()
+        try:
+            self._monitor = self.monitor_factory()
+            try:
+                last_status = dict(self._get_status())
+            except Exception as e:
+                logger.warning("读取PPT状态失败: %s", e)
+                last_status = dict(EMPTY_PPT_STATUS)
+            # status 只在事件循环线程中修改; 先于 _ready 的通知排入事件循环, start() 返回时已经设置
+            self._loop.call_soon_threadsafe(setattr, self, "status", dict(last_status))
+            self._ready.set()
+            # 第一次循环时订阅事件
+            subscribed = False
+            last_poll = 0.0
+            while not self._stop_event.is_set():
+                try:
+                    pythoncom.PumpWaitingMessages()
+                    if self._pending_event is not None:
+                        (name, changed_at), self._pending_event = self._pending_event, None
+                        last_status = self._read_status("event:" + name, changed_at) or last_status
+                        last_poll = time.monotonic()
+                        continue
+                    interval = self.event_poll_interval if subscribed else self.fallback_interval.for_status(last_status)
+                    now = time.monotonic()
+                    if now - last_poll >= interval:
+                        last_poll = now
+                        last_status = self._read_status("poll") or last_status
+                        if not subscribed:
+                            subscribed = self._subscribe(win32com.client)
+                        elif self._monitor.ppt_app is None:
+                            # 应用已退出, 事件订阅失效
+                            self._sink = None
+                            subscribed = False
+                except Exception as e:
+                    # PowerPoint 崩溃等引起的 COM 错误不结束线程: 放弃事件订阅, 下一个轮询间隔重新读取状态并订阅
+                    logger.warning("PPT事件线程出错, 稍后重试: %s", e)
+                    self._sink = None
+                    subscribed = False
+                    last_poll = time.monotonic()
+                self._stop_event.wait(0.01)
+        except Exception:
+            logger.exception("PPT事件线程异常退出")
+        finally:
+            self._ready.set()
+            self._sink = None
+            self._monitor = None
+            pythoncom.CoUninitialize()
+
+
+class FakeSlideSource(SlideSource):
+    '''
+    不依赖 PowerPoint 的状态来源, 用于在 Linux 上测试检测到播放的延迟路径
+    '''
+    def __init__(self, status=None, queue=None):
+        super().__init__(queue)
+        if status:
+            self.status.update(status)
+
+    def set_status(self, **fields):
+        status = dict(self.status)
+        status.update(fields)
+        return self.publish(status, "fake")
+
+    def goto(self, slide_index):
+        '''
+        模拟放映时翻页
+        '''
+        return self.set_status(present_slide_index=slide_index, edit_slide_index=slide_index)
+
+
+def create_slide_source(kind, monitor, monitor_factory, interval=0.5, queue=None, worker=None):
+    '''
+    根据配置创建状态来源
+    kind: events 事件方式 (仅 Windows, 失败时退回轮询), polling 轮询方式
+    interval: 轮询间隔, 秒或 PollIntervals
+    worker: 轮询方式使用的 ComWorker, monitor 必须在该线程中创建和连接; 事件方式把读取状态的耗时记到它的 latency 中
+    '''
+    if kind == "events":
+        if sys.platform == "win32":
+            try:
+                import pythoncom  # noqa: F401
+                return ComEventSlideSource(monitor_factory, fallback_interval=interval, queue=queue, worker=worker)
+            except ImportError:
+                logger.warning("pywin32 不可用, 使用轮询方式检测幻灯片变化")
+        else:
+            logger.warning("当前平台不支持PPT应用事件, 使用轮询方式检测幻灯片变化")
+    elif kind != "polling":
+        logger.warning("未知的 slide_source: %s, 使用轮询方式", kind)
+    return PollingSlideSource(monitor, interval=interval, queue=queue, worker=worker)
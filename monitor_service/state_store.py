@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger("monitor_service")
+
+
+class AvatarEvent():
+    '''
+    数字人客户端上报的事件, 如 {"event": "started", "type": "video", "src": ...}
+    '''
+    __slots__ = ("event", "received_at", "client")
+
+    def __init__(self, event, client=None, received_at=None):
+        self.event = event
+        self.client = client
+        self.received_at = time.monotonic() if received_at is None else received_at
+
+    def __repr__(self):
+        return "AvatarEvent(%r)" % (self.event,)
+
+
+class StateChange():
+    '''
+    运行状态变化, key 为 work_mode 或 avatar_command
+    '''
+    __slots__ = ("key", "old", "new")
+
+    def __init__(self, key, old, new):
+        self.key = key
+        self.old = old
+        self.new = new
+
+    def __repr__(self):
+        return "StateChange(%s: %r -> %r)" % (self.key, self.old, self.new)
+
+
+class StateStore():
+    '''
+    进程内的运行状态和事件队列
+    数字人事件, 工作模式和数字人指令的变化都放入 inbox, 主循环直接 await, 不再经过 config.json.
+    SlideSource 可以共用同一个 inbox, 主循环按到达顺序处理所有事件.
+    config.json 只保存操作员编辑的配置.
+    '''
+    WORK_MODES = ("manual", "collaboration", "auto")
+
+    def __init__(self, work_mode="manual", avatar_command="play"):
+        self.inbox = asyncio.Queue()
+        self.work_mode = work_mode
+        self.avatar_command = avatar_command
+        self.last_avatar_event = None
+        self.events_received = 0
+
+    def post_avatar_event(self, event, client=None):
+        self.last_avatar_event = event
+        self.events_received += 1
+        self.inbox.put_nowait(AvatarEvent(event, client))
+
+    def _set(self, key, value):
+        old = getattr(self, key)
+        if old == value:
+            return False
+        setattr(self, key, value)
+        self.inbox.put_nowait(StateChange(key, old, value))
+        return True
+
+    def set_work_mode(self, work_mode):
+        if work_mode not in self.WORK_MODES:
+            logger.warning("未知模式: %s, 按讲解员模式处理", work_mode)
+            work_mode = "manual"
+        return self._set("work_mode", work_mode)
+
+    def set_avatar_command(self, avatar_command):
+        return self._set("avatar_command", avatar_command)
+
+    async def next_event(self, timeout=None):
+        '''
+        等待下一个事件 (AvatarEvent, StateChange 或 SlideChange), 超时返回 None
+        '''
+        try:
+            if timeout is None:
+                return await self.inbox.get()
+            return await asyncio.wait_for(self.inbox.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
@@ -0,0 +1,238 @@
+import asyncio
+import logging
+import time
+
+from tracing import LatencyHistogram
+
+logger = logging.getLogger("monitor_service")
+
+
+class Timeline():
+    '''
+    自动模式下一个演示文稿的时间表
+    durations 按幻灯片编号索引, durations[0] 不使用; 没有视频或时长未知的幻灯片使用 default_seconds.
+    key 为 (演示文稿, 胶片数量, 视频清单版本), 任一变化时需要重新生成.
+    '''
+    def __init__(self, deck_name, durations, default_seconds=5.0, key=None):
+        self.deck_name = deck_name
+        self.key = key
+        self.durations = [None]
+        # 使用默认时长的幻灯片
+        self.estimated = []
+        for slide_index, duration in enumerate(durations, 1):
+            if not duration:
+                duration = default_seconds
+                self.estimated.append(slide_index)
+            self.durations.append(float(duration))
+        # 客户端实际播放的时长, 与文件头中的时长不同时 (解码卡顿, 播放速率) 替代 durations
+        self.observed = {}
+
+    @property
+    def slides_count(self):
+        return len(self.durations) - 1
+
+    def duration(self, slide_index):
+        if slide_index in self.observed:
+            return self.observed[slide_index]
+        if 0 < slide_index < len(self.durations):
+            return self.durations[slide_index]
+        return None
+
+    def total(self):
+        return sum(self.duration(i) for i in range(1, len(self.durations)))
+
+    def observe(self, slide_index, seconds):
+        '''
+        记录客户端实际播放的时长, 与预计相差超过 50% 时认为测量有误
+        '''
+        expected = self.durations[slide_index] if 0 < slide_index < len(self.durations) else None
+        if expected is None or seconds <= 0 or abs(seconds - expected) > expected * 0.5:
+            return
+        self.observed[slide_index] = seconds
+
+
+class AdvanceSlide():
+    '''
+    时间表到期, 切换到 slide, 由 AutoScheduler 放入主循环的队列
+    '''
+    __slots__ = ("slide", "due_at", "generation")
+
+    def __init__(self, slide, due_at, generation):
+        self.slide = slide
+        self.due_at = due_at
+        self.generation = generation
+
+    def __repr__(self):
+        return "AdvanceSlide(slide=%s)" % self.slide
+
+
+class AutoScheduler():
+    '''
+    自动模式的时间表调度
+    每发送一页的 playlist (play), 按该页视频的时长在单调时钟上安排下一页, 到期时向 inbox 放入 AdvanceSlide,
+    主循环先下发 playlist 再翻页, 不再等待客户端 finished, PowerPoint 翻页和检测到变化.
+    提前量 lead 为 playlist 下发到客户端开始播放的时间, 由 started 事件测量, 下一页恰好在当前视频结束时开始.
+    漂移校正:
+      started 事件到达时以实际开始时间重新计算到期时间;
+      finished 事件比预计早到时立即切换;
+      客户端上报的播放时长 (started/finished 的 at, 客户端时钟) 更新时间表中该页的时长.
+    暂停时取消计时, 恢复后剩余的时间表整体后移暂停的时长.
+    clock: 与事件循环的 loop.time() 一致的单调时钟, 回放时为虚拟时钟
+    '''
+    # lead 的上限, 提前量过大会截断当前视频的结尾
+    MAX_LEAD = 0.3
+
+    def __init__(self, inbox, loop_deck=True, lead=0.05, clock=time.monotonic):
+        self.inbox = inbox
+        self.loop_deck = loop_deck
+        self.lead = lead
+        self.clock = clock
+        self.timeline = None
+        self.current = None
+        self.video = None
+        self.trace = None
+        self.sent_at = None
+        # 当前视频在服务端单调时钟上的 (预计或实际) 开始时间
+        self.anchor = None
+        self.due_at = None
+        self.paused_at = None
+        self.generation = 0
+        self.advances = 0
+        self.early_finishes = 0
+        self.paused_seconds = 0.0
+        self._client_started_at = None
+        self._handle = None
+        # 实际开始/结束时间与预计的偏差
+        self.drift = LatencyHistogram(max_samples=512)
+
+    @property
+    def active(self):
+        return self.timeline is not None and self.current is not None
+
+    def load(self, timeline):
+        self.stop()
+        self.timeline = timeline
+        logger.info("自动模式时间表: %s, %s 页, 总时长 %.1fs%s", timeline.deck_name, timeline.slides_count, timeline.total(),
+                    ", 第 %s 页没有视频时长, 按默认时长" % timeline.estimated if timeline.estimated else "")
+
+    def stop(self):
+        self._cancel()
+        self.current = None
+        self.video = None
+        self.trace = None
+        self.paused_at = None
+        self.generation += 1
+
+    def is_current(self, advance):
+        return advance.generation == self.generation and self.paused_at is None
+
+    def next_slide(self):
+        if not self.active:
+            return None
+        if self.current < self.timeline.slides_count:
+            return self.current + 1
+        return 1 if self.loop_deck else None
+
+    def play(self, slide, trace=None, video=None, at=None):
+        '''
+        主循环已经下发 slide 的 playlist
+        '''
+        if self.timeline is None or not 0 < slide <= self.timeline.slides_count:
+            self.stop()
+            return
+        at = self.clock() if at is None else at
+        self._cancel()
+        self.generation += 1
+        self.current = slide
+        self.video = video
+        self.trace = trace
+        self.sent_at = at
+        self.anchor = at + self.lead
+        self.paused_at = None
+        self._client_started_at = None
+        self._schedule()
+
+    def pause(self, at=None):
+        if not self.active or self.paused_at is not None:
+            return
+        self.paused_at = self.clock() if at is None else at
+        self._cancel()
+        self.generation += 1
+
+    def resume(self, at=None):
+        if self.paused_at is None:
+            return
+        at = self.clock() if at is None else at
+        shift = at - self.paused_at
+        self.paused_seconds += shift
+        self.anchor += shift
+        self.paused_at = None
+        self._schedule()
+
+    def on_avatar_event(self, event, received_at):
+        '''
+        用客户端的 started/finished 事件校正时间表
+        '''
+        if not self.active or event.get("type") != "video" or event.get("src") != self.video:
+            return
+        if event.get("trace") is not None and self.trace is not None and event.get("trace") != self.trace:
+            return
+        if event.get("event") == "started":
+            if self._client_started_at is not None:
+                return
+            self._client_started_at = event.get("at")
+            latency = received_at - self.sent_at
+            if 0 <= latency < 5:
+                self.lead = min(self.MAX_LEAD, self.lead * 0.8 + latency * 0.2)
+            self.drift.add(abs(received_at - self.anchor))
+            self.anchor = received_at
+            if self.paused_at is None:
+                self._schedule()
+        elif event.get("event") == "finished":
+            if self._client_started_at is not None and event.get("at") is not None:
+                self.timeline.observe(self.current, (event["at"] - self._client_started_at) / 1000.0)
+            if self._handle is not None:
+                # 视频比预计的早结束
+                self.drift.add(abs(self.due_at + self.lead - received_at))
+                self.early_finishes += 1
+                self._cancel()
+                self._fire()
+
+    def _cancel(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _schedule(self):
+        self._cancel()
+        if not self.active or self.paused_at is not None or self.next_slide() is None:
+            self.due_at = None
+            return
+        self.due_at = self.anchor + self.timeline.duration(self.current) - self.lead
+        delay = max(0.0, self.due_at - self.clock())
+        self._handle = asyncio.get_running_loop().call_later(delay, self._fire)
+
+    def _fire(self):
+        self._handle = None
+        slide = self.next_slide()
+        if slide is None:
+            return
+        self.advances += 1
+        self.inbox.put_nowait(AdvanceSlide(slide, self.due_at, self.generation))
+
+    def status(self):
+        status = {
+            "deck": self.timeline.deck_name if self.timeline else None,
+            "slide": self.current,
+            "paused": self.paused_at is not None,
+            "lead_ms": round(self.lead * 1000, 2),
+            "advances": self.advances,
+            "early_finishes": self.early_finishes,
+            "paused_seconds": round(self.paused_seconds, 3),
+            "drift_ms": self.drift.summary()
+        }
+        if self.due_at is not None and self._handle is not None:
+            status["next_in"] = round(self.due_at - self.clock(), 3)
+        if self.timeline is not None:
+            status["total_seconds"] = round(self.timeline.total(), 3)
+        return status
@@ -0,0 +1,142 @@
+import bisect
+import collections
+import itertools
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger("monitor_service")
+
+# 一次翻页的各个阶段, 时间戳均为监控服务的 time.monotonic()
+#   changed   PowerPoint 触发页面变化事件 (仅事件方式可知)
+#   detected  读取到新的幻灯片状态
+#   handled   主循环取出变化
+#   sent      playlist 放入发送队列
+#   written   playlist 写入第一个客户端的连接
+#   started   客户端上报 {"event": "started"}
+#   rendered  客户端上报第一帧已渲染
+STAGES = ("changed", "detected", "handled", "sent", "written", "started", "rendered")
+
+# 统计的区间
+SEGMENTS = (
+    ("changed", "detected"),
+    ("detected", "sent"),
+    ("sent", "written"),
+    ("written", "started"),
+    ("started", "rendered"),
+    ("detected", "started"),
+    ("detected", "rendered")
+)
+
+
+# 累计直方图的上界 (秒), 用于 /metrics
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class LatencyHistogram():
+    '''
+    保留最近 max_samples 个样本, 按需计算分位数
+    同时按 BUCKETS 累计全部样本的数量和总和 (Prometheus histogram)
+    '''
+    def __init__(self, max_samples=2048):
+        self.samples = collections.deque(maxlen=max_samples)
+        self.count = 0
+        self.sum = 0.0
+        # buckets[i]: 落在 (BUCKETS[i-1], BUCKETS[i]] 中的样本数, 最后一项为超过 BUCKETS[-1] 的样本数
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        self.sum += seconds
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def summary(self):
+        '''
+        返回毫秒为单位的 p50/p95/p99/max
+        '''
+        if not self.samples:
+            return {"count": self.count}
+        ordered = sorted(self.samples)
+
+        def percentile(p):
+            return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 2)
+
+        return {
+            "count": self.count,
+            "p50": percentile(0.50),
+            "p95": percentile(0.95),
+            "p99": percentile(0.99),
+            "max": round(ordered[-1] * 1000, 2)
+        }
+
+
+class LatencyTracer():
+    '''
+    翻页到数字人开始播放的端到端时间线
+    每次发送 playlist 时生成关联 ID (trace), 随 playlist 下发, 客户端在 started/rendered 事件中原样带回.
+    每个阶段只记录第一次的时间, 区间的两端都到齐后计入对应的直方图.
+    '''
+    def __init__(self, max_traces=256):
+        self.traces = collections.OrderedDict()
+        self.max_traces = max_traces
+        self.histograms = {"%s->%s" % segment: LatencyHistogram() for segment in SEGMENTS}
+        self._ids = itertools.count(1)
+        self._prefix = "%x" % int(time.time())
+
+    def begin(self, slide_change=None, slide=None):
+        '''
+        开始一次追踪, slide_change 为触发本次播放的 SlideChange (可以为 None), 返回 trace ID
+        '''
+        trace_id = "%s-%d" % (self._prefix, next(self._ids))
+        trace = {"slide": slide}
+        self.traces[trace_id] = trace
+        if len(self.traces) > self.max_traces:
+            self.traces.popitem(last=False)
+        if slide_change is not None:
+            if getattr(slide_change, "changed_at", None) is not None:
+                self.mark(trace_id, "changed", slide_change.changed_at)
+            self.mark(trace_id, "detected", slide_change.detected_at)
+        self.mark(trace_id, "handled")
+        return trace_id
+
+    def mark(self, trace_id, stage, timestamp=None):
+        trace = self.traces.get(trace_id)
+        if trace is None or stage not in STAGES or stage in trace:
+            return
+        trace[stage] = time.monotonic() if timestamp is None else timestamp
+        for start, end in SEGMENTS:
+            if stage in (start, end) and start in trace and end in trace:
+                self.histograms["%s->%s" % (start, end)].add(trace[end] - trace[start])
+
+    def summary(self):
+        return {name: histogram.summary() for name, histogram in self.histograms.items()}
+
+    def recent(self, count=20):
+        '''
+        最近的追踪记录, 时间为相对 detected (或最早阶段) 的毫秒数
+        '''
+        result = []
+        for trace_id, trace in list(self.traces.items())[-count:]:
+            stages = {stage: trace[stage] for stage in STAGES if stage in trace}
+            base = min(stages.values()) if stages else 0
+            result.append({
+                "trace": trace_id,
+                "slide": trace.get("slide"),
+                "stages": {stage: round((ts - base) * 1000, 2) for stage, ts in stages.items()}
+            })
+        return result
+
+    def export(self, path):
+        data = {"generated_at": time.time(), "latency_ms": self.summary(), "recent": self.recent()}
+        try:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_file = path + ".tmp"
+            with open(tmp_file, "w", encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_file, path)
+        except OSError as e:
+            logger.warning("导出延迟统计失败: %s", e)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# monitor_service 中的模块按文件名互相导入 (与 cd monitor_service && python monitor.py 相同)
+MONITOR_SERVICE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "monitor_service")
+sys.path.insert(0, os.path.abspath(MONITOR_SERVICE_DIR))
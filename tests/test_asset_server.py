@@ -0,0 +1,62 @@
+'''
+视频文件服务: 空闲的文件句柄关闭后文件可以被替换, 空闲的 keep-alive 连接超时关闭
+'''
+import asyncio
+import json
+import os
+
+from asset_server import AssetServer, FileHandleCache
+from manifest import SlideVideoManifest
+
+
+def test_idle_file_handles_are_closed(tmp_path):
+    path = str(tmp_path / "idle.webm")
+    with open(path, "wb") as f:
+        f.write(b"a" * 100)
+    files = FileHandleCache(idle_seconds=5.0)
+    entry = files.acquire(path)
+    # 传输中的文件不关闭
+    files.close_idle(entry.last_used + 10)
+    assert len(files) == 1
+    files.release(entry)
+    files.close_idle(entry.last_used + 1)
+    assert len(files) == 1
+    files.close_idle(entry.last_used + 5)
+    assert len(files) == 0
+    assert entry.file.closed
+    assert files.idle_closed == 1
+    # 关闭后可以替换文件, 下一次请求打开新的文件
+    os.replace(str(tmp_path / "idle.webm"), str(tmp_path / "old.webm"))
+    with open(path, "wb") as f:
+        f.write(b"b" * 50)
+    entry = files.acquire(path)
+    assert entry.size == 50
+    files.release(entry)
+    files.close()
+
+
+def test_idle_keep_alive_connection_is_closed(tmp_path):
+    os.makedirs(str(tmp_path / "videos"))
+    with open(str(tmp_path / "videos" / "idle.webm"), "wb") as f:
+        f.write(b"a" * 100)
+    with open(str(tmp_path / "slide_video.json"), "w", encoding="utf-8") as f:
+        json.dump({"slide_videos": [{"name": "deck.pptx", "videos": {"idle": "videos/idle.webm"}}]}, f)
+    manifest = SlideVideoManifest(str(tmp_path))
+    manifest.load()
+
+    async def run():
+        async with AssetServer(manifest, "127.0.0.1", 0, keep_alive_timeout=0.2) as server:
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+            writer.write(b"GET /assets/videos/idle.webm HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            head = await reader.readuntil(b"\r\n\r\n")
+            assert head.startswith(b"HTTP/1.1 200")
+            assert b"Keep-Alive: timeout=1" in head
+            assert len(await reader.readexactly(100)) == 100
+            assert server.connections == 1
+            # 不再发送请求, 服务端在 keep_alive_timeout 后关闭连接
+            assert await asyncio.wait_for(reader.read(), 2.0) == b""
+            writer.close()
+            await asyncio.sleep(0.01)
+            return server.connections, server.idle_timeouts
+
+    assert asyncio.run(run()) == (0, 1)
@@ -0,0 +1,34 @@
+'''
+ClientChannel: 关闭时发送任务一定结束, 即使取消在一次发送刚好完成时到达
+'''
+import asyncio
+
+from broadcast import ClientChannel
+
+
+class FakeWebSocket():
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, message):
+        self.sent.append(message)
+
+
+def test_close_while_send_completes():
+    async def main():
+        websocket = FakeWebSocket()
+        channel = ClientChannel(websocket)
+        channel.enqueue("message")
+        # 发送任务进入 wait_for 时关闭, 取消和发送完成在同一轮事件循环中
+        await asyncio.sleep(0)
+        await channel.close()
+        assert channel._task.done()
+        assert websocket.sent == ["message"]
+
+    async def watchdog():
+        task = asyncio.create_task(main())
+        done, _ = await asyncio.wait({task}, timeout=1.0)
+        assert task in done, "关闭后发送任务没有结束"
+        task.result()
+
+    asyncio.run(watchdog())
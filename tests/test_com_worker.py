@@ -0,0 +1,141 @@
+'''
+ComWorker: PowerPoint 弹出模态对话框 (模拟的 PowerPoint 阻塞) 时 call() 按时超时, 事件循环不受影响
+'''
+import asyncio
+import threading
+import time
+
+import pytest
+
+from com_worker import ComTimeoutError, ComWorker
+from fake_com import FakePowerPointApp, fake_get_active_object
+from ppt_com import PowerPointMonitor
+
+TIMEOUT = 0.3
+STALL = 1.0
+
+
+def test_stalled_call_times_out_without_blocking_the_loop():
+    app = FakePowerPointApp()
+    app.open("deck.pptx", 5).SlideShowSettings.Run()
+    ppt_monitor = PowerPointMonitor(get_active_object=fake_get_active_object(app))
+    worker = ComWorker(default_timeout=TIMEOUT)
+
+    async def ticker(gaps, stop):
+        # 事件循环每 10ms 醒来一次, 记录实际的间隔
+        last = time.monotonic()
+        while not stop.is_set():
+            await asyncio.sleep(0.01)
+            now = time.monotonic()
+            gaps.append(now - last)
+            last = now
+
+    async def run():
+        await worker.call(ppt_monitor.connect_powerpoint, True)
+        gaps = []
+        stop = asyncio.Event()
+        ticking = asyncio.create_task(ticker(gaps, stop))
+        app.stall(STALL)
+        started = time.monotonic()
+        with pytest.raises(ComTimeoutError):
+            await worker.call(ppt_monitor.get_current_ppt_status)
+        elapsed = time.monotonic() - started
+        hung_during_stall = (worker.hung, worker.hanging, worker.busy_seconds)
+
+        # 对话框关闭后, 被丢弃的调用返回, 之后的调用正常完成
+        await asyncio.sleep(STALL)
+        status = await worker.call(ppt_monitor.get_current_ppt_status)
+        stop.set()
+        await ticking
+        worker.stop()
+        return elapsed, gaps, hung_during_stall, status
+
+    elapsed, gaps, (hung, hanging, busy_seconds), status = asyncio.run(run())
+    assert TIMEOUT <= elapsed < TIMEOUT + 0.2
+    assert hung == 1 and hanging == 1 and busy_seconds > 0
+    assert worker.hung == 1
+    assert worker.hanging == 0
+    assert worker.late == 1
+    assert worker.busy_seconds == 0
+    assert status["present_slide_index"] == 1
+    assert max(gaps) < 0.1
+
+
+def test_latency_is_recorded_on_the_event_loop():
+    app = FakePowerPointApp()
+    app.open("deck.pptx", 5).SlideShowSettings.Run()
+    ppt_monitor = PowerPointMonitor(get_active_object=fake_get_active_object(app))
+    threads = set()
+
+    class Worker(ComWorker):
+        def record_latency(self, name, seconds):
+            threads.add(threading.current_thread())
+            super().record_latency(name, seconds)
+
+    worker = Worker(default_timeout=TIMEOUT)
+
+    async def run():
+        await worker.call(ppt_monitor.connect_powerpoint, True)
+        for _ in range(20):
+            await worker.call(ppt_monitor.get_current_ppt_status)
+        # 其他线程 (PowerPoint 事件线程) 的读取也汇总到同一个直方图
+        loop = asyncio.get_running_loop()
+        thread = threading.Thread(target=lambda: loop.call_soon_threadsafe(
+            worker.record_latency, "PowerPointMonitor.get_current_ppt_status", 0.001))
+        thread.start()
+        thread.join()
+        await asyncio.sleep(0.01)
+
+    try:
+        asyncio.run(run())
+    finally:
+        worker.stop()
+    assert threads == {threading.main_thread()}
+    assert worker.latency["PowerPointMonitor.get_current_ppt_status"].count == 21
+    assert worker.latency["PowerPointMonitor.connect_powerpoint"].count == 1
+
+
+
+def test_timeout_while_the_call_is_being_claimed(monkeypatch):
+    '''
+    工作线程认领调用 (读取开始时间) 的同时调用方超时: 调用方收到 ComTimeoutError 后调用仍然执行时必须计为 hung,
+    返回后计为 late, 不能按排队超时处理
+    '''
+    import com_worker
+
+    class SlowClock():
+        # 工作线程第一次读取时钟 (开始执行时) 等待 0.2 秒, 让超时落在认领调用的过程中
+        delayed = False
+
+        @staticmethod
+        def monotonic():
+            if threading.current_thread().name == "com-sta" and not SlowClock.delayed:
+                SlowClock.delayed = True
+                time.sleep(0.2)
+            return time.monotonic()
+
+        sleep = staticmethod(time.sleep)
+
+    worker = ComWorker(default_timeout=0.05)
+    worker.start()
+    monkeypatch.setattr(com_worker, "time", SlowClock)
+    executed = []
+
+    def work():
+        executed.append(1)
+        time.sleep(0.1)
+
+    async def run():
+        with pytest.raises(ComTimeoutError):
+            await worker.call(work)
+        deadline = time.monotonic() + 5
+        while worker.late == 0:
+            assert time.monotonic() < deadline, "超时的调用没有计为 late"
+            await asyncio.sleep(0.01)
+
+    try:
+        asyncio.run(run())
+    finally:
+        worker.stop()
+    assert executed == [1]
+    assert (worker.timeouts, worker.hung, worker.late, worker.hanging) == (1, 1, 1, 0)
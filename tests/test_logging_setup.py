@@ -0,0 +1,38 @@
+'''
+RateLimitFilter: 多个线程同时从同一位置记录日志时, 通过和丢弃的条数与令牌数一致
+'''
+import logging
+import sys
+import threading
+
+from logging_setup import RateLimitFilter
+
+
+def test_rate_limit_counts_are_consistent_across_threads():
+    # 不补充令牌: 只有 burst 条能通过
+    limiter = RateLimitFilter(rate=0.0, burst=1000)
+    record = logging.LogRecord("monitor_service", logging.INFO, __file__, 1, "message", None, None)
+    threads_count = 8
+    per_thread = 2000
+    passed = [0] * threads_count
+    start = threading.Barrier(threads_count)
+
+    def worker(index):
+        start.wait()
+        for _ in range(per_thread):
+            if limiter.filter(record):
+                passed[index] += 1
+
+    # 频繁切换线程, 没有锁时令牌桶的读取和更新会交错
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=worker, args=(index,)) for index in range(threads_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert sum(passed) == 1000
+    assert limiter.suppressed == threads_count * per_thread - 1000
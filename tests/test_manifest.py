@@ -0,0 +1,74 @@
+'''
+slide_video.json 变化后在线程池中重新编译, 编译期间事件循环不被阻塞, 完成后换上新的清单
+'''
+import asyncio
+import json
+import time
+
+from manifest import SlideVideoManifest
+
+COMPILE_SECONDS = 0.5
+
+
+def _write_config(tmp_path, decks):
+    with open(tmp_path / "slide_video.json", "w", encoding="utf-8") as f:
+        json.dump({"slide_videos": [{"name": name, "videos": {"idle": "idle.webm"}} for name in decks]}, f)
+
+
+class SlowManifest(SlideVideoManifest):
+    '''
+    模拟视频很多时的编译耗时
+    '''
+    def compile(self, *args, **kwargs):
+        time.sleep(COMPILE_SECONDS)
+        return super().compile(*args, **kwargs)
+
+
+def test_reload_runs_off_the_event_loop(tmp_path):
+    _write_config(tmp_path, ["a.pptx"])
+    manifest = SlowManifest(str(tmp_path))
+    assert manifest.load()
+    generation = manifest.generation
+
+    async def run():
+        manifest.watch(debounce=0.05)
+        gaps = []
+        last = time.monotonic()
+        _write_config(tmp_path, ["a.pptx", "b.pptx"])
+        deadline = time.monotonic() + 5
+        while manifest.generation == generation:
+            assert time.monotonic() < deadline, "清单没有重新加载"
+            # 编译期间房间继续使用原来的清单
+            assert manifest.find_deck("a.pptx") is not None
+            await asyncio.sleep(0.01)
+            now = time.monotonic()
+            gaps.append(now - last)
+            last = now
+        manifest.close()
+        return gaps
+
+    gaps = asyncio.run(run())
+    assert max(gaps) < COMPILE_SECONDS / 2
+    assert manifest.find_deck("b.pptx") is not None
+    assert manifest.generation == generation + 1
+
+
+def test_find_deck_falls_back_to_name_suffix(tmp_path):
+    _write_config(tmp_path, ["D:\\展览\\产品介绍.pptx", "booth/demo.pptx", "2024-demo.pptx"])
+    manifest = SlideVideoManifest(str(tmp_path))
+    assert manifest.load()
+    assert manifest.find_deck("Demo.pptx").name == "booth/demo.pptx"
+    # 名称不是文件名时按后缀匹配, 与之前的 endswith 相同
+    assert manifest.find_deck("介绍.pptx").name == "D:\\展览\\产品介绍.pptx"
+    assert manifest.find_deck("other.pptx") is None
+
+
+def test_missing_config_keeps_loaded_decks(tmp_path):
+    _write_config(tmp_path, ["a.pptx"])
+    manifest = SlideVideoManifest(str(tmp_path))
+    assert manifest.load()
+    generation = manifest.generation
+    (tmp_path / "slide_video.json").rename(tmp_path / "slide_video.json.bak")
+    assert not manifest.load()
+    assert manifest.find_deck("a.pptx") is not None
+    assert manifest.generation == generation
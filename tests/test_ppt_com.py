@@ -0,0 +1,38 @@
+'''
+PowerPointMonitor.goto_page: 编辑模式下向前跳转 (自动模式循环播放时从最后一页回到第 1 页)
+'''
+import json
+
+from fake_com import FakePowerPointApp, fake_get_active_object
+from manifest import SlideVideoManifest
+from ppt_com import PowerPointMonitor
+
+
+def connect(tmp_path, slides_count):
+    with open(tmp_path / "slide_video.json", "w", encoding="utf-8") as f:
+        json.dump({"slide_videos": [{"name": "deck.pptx", "videos": {"idle": "idle.webm"}}]}, f)
+    manifest = SlideVideoManifest(str(tmp_path))
+    manifest.load()
+    app = FakePowerPointApp()
+    presentation = app.open("deck.pptx", slides_count)
+    monitor = PowerPointMonitor(manifest, get_active_object=fake_get_active_object(app))
+    monitor.connect_powerpoint(True)
+    return presentation, monitor
+
+
+def test_edit_mode_wraps_to_first_slide(tmp_path):
+    presentation, monitor = connect(tmp_path, 5)
+    presentation.Slides(5).Select()
+    assert monitor.get_current_ppt_status()["edit_slide_index"] == 5
+
+    monitor.goto_page(1)
+    status = monitor.get_current_ppt_status()
+    assert status["edit_slide_index"] == 1
+    assert status["present_slide_index"] == -1
+
+
+def test_edit_mode_ignores_slides_out_of_range(tmp_path):
+    presentation, monitor = connect(tmp_path, 5)
+    presentation.Slides(3).Select()
+    monitor.goto_page(6)
+    assert monitor.get_current_ppt_status()["edit_slide_index"] == 3
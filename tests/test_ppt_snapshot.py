@@ -0,0 +1,32 @@
+'''
+PresentationSnapshot 缓存的放映视图失效 (放映结束后重新开始) 时, 同一次刷新中重新获取, 不返回 -1
+'''
+from fake_com import FakePowerPointApp
+from ppt_snapshot import PresentationSnapshot
+
+
+def test_restarted_show_is_read_in_the_same_refresh():
+    app = FakePowerPointApp()
+    presentation = app.open("deck.pptx", 10)
+    presentation.start_show(2)
+    snapshot = PresentationSnapshot(app)
+    assert snapshot.refresh()["present_slide_index"] == 2
+    cached = snapshot.show_view
+
+    # 两次刷新之间放映结束又重新开始, 缓存的视图属于上一次放映
+    presentation.end_show()
+    presentation.start_show(5)
+    assert snapshot.refresh()["present_slide_index"] == 5
+    assert snapshot.show_view is not cached
+
+
+def test_ended_show_is_not_presenting():
+    app = FakePowerPointApp()
+    presentation = app.open("deck.pptx", 10)
+    presentation.start_show(3)
+    snapshot = PresentationSnapshot(app)
+    assert snapshot.refresh()["present_slide_index"] == 3
+
+    presentation.end_show()
+    assert snapshot.refresh()["present_slide_index"] == -1
+    assert snapshot.show_view is None
@@ -0,0 +1,66 @@
+'''
+客户端订阅没有配置的房间: 房间在最后一个客户端离开时删除, 配置的房间保留
+'''
+import asyncio
+import json
+import types
+
+from server import handler
+
+
+class FakeWebSocket():
+    '''
+    依次收到 messages 中的消息后关闭的连接; 指定 hold (asyncio.Event) 时等到 hold 设置后再关闭
+    '''
+    def __init__(self, path, messages=(), hold=None):
+        self.hold = hold
+        self.request = types.SimpleNamespace(path=path)
+        self.remote_address = ("127.0.0.1", 0)
+        self.messages = [json.dumps(message) for message in messages]
+        self.sent = []
+
+    async def send(self, message):
+        self.sent.append(message)
+
+    async def close(self):
+        pass
+
+    def __aiter__(self):
+        return self._receive()
+
+    async def _receive(self):
+        for message in self.messages:
+            await asyncio.sleep(0)
+            yield message
+        if self.hold is not None:
+            await self.hold.wait()
+
+
+def test_unconfigured_rooms_are_removed(monkeypatch):
+    monkeypatch.setattr(handler, "rooms", {})
+    configured = handler.room("booth-1")
+    configured.configured = True
+
+    async def main():
+        await handler.handler(FakeWebSocket("/booth-1"))
+        await handler.handler(FakeWebSocket("/no-such-room"))
+        await handler.handler(FakeWebSocket("/", [{"subscribe": "room-%s" % index} for index in range(100)]))
+
+    asyncio.run(main())
+    assert handler.rooms == {"booth-1": configured}
+
+
+def test_unconfigured_room_is_kept_while_clients_remain(monkeypatch):
+    monkeypatch.setattr(handler, "rooms", {})
+
+    async def main():
+        hold = asyncio.Event()
+        waiting = asyncio.create_task(handler.handler(FakeWebSocket("/later", hold=hold)))
+        await handler.handler(FakeWebSocket("/later"))
+        # 还有客户端在等待配置, 房间保留
+        assert len(handler.rooms["later"].clients) == 1
+        hold.set()
+        await waiting
+        assert "later" not in handler.rooms
+
+    asyncio.run(main())
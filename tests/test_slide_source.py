@@ -0,0 +1,44 @@
+'''
+检测到播放的延迟路径: FakeSlideSource 的翻页经过 run_state_machine 下发 cue, 延迟追踪记录每个阶段
+'''
+import asyncio
+import time
+
+from slide_source import FakeSlideSource
+from test_state_store import Machine
+
+
+async def wait_for_records(machine, predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not any(predicate(record) for record in machine.room.recorder.records):
+        assert not machine.task.done(), machine.task.exception()
+        assert time.monotonic() < deadline, "状态机没有下发消息"
+        await asyncio.sleep(0.01)
+
+
+def test_slide_change_is_broadcast_and_traced(tmp_path):
+    async def run():
+        machine = Machine(tmp_path, work_mode="auto")
+        source = FakeSlideSource(machine.ppt_monitor.get_current_ppt_status(), queue=machine.store.inbox)
+        await source.start()
+        await machine.start()
+        assert source.goto(2)
+        await wait_for_records(machine, lambda r: r["kind"] == "out" and r["message"]["tasks"] == "cue")
+        cue = [r["message"] for r in machine.records("out") if r["message"]["tasks"] == "cue"][0]
+        # 数字人播放器带回 trace 表示开始播放
+        machine.room.on_client_message(None, {"event": "started", "type": "video", "src": "s2.webm", "trace": cue["trace"]},
+                                       "client")
+        await machine.drain(1)
+        await source.stop()
+        return machine, cue
+
+    machine, cue = asyncio.run(run())
+    assert [r["status"]["present_slide_index"] for r in machine.records("slide")] == [2]
+    assert [r["message"]["tasks"] for r in machine.records("out")][:2] == ["deck", "cue"]
+    assert cue["slide"] == 2
+    trace = machine.room.tracer.traces[cue["trace"]]
+    assert trace["slide"] == 2
+    assert trace["detected"] <= trace["handled"] <= trace["sent"] <= trace["started"]
+    summary = machine.room.tracer.summary()
+    assert summary["detected->sent"]["count"] == 1
+    assert summary["detected->started"]["count"] == 1
@@ -0,0 +1,40 @@
+'''
+没有 pywin32 和 tendo 时 (非 Windows, 工具和测试环境) monitor 可以导入, 并且导入足够快
+'''
+import json
+import os
+import subprocess
+import sys
+
+MONITOR_SERVICE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "monitor_service")
+
+# 导入 monitor 的目标耗时 (秒), 与 bench.py 的 STARTUP_TARGET_SECONDS 相同
+STARTUP_TARGET_SECONDS = 0.5
+
+# 每次在新的解释器中导入 (本进程中其他测试已经导入过 monitor), 屏蔽 Windows 相关模块
+STARTUP_PROBE = """
+import json, sys, time
+for name in ("win32com", "win32com.client", "pythoncom", "pywintypes", "tendo", "tendo.singleton"):
+    sys.modules[name] = None
+start = time.perf_counter()
+import monitor
+elapsed = time.perf_counter() - start
+print(json.dumps({"seconds": elapsed, "loaded": [name for name in ("win32com.client", "pythoncom", "tendo.singleton", "websockets")
+                                                 if sys.modules.get(name) is not None]}))
+"""
+
+
+def _import_monitor():
+    result = subprocess.run([sys.executable, "-c", STARTUP_PROBE], capture_output=True, text=True, cwd=MONITOR_SERVICE_DIR)
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_monitor_imports_without_windows_backends():
+    probe = _import_monitor()
+    assert probe["loaded"] == []
+
+
+def test_monitor_import_time():
+    seconds = min(_import_monitor()["seconds"] for _ in range(3))
+    assert seconds <= STARTUP_TARGET_SECONDS
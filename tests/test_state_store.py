@@ -0,0 +1,156 @@
+'''
+StateStore 的事件队列: 连续到达的数字人事件和状态变化经过 run_state_machine 时一个都不丢失, 并且按到达顺序处理
+'''
+import asyncio
+import json
+import time
+
+from com_worker import ComWorker
+from fake_com import FakePowerPointApp, fake_get_active_object
+from manifest import SlideVideoManifest
+from monitor import run_state_machine
+from ppt_com import PowerPointMonitor
+from recorder import SessionRecorder
+from server import Room
+from state_store import StateStore
+from timeline import AutoScheduler
+
+DECK = "deck.pptx"
+
+
+class Machine():
+    '''
+    一个房间的状态机, 使用模拟的 PowerPoint (放映中, 第 1 页), 用 SessionRecorder 记录处理的事件和下发的消息
+    '''
+    def __init__(self, tmp_path, work_mode="manual", avatar_command="play"):
+        with open(tmp_path / "slide_video.json", "w", encoding="utf-8") as f:
+            json.dump({"slide_videos": [{"name": DECK, "videos": {"idle": "idle.webm", "slide-1": "s1.webm"}}]}, f)
+        self.manifest = SlideVideoManifest(str(tmp_path))
+        self.manifest.load()
+        self.app = FakePowerPointApp()
+        self.presentation = self.app.open(DECK, 10)
+        self.presentation.SlideShowSettings.Run()
+        self.ppt_monitor = PowerPointMonitor(self.manifest, get_active_object=fake_get_active_object(self.app))
+        self.ppt_monitor.connect_powerpoint(True)
+        self.store = StateStore(work_mode, avatar_command)
+        self.room = Room("test")
+        self.room.store = self.store
+        self.room.ppt_monitor = self.ppt_monitor
+        self.room.recorder = SessionRecorder(keep=True)
+        self.worker = ComWorker(2.0)
+        self.task = None
+
+    def records(self, *kinds):
+        return [record for record in self.room.recorder.records if record["kind"] in kinds]
+
+    async def start(self):
+        self.worker.start()
+        scheduler = AutoScheduler(self.store.inbox)
+        status = self.ppt_monitor.get_current_ppt_status()
+        self.task = asyncio.create_task(run_state_machine(self.room, self.store, self.ppt_monitor, scheduler, self.worker,
+                                                          _Config(), self.manifest, status))
+
+    async def drain(self, count, timeout=5.0):
+        '''
+        等待状态机处理完 count 个数字人事件和状态变化, 然后停止
+        '''
+        deadline = time.monotonic() + timeout
+        while len(self.records("avatar", "state")) < count or not self.store.inbox.empty():
+            assert not self.task.done(), self.task.exception()
+            assert time.monotonic() < deadline, "状态机没有处理完队列中的事件"
+            await asyncio.sleep(0.01)
+        # 最后一个事件可能还在等待 COM 调用
+        await asyncio.sleep(0.05)
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.worker.stop()
+
+
+class _Config():
+    config = {"preload_slides": 2, "cue_messages": True, "auto_slide_seconds": 5.0, "auto_loop": True}
+
+
+def test_burst_of_events_is_processed_in_order(tmp_path):
+    count = 300
+    modes = ["collaboration", "auto", "manual"]
+    commands = ["pause", "play"]
+
+    async def run():
+        machine = Machine(tmp_path)
+        expected = []
+        # 状态机启动之前全部放入队列, 模拟一次突发
+        for i in range(count):
+            if i % 3 == 0:
+                new = modes[(i // 3) % len(modes)]
+                old = machine.store.work_mode
+                assert machine.store.set_work_mode(new)
+                expected.append(("state", "work_mode", old, new))
+            elif i % 3 == 1:
+                new = commands[(i // 3) % len(commands)]
+                old = machine.store.avatar_command
+                assert machine.store.set_avatar_command(new)
+                expected.append(("state", "avatar_command", old, new))
+            else:
+                event = {"event": "finished", "type": "video", "src": "clip-%d.webm" % i}
+                machine.store.post_avatar_event(event)
+                expected.append(("avatar", event))
+        await machine.start()
+        await machine.drain(count)
+        return machine, expected
+
+    machine, expected = asyncio.run(run())
+    observed = [("state", r["key"], r["old"], r["new"]) if r["kind"] == "state" else ("avatar", r["event"])
+                for r in machine.records("avatar", "state")]
+    assert observed == expected
+    assert machine.store.events_received == count // 3
+
+
+def test_work_mode_changes_are_not_collapsed(tmp_path):
+    '''
+    manual -> auto -> manual 在主循环处理之前连续到达: 两次切换都按各自的新模式处理,
+    切换到 auto 时翻到下一页, 切换回 manual 时下发空的播放列表
+    '''
+    async def run():
+        machine = Machine(tmp_path, work_mode="manual")
+        machine.store.set_work_mode("auto")
+        machine.store.set_work_mode("manual")
+        await machine.start()
+        await machine.drain(2)
+        return machine
+
+    machine = asyncio.run(run())
+    assert [(r["old"], r["new"]) for r in machine.records("state")] == [("manual", "auto"), ("auto", "manual")]
+    assert [r["method"] for r in machine.records("com")] == ["goto_next_page"]
+    assert machine.presentation.SlideShowWindow.View.Slide.SlideIndex == 2
+    outs = machine.records("out")
+    assert len(outs) == 1
+    assert outs[0]["message"] == {"tasks": "playlist", "playlist": []}
+    assert machine.room.session.work_mode == "manual"
+
+
+def test_collaboration_uses_the_current_slide_before_any_change(tmp_path):
+    '''
+    还没有检测到翻页时切换到协作模式: idle 视频按幻灯片来源的当前页 (放映中第 1 页) 查找, 而不是 -1
+    '''
+    async def run():
+        machine = Machine(tmp_path, work_mode="manual")
+        pages = []
+        get_idle_video_file = machine.ppt_monitor.get_idle_video_file
+
+        def spy(*args):
+            pages.extend(args)
+            return get_idle_video_file(*args)
+
+        machine.ppt_monitor.get_idle_video_file = spy
+        machine.store.set_work_mode("collaboration")
+        await machine.start()
+        await machine.drain(1)
+        return machine, pages
+
+    machine, pages = asyncio.run(run())
+    assert pages == [1]
+    assert [r["message"]["tasks"] for r in machine.records("out")] == ["playlist"]
+    assert machine.room.session.work_mode == "collaboration"